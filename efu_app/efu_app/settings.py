@@ -49,6 +49,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Outermost so its wall time covers the other middleware. It removes
+    # itself unless EFU_ENGINE['PROFILING'] is set.
+    'efu_engine.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -159,3 +162,9 @@ SPECTACULAR_SETTINGS = {
 }
 
 AUTH_USER_MODEL = 'efu_auth.ApiUser'
+
+# Filtering engine, see efu_engine/conf.py for the available keys.
+EFU_ENGINE = {
+    'PROFILING': bool(int(os.environ.get('EFU_PROFILING', 0))),
+    'PROFILING_DIR': os.environ.get('EFU_PROFILING_DIR'),
+}
@@ -0,0 +1,48 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from efu_auth.models import Rule
+from efu_engine.transfer import (
+    FORMAT_CSV,
+    FORMAT_JSONL,
+    FORMATS,
+    dump_rules,
+)
+
+
+class Command(BaseCommand):
+    """Django command to export the rules of a user as JSONL or CSV."""
+    help = 'Write the rules of a user as JSONL or CSV for import_rules.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user', help='Email of the user owning the rules.')
+        parser.add_argument(
+            '--output',
+            default='-',
+            help='File to write, standard output by default.',
+        )
+        parser.add_argument(
+            '--format',
+            choices=FORMATS,
+            dest='file_format',
+            help='File format, detected from the output extension by default.',
+        )
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        try:
+            user = get_user_model().objects.get(email=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError('User %s does not exist.' % options['user'])
+
+        output = options['output']
+        file_format = options['file_format'] or (
+            FORMAT_CSV if output.endswith('.csv') else FORMAT_JSONL
+        )
+        chunks = dump_rules(Rule.objects.filter(user=user).order_by('id'), file_format)
+        if output == '-':
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+        else:
+            with open(output, 'w', newline='') as out:
+                out.writelines(chunks)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from efu_auth.models import RuleSet
+from efu_engine.artifact import dump_stored_ruleset
+
+
+class Command(BaseCommand):
+    """Django command to export a ruleset as a binary artifact."""
+    help = 'Write the compiled binary artifact of a ruleset for filtering agents.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('ruleset', type=int, help='RuleSet id.')
+        parser.add_argument('output', help='Artifact file to write.')
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        try:
+            ruleset = RuleSet.objects.get(pk=options['ruleset'])
+        except RuleSet.DoesNotExist:
+            raise CommandError('RuleSet %s does not exist.' % options['ruleset'])
+
+        data = dump_stored_ruleset(ruleset)
+        with open(options['output'], 'wb') as out:
+            out.write(data)
+        self.stderr.write(f'{len(data)} bytes written.')
@@ -0,0 +1,89 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from efu_auth.models import RuleSet
+from efu_engine.cache import get_compiled_ruleset
+from efu_engine.mailboxes import (
+    evaluate_email,
+    iter_mailbox,
+)
+from efu_engine.matcher import ruleset_rules
+from efu_engine.parallel import evaluate_parallel
+
+
+class Command(BaseCommand):
+    """Django command to filter an mbox file or Maildir with a ruleset."""
+    help = 'Evaluate a ruleset over a mailbox and write the matches as JSONL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='mbox file or Maildir directory.')
+        parser.add_argument('--ruleset', type=int, required=True, help='RuleSet id.')
+        parser.add_argument(
+            '--format',
+            choices=['auto', 'mbox', 'maildir'],
+            default='auto',
+            dest='mailbox_format',
+            help='Mailbox format, detected from the path by default.',
+        )
+        parser.add_argument(
+            '--output',
+            default='-',
+            help='JSONL file to write, standard output by default.',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=0,
+            help='Number of worker processes, 0 to evaluate in this process.',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=256,
+            help='Number of messages sent to a worker at a time.',
+        )
+        parser.add_argument(
+            '--unordered',
+            action='store_true',
+            help='Write results as soon as they are ready instead of in mailbox order.',
+        )
+
+    def _evaluated(self, ruleset, messages, options):
+        """Yield (key, result) pairs for every message of the mailbox."""
+        if options['workers']:
+            return evaluate_parallel(
+                ruleset_rules(ruleset),
+                messages,
+                workers=options['workers'],
+                chunk_size=options['chunk_size'],
+                ordered=not options['unordered'],
+                evaluate=evaluate_email,
+            )
+        compiled = get_compiled_ruleset(ruleset)
+        return ((key, evaluate_email(compiled, raw)) for key, raw in messages)
+
+    def _write(self, out, evaluated):
+        """Write matching results as JSON lines and return their number."""
+        count = 0
+        for key, result in evaluated:
+            if result['rules']:
+                out.write(json.dumps(dict(key=key, **result), default=str) + '\n')
+                count += 1
+        return count
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        try:
+            ruleset = RuleSet.objects.get(pk=options['ruleset'])
+        except RuleSet.DoesNotExist:
+            raise CommandError('RuleSet %s does not exist.' % options['ruleset'])
+
+        messages = iter_mailbox(options['path'], options['mailbox_format'])
+        evaluated = self._evaluated(ruleset, messages, options)
+        if options['output'] == '-':
+            count = self._write(self.stdout, evaluated)
+        else:
+            with open(options['output'], 'w') as out:
+                count = self._write(out, evaluated)
+        self.stderr.write(f'{count} matching messages.')
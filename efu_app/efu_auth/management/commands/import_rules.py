@@ -0,0 +1,57 @@
+import sys
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from efu_engine.transfer import (
+    FORMAT_CSV,
+    FORMAT_JSONL,
+    FORMATS,
+    RuleImportError,
+    load_rules,
+    read_csv,
+    read_jsonl,
+)
+
+
+class Command(BaseCommand):
+    """Django command to import the rules of a user from JSONL or CSV."""
+    help = 'Create the rules of a JSONL or CSV file for a user, skipping existing ones.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user', help='Email of the user owning the rules.')
+        parser.add_argument('path', help='File to read, - for standard input.')
+        parser.add_argument(
+            '--format',
+            choices=FORMATS,
+            dest='file_format',
+            help='File format, detected from the file extension by default.',
+        )
+
+    def _import(self, user, lines, file_format):
+        reader = read_csv if file_format == FORMAT_CSV else read_jsonl
+        try:
+            return load_rules(user, reader(lines))
+        except (RuleImportError, ValueError) as exc:
+            raise CommandError(exc)
+
+    def handle(self, *args, **options):
+        """Entrypoint for command."""
+        try:
+            user = get_user_model().objects.get(email=options['user'])
+        except get_user_model().DoesNotExist:
+            raise CommandError('User %s does not exist.' % options['user'])
+
+        path = options['path']
+        file_format = options['file_format'] or (
+            FORMAT_CSV if path.endswith('.csv') else FORMAT_JSONL
+        )
+        if path == '-':
+            counts = self._import(user, sys.stdin, file_format)
+        else:
+            with open(path, newline='') as lines:
+                counts = self._import(user, lines, file_format)
+        self.stderr.write(
+            f"{counts['created']} of {counts['rows']} rules created, "
+            f"{counts['duplicates']} duplicates skipped."
+        )
@@ -0,0 +1,93 @@
+# Generated by Django 3.2.15 on 2026-10-17 19:55
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApiUser',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('password', models.CharField(max_length=128, verbose_name='password')),
+                ('last_login', models.DateTimeField(blank=True, null=True, verbose_name='last login')),
+                ('is_superuser', models.BooleanField(default=False, help_text='Designates that this user has all permissions without explicitly assigning them.', verbose_name='superuser status')),
+                ('email', models.EmailField(max_length=255, unique=True)),
+                ('name', models.CharField(max_length=255)),
+                ('is_active', models.BooleanField(default=True)),
+                ('is_staff', models.BooleanField(default=False)),
+                ('groups', models.ManyToManyField(blank=True, help_text='The groups this user belongs to. A user will get all permissions granted to each of their groups.', related_name='user_set', related_query_name='user', to='auth.Group', verbose_name='groups')),
+                ('user_permissions', models.ManyToManyField(blank=True, help_text='Specific permissions for this user.', related_name='user_set', related_query_name='user', to='auth.Permission', verbose_name='user permissions')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='Rule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('pattern', models.CharField(max_length=255)),
+                ('description', models.TextField(blank=True)),
+                ('identity_hash', models.CharField(editable=False, max_length=64)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RuleSet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('description', models.CharField(blank=True, max_length=255)),
+                ('version', models.PositiveIntegerField(default=1, editable=False)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RuleSetRule',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rule', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='efu_auth.rule')),
+                ('ruleset', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='efu_auth.ruleset')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='ruleset',
+            name='rules',
+            field=models.ManyToManyField(through='efu_auth.RuleSetRule', to='efu_auth.Rule'),
+        ),
+        migrations.AddField(
+            model_name='ruleset',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddIndex(
+            model_name='rulesetrule',
+            index=models.Index(fields=['rule', 'ruleset'], name='ruleset_rule_reverse_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='rulesetrule',
+            constraint=models.UniqueConstraint(fields=('ruleset', 'rule'), name='ruleset_rule_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='ruleset',
+            index=models.Index(fields=['user', 'id'], name='ruleset_user_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='rule',
+            index=models.Index(fields=['user', 'name', 'id'], name='rule_user_name_id_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='rule',
+            constraint=models.UniqueConstraint(fields=('user', 'identity_hash'), name='rule_user_identity_uniq'),
+        ),
+    ]
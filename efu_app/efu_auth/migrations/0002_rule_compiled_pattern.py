@@ -0,0 +1,61 @@
+# Generated by Django 3.2.15 on 2026-10-17 19:57
+
+from django.db import migrations, models
+
+from efu_engine.patterns import (
+    KIND_LITERAL,
+    PatternError,
+    analyze_pattern,
+)
+
+
+def compile_existing_rules(apps, schema_editor):
+    """Store the precompiled form of every existing rule."""
+    Rule = apps.get_model('efu_auth', 'Rule')
+    fields = ['kind', 'compiled_pattern', 'prefilter', 'needs_backtracking']
+    batch = []
+    for rule in Rule.objects.only('id', 'pattern').iterator(chunk_size=1000):
+        try:
+            analyzed = analyze_pattern(rule.pattern)
+        except PatternError:
+            # Patterns were not validated before; keep invalid regexes
+            # usable by matching them as plain text.
+            analyzed = analyze_pattern(rule.pattern, KIND_LITERAL)
+        for field, value in analyzed.items():
+            setattr(rule, field, value)
+        batch.append(rule)
+        if len(batch) >= 1000:
+            Rule.objects.bulk_update(batch, fields)
+            batch = []
+    Rule.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='compiled_pattern',
+            field=models.TextField(blank=True, editable=False),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='kind',
+            field=models.CharField(blank=True, choices=[('literal', 'Literal'), ('regex', 'Regular expression'), ('glob', 'Glob')], max_length=16),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='needs_backtracking',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='prefilter',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+        migrations.RunPython(compile_existing_rules, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 3.2.15 on 2026-10-17 19:59
+
+from django.db import migrations, models
+
+from efu_engine.patterns import analyze_pattern
+
+
+def compute_rule_atoms(apps, schema_editor):
+    """Store the prefilter atoms of every existing rule."""
+    Rule = apps.get_model('efu_auth', 'Rule')
+    batch = []
+    rules = Rule.objects.only('id', 'pattern', 'kind')
+    for rule in rules.iterator(chunk_size=1000):
+        # Stored patterns were validated against their kind by 0002.
+        rule.atoms = analyze_pattern(rule.pattern, rule.kind)['atoms']
+        batch.append(rule)
+        if len(batch) >= 1000:
+            Rule.objects.bulk_update(batch, ['atoms'])
+            batch = []
+    Rule.objects.bulk_update(batch, ['atoms'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0002_rule_compiled_pattern'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='atoms',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.RunPython(compute_rule_atoms, migrations.RunPython.noop),
+    ]
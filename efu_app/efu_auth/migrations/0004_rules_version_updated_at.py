@@ -0,0 +1,34 @@
+# Generated by Django 3.2.15 on 2026-10-17 20:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0003_rule_atoms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apiuser',
+            name='rules_updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AddField(
+            model_name='apiuser',
+            name='rules_version',
+            field=models.PositiveIntegerField(default=1, editable=False),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='ruleset',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
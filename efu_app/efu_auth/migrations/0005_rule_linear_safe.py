@@ -0,0 +1,39 @@
+# Generated by Django 3.2.15 on 2026-10-17 20:18
+
+from django.db import migrations, models
+
+from efu_engine.patterns import (
+    KIND_LITERAL,
+    analyze_pattern,
+)
+
+
+def compute_rule_linear_safe(apps, schema_editor):
+    """Classify the regexes of existing rules."""
+    Rule = apps.get_model('efu_auth', 'Rule')
+    batch = []
+    rules = Rule.objects.exclude(kind=KIND_LITERAL).only('id', 'pattern', 'kind')
+    for rule in rules.iterator(chunk_size=1000):
+        rule.linear_safe = analyze_pattern(rule.pattern, rule.kind)['linear_safe']
+        if not rule.linear_safe:
+            batch.append(rule)
+        if len(batch) >= 1000:
+            Rule.objects.bulk_update(batch, ['linear_safe'])
+            batch = []
+    Rule.objects.bulk_update(batch, ['linear_safe'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0004_rules_version_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='linear_safe',
+            field=models.BooleanField(default=True, editable=False),
+        ),
+        migrations.RunPython(compute_rule_linear_safe, migrations.RunPython.noop),
+    ]
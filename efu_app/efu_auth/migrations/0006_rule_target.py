@@ -0,0 +1,23 @@
+# Generated by Django 3.2.15 on 2026-10-17 20:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0005_rule_linear_safe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='header',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='rule',
+            name='target',
+            field=models.CharField(choices=[('message', 'Whole message'), ('header', 'Header'), ('subject', 'Subject'), ('body', 'Plain text body'), ('html', 'HTML body'), ('attachments', 'Attachment names'), ('raw', 'Raw source')], default='message', max_length=16),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.15 on 2026-10-17 20:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0006_rule_target'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rulesetrule',
+            name='action',
+            field=models.CharField(choices=[('accept', 'Accept'), ('reject', 'Reject'), ('tag', 'Tag'), ('stop', 'Stop')], default='tag', max_length=16),
+        ),
+        migrations.AddField(
+            model_name='rulesetrule',
+            name='position',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
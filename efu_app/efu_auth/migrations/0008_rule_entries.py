@@ -0,0 +1,31 @@
+# Generated by Django 3.2.15 on 2026-10-17 20:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0007_rulesetrule_position_action'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rule',
+            name='kind',
+            field=models.CharField(blank=True, choices=[('literal', 'Literal'), ('regex', 'Regular expression'), ('glob', 'Glob'), ('domain', 'Domain set'), ('address', 'Email address set'), ('ip', 'IP network set')], max_length=16),
+        ),
+        migrations.CreateModel(
+            name='RuleEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('value', models.CharField(max_length=255)),
+                ('rule', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='entries', to='efu_auth.rule')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='ruleentry',
+            constraint=models.UniqueConstraint(fields=('rule', 'value'), name='rule_entry_uniq'),
+        ),
+    ]
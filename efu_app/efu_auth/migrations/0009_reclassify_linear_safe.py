@@ -0,0 +1,36 @@
+from django.db import migrations
+
+from efu_engine.patterns import (
+    KIND_LITERAL,
+    analyze_pattern,
+)
+from efu_engine.sets import SET_KINDS
+
+
+def reclassify_rule_linear_safe(apps, schema_editor):
+    """Classify the regexes of existing rules with the stricter checks."""
+    Rule = apps.get_model('efu_auth', 'Rule')
+    batch = []
+    rules = Rule.objects.exclude(
+        kind__in=[KIND_LITERAL, *SET_KINDS],
+    ).only('id', 'pattern', 'kind', 'linear_safe')
+    for rule in rules.iterator(chunk_size=1000):
+        linear_safe = analyze_pattern(rule.pattern, rule.kind)['linear_safe']
+        if linear_safe != rule.linear_safe:
+            rule.linear_safe = linear_safe
+            batch.append(rule)
+        if len(batch) >= 1000:
+            Rule.objects.bulk_update(batch, ['linear_safe'])
+            batch = []
+    Rule.objects.bulk_update(batch, ['linear_safe'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0008_rule_entries'),
+    ]
+
+    operations = [
+        migrations.RunPython(reclassify_rule_linear_safe, migrations.RunPython.noop),
+    ]
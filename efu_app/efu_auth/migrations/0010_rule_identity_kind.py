@@ -0,0 +1,51 @@
+import hashlib
+
+from django.db import migrations
+
+# Frozen copies of the pattern metacharacters and identity hash of this
+# migration's time, so later changes to them leave it unchanged.
+REGEX_METACHARS = frozenset('.^$*+?{}[]\\|()')
+
+
+def make_identity_hash(name, pattern, description, target, header, kind):
+    """Return the identity hash of a rule as Rule computed it then."""
+    parts = [name, pattern, description]
+    if target != 'message' or header:
+        parts.extend((target, header))
+    default_kind = 'regex' if REGEX_METACHARS.intersection(pattern) else 'literal'
+    if kind and kind != default_kind:
+        parts.append(kind)
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def rehash_rule_identity(apps, schema_editor):
+    """Include the kind in the identity hash of rules of a chosen kind."""
+    Rule = apps.get_model('efu_auth', 'Rule')
+    batch = []
+    rules = Rule.objects.only(
+        'id', 'name', 'pattern', 'description', 'target', 'header', 'kind',
+        'identity_hash',
+    )
+    for rule in rules.iterator(chunk_size=1000):
+        identity_hash = make_identity_hash(
+            rule.name, rule.pattern, rule.description, rule.target, rule.header,
+            rule.kind,
+        )
+        if identity_hash != rule.identity_hash:
+            rule.identity_hash = identity_hash
+            batch.append(rule)
+        if len(batch) >= 1000:
+            Rule.objects.bulk_update(batch, ['identity_hash'])
+            batch = []
+    Rule.objects.bulk_update(batch, ['identity_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0009_reclassify_linear_safe'),
+    ]
+
+    operations = [
+        migrations.RunPython(rehash_rule_identity, migrations.RunPython.noop),
+    ]
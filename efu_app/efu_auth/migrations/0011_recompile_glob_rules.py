@@ -0,0 +1,33 @@
+from django.db import migrations
+
+from efu_engine.patterns import (
+    KIND_GLOB,
+    analyze_pattern,
+)
+
+
+def recompile_glob_rules(apps, schema_editor):
+    """Translate the globs of existing rules with the fixed character sets."""
+    Rule = apps.get_model('efu_auth', 'Rule')
+    batch = []
+    rules = Rule.objects.filter(kind=KIND_GLOB, pattern__contains='[')
+    fields = list(analyze_pattern('*', KIND_GLOB))
+    for rule in rules.iterator(chunk_size=1000):
+        for field, value in analyze_pattern(rule.pattern, rule.kind).items():
+            setattr(rule, field, value)
+        batch.append(rule)
+        if len(batch) >= 1000:
+            Rule.objects.bulk_update(batch, fields)
+            batch = []
+    Rule.objects.bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('efu_auth', '0010_rule_identity_kind'),
+    ]
+
+    operations = [
+        migrations.RunPython(recompile_glob_rules, migrations.RunPython.noop),
+    ]
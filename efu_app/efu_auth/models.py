@@ -1,14 +1,47 @@
+import hashlib
 import uuid
 import os
 
 from django.conf import settings
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import (
     AbstractBaseUser,
     BaseUserManager,
     PermissionsMixin,
 )
 
+from efu_engine.actions import (
+    ACTION_CHOICES,
+    ACTION_TAG,
+)
+from efu_engine.message import (
+    TARGET_CHOICES,
+    TARGET_MESSAGE,
+)
+from efu_engine.patterns import (
+    KIND_CHOICES,
+    analyze_pattern,
+    default_kind,
+)
+
+def _without_fields(instance, kwargs, fields):
+    """Return save() kwargs leaving fields out of the update of a stored row.
+
+    Counters bumped with F() updates must not be written back by a save
+    of an instance loaded before the bump.
+    """
+    if instance._state.adding or kwargs.get('force_insert'):
+        return kwargs
+    update_fields = kwargs.get('update_fields')
+    if update_fields is None:
+        update_fields = [
+            field.name for field in instance._meta.concrete_fields if not field.primary_key
+        ]
+    kwargs['update_fields'] = [name for name in update_fields if name not in fields]
+    return kwargs
+
+
 class ApiUserManager(BaseUserManager):
     """Manager for users."""
 
@@ -37,10 +70,20 @@ class ApiUser(AbstractBaseUser, PermissionsMixin):
     name = models.CharField(max_length=255)
     is_active = models.BooleanField(default=True)
     is_staff = models.BooleanField(default=False)
+    # Bumped by efu_engine.signals on every change to the rulesets or rules
+    # of the user; the ETag and Last-Modified of ruleset reads derive from
+    # them without loading any ruleset. Saves never write them.
+    rules_version = models.PositiveIntegerField(default=1, editable=False)
+    rules_updated_at = models.DateTimeField(default=timezone.now, editable=False)
 
     objects = ApiUserManager()
 
     USERNAME_FIELD = 'email'
+    VERSION_FIELDS = ('rules_version', 'rules_updated_at')
+
+    def save(self, *args, **kwargs):
+        """Save the user, leaving the rules version to efu_engine.signals."""
+        super().save(*args, **_without_fields(self, kwargs, self.VERSION_FIELDS))
 
 class Rule(models.Model):
     user = models.ForeignKey(
@@ -50,10 +93,118 @@ class Rule(models.Model):
     name = models.CharField(max_length=255)
     pattern = models.CharField(max_length=255)
     description = models.TextField(blank=True)
+    # Hash of the fields identifying a rule, so finding an existing rule is
+    # a single probe of the (user, identity_hash) unique index.
+    identity_hash = models.CharField(max_length=64, editable=False)
+    # How pattern is interpreted, inferred from the pattern when blank.
+    kind = models.CharField(max_length=16, choices=KIND_CHOICES, blank=True)
+    # The part of a message pattern is matched against; header names the
+    # header of header targets.
+    target = models.CharField(max_length=16, choices=TARGET_CHOICES, default=TARGET_MESSAGE)
+    header = models.CharField(max_length=255, blank=True)
+    # Precompiled form of pattern computed by efu_engine.patterns on save:
+    # the normalized regex source (empty for literals), a literal every
+    # match contains, literals one of which every match contains (indexed
+    # by the evaluator to skip the regex), whether the regex needs a
+    # backtracking engine and whether it is safe from catastrophic
+    # backtracking.
+    compiled_pattern = models.TextField(blank=True, editable=False)
+    prefilter = models.CharField(max_length=255, blank=True, editable=False)
+    atoms = models.JSONField(default=list, blank=True, editable=False)
+    needs_backtracking = models.BooleanField(default=False, editable=False)
+    linear_safe = models.BooleanField(default=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    IDENTITY_FIELDS = ('name', 'pattern', 'description', 'target', 'header', 'kind')
+    COMPILED_FIELDS = (
+        'kind', 'compiled_pattern', 'prefilter', 'atoms', 'needs_backtracking',
+        'linear_safe',
+    )
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the rules of a user.
+            models.Index(fields=['user', 'name', 'id'], name='rule_user_name_id_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'identity_hash'],
+                name='rule_user_identity_uniq',
+            ),
+        ]
 
     def __str__(self):
         return self.name #f'{self.name} : {self.value}'
 
+    @staticmethod
+    def make_identity_hash(name, pattern, description='', target=TARGET_MESSAGE, header='',
+                           kind=''):
+        """Return the hash identifying a rule among the rules of a user.
+
+        An empty kind stands for the kind the pattern defaults to.
+        """
+        parts = [name, pattern, description]
+        # Rules reading the whole message keep the hash they had before
+        # rules had targets, rules of the default kind the one they had
+        # before rules had kinds.
+        if target != TARGET_MESSAGE or header:
+            parts.extend((target, header))
+        if kind and kind != default_kind(pattern):
+            parts.append(kind)
+        identity = '\0'.join(parts)
+        return hashlib.sha256(identity.encode()).hexdigest()
+
+    def set_identity_hash(self):
+        """Recompute identity_hash, needed before bulk_create."""
+        self.identity_hash = self.make_identity_hash(
+            self.name, self.pattern, self.description, self.target, self.header,
+            self.kind,
+        )
+
+    def set_compiled_pattern(self):
+        """Validate pattern and store its precompiled form.
+
+        Raises efu_engine.patterns.PatternError for an invalid pattern.
+        """
+        for field, value in analyze_pattern(self.pattern, self.kind).items():
+            setattr(self, field, value)
+
+    def save(self, *args, **kwargs):
+        """Save the rule with up to date derived fields."""
+        self.set_identity_hash()
+        self.set_compiled_pattern()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if update_fields & set(self.IDENTITY_FIELDS):
+                update_fields.add('identity_hash')
+            if update_fields & {'pattern', 'kind'}:
+                update_fields.update(self.COMPILED_FIELDS)
+            update_fields.add('updated_at')
+            kwargs['update_fields'] = update_fields
+        super().save(*args, **kwargs)
+
+class RuleEntry(models.Model):
+    """Entry of the set of a domain, address or IP set rule.
+
+    Values are normalized by efu_engine.sets.normalize_entry. Entries are
+    written in bulk, so writers bump the versions of the rule's rulesets
+    with efu_engine.signals.bump_rule_entries.
+    """
+    # Covered by the unique constraint below.
+    rule = models.ForeignKey(
+        'Rule', on_delete=models.CASCADE, related_name='entries', db_index=False,
+    )
+    value = models.CharField(max_length=255)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['rule', 'value'], name='rule_entry_uniq'),
+        ]
+
+    def __str__(self):
+        return self.value
+
 class RuleSet(models.Model):
     """RuleSet object."""
     user = models.ForeignKey(
@@ -62,7 +213,46 @@ class RuleSet(models.Model):
     )
     name = models.CharField(max_length=255)
     description = models.CharField(max_length=255, blank=True) #models.TextField(blank=True)
-    rules = models.ManyToManyField('Rule')
+    rules = models.ManyToManyField('Rule', through='RuleSetRule')
+    # Bumped by efu_engine.signals whenever the compiled form of the ruleset
+    # changes; it is part of the key of every cached matcher. Saves never
+    # write it.
+    version = models.PositiveIntegerField(default=1, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Keyset pagination of the rulesets of a user.
+            models.Index(fields=['user', 'id'], name='ruleset_user_id_idx'),
+        ]
 
     def __str__(self):
         return self.name
+
+    def save(self, *args, **kwargs):
+        """Save the ruleset, leaving its version to efu_engine.signals."""
+        super().save(*args, **_without_fields(self, kwargs, ('version',)))
+
+
+class RuleSetRule(models.Model):
+    """Membership of a rule in a ruleset."""
+    # Both columns are covered by the composite indexes below.
+    ruleset = models.ForeignKey('RuleSet', on_delete=models.CASCADE, db_index=False)
+    rule = models.ForeignKey('Rule', on_delete=models.CASCADE, db_index=False)
+    # Rules are evaluated by ascending position, then id. The first
+    # matching rule with a terminal action ends the evaluation, see
+    # efu_engine.actions.
+    position = models.PositiveIntegerField(default=0)
+    action = models.CharField(max_length=16, choices=ACTION_CHOICES, default=ACTION_TAG)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['ruleset', 'rule'],
+                name='ruleset_rule_uniq',
+            ),
+        ]
+        indexes = [
+            # Reverse lookups: rulesets of a rule, assigned_only filters.
+            models.Index(fields=['rule', 'ruleset'], name='ruleset_rule_reverse_idx'),
+        ]
@@ -1,13 +1,26 @@
 """
 Test custom Django management commands.
 """
+import json
+import os
+import tempfile
+from io import StringIO
 from unittest.mock import patch
 
 from psycopg2 import OperationalError as Psycopg2OpError
 
+from django.contrib.auth import get_user_model
 from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.db.utils import OperationalError
-from django.test import SimpleTestCase
+from django.test import SimpleTestCase, TestCase
+
+from efu_auth.models import (
+    Rule,
+    RuleSet,
+)
+from efu_engine.artifact import open_artifact
+from efu_engine.cache import ruleset_cache
 
 
 @patch('efu_auth.management.commands.wait_for_db.Command.check')
@@ -32,3 +45,145 @@ class CommandTests(SimpleTestCase):
 
         self.assertEqual(patched_check.call_count, 6)
         patched_check.assert_called_with(databases=['default'])
+
+
+MBOX = b"""From jason@example.com Mon Jan  1 00:00:00 2024
+From: jason@example.com
+Subject: Senior developer
+Message-ID: <1@example.com>
+
+We are hiring.
+>From the team.
+
+From other@example.com Mon Jan  1 00:00:00 2024
+From: other@example.com
+Subject: Lunch
+
+Nothing here.
+"""
+
+
+class FilterMailboxCommandTests(TestCase):
+    """Test the filter_mailbox command."""
+
+    def setUp(self):
+        ruleset_cache.clear()
+        user = get_user_model().objects.create_user('user@example.com', 'pass123')
+        self.ruleset = RuleSet.objects.create(user=user, name='Jobs')
+        self.rule = Rule.objects.create(user=user, name='Senior', pattern='Senior')
+        self.team = Rule.objects.create(user=user, name='Team', pattern='^From the team')
+        self.ruleset.rules.add(self.rule, self.team)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def filter_mailbox(self, path, **options):
+        """Run the command and return its parsed JSONL output."""
+        out = StringIO()
+        call_command(
+            'filter_mailbox', path, ruleset=self.ruleset.id, stdout=out, stderr=StringIO(), **options
+        )
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def test_filter_mbox(self):
+        """Test matching messages of an mbox file are written."""
+        path = os.path.join(self.tmpdir.name, 'inbox.mbox')
+        with open(path, 'wb') as fp:
+            fp.write(MBOX)
+
+        results = self.filter_mailbox(path)
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0]['key'], 0)
+        self.assertEqual(results[0]['message_id'], '<1@example.com>')
+        self.assertEqual(results[0]['rules'], [self.rule.id])
+
+    def test_filter_mbox_with_workers(self):
+        """Test worker processes give the same results."""
+        path = os.path.join(self.tmpdir.name, 'inbox.mbox')
+        with open(path, 'wb') as fp:
+            fp.write(MBOX * 3)
+
+        results = self.filter_mailbox(path, workers=2, chunk_size=1)
+
+        self.assertEqual([r['key'] for r in results], [0, 2, 4])
+        self.assertEqual(results[0]['rules'], [self.rule.id])
+
+    def test_filter_maildir(self):
+        """Test matching messages of a Maildir are written."""
+        for folder in ('new', 'cur', 'tmp'):
+            os.mkdir(os.path.join(self.tmpdir.name, folder))
+        for name, entry in zip(('1', '2'), MBOX.split(b'\n\nFrom ')):
+            with open(os.path.join(self.tmpdir.name, 'new', name), 'wb') as fp:
+                fp.write(entry.split(b'\n', 1)[1])
+
+        results = self.filter_mailbox(self.tmpdir.name)
+
+        self.assertEqual([r['key'] for r in results], [os.path.join('new', '1')])
+
+    def test_unknown_ruleset(self):
+        """Test an unknown ruleset is an error."""
+        with self.assertRaises(CommandError):
+            call_command('filter_mailbox', self.tmpdir.name, ruleset=0)
+
+
+class ExportRuleSetCommandTests(TestCase):
+    """Test the export_ruleset command."""
+
+    def test_export_ruleset(self):
+        """Test the written artifact holds the rules of the ruleset."""
+        user = get_user_model().objects.create_user('user@example.com', 'pass123')
+        ruleset = RuleSet.objects.create(user=user, name='Jobs')
+        rule = Rule.objects.create(user=user, name='Dev', pattern=r'dev(eloper)?\b')
+        ruleset.rules.add(rule)
+        ruleset.refresh_from_db()
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'jobs.efurs')
+            call_command('export_ruleset', ruleset.id, path, stderr=StringIO())
+            with open_artifact(path) as artifact:
+                specs = list(artifact.rule_specs())
+
+        self.assertEqual(artifact.ruleset_version, ruleset.version)
+        self.assertEqual([spec.id for spec in specs], [rule.id])
+        self.assertEqual(specs[0].source, rule.compiled_pattern)
+
+    def test_unknown_ruleset(self):
+        """Test exporting an unknown ruleset fails."""
+        with self.assertRaises(CommandError):
+            call_command('export_ruleset', 0, os.devnull)
+
+
+class RuleTransferCommandTests(TestCase):
+    """Test the import_rules and export_rules commands."""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('user@example.com', 'pass123')
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+
+    def test_export_and_import_rules(self):
+        """Test rules exported to CSV are imported for another user."""
+        Rule.objects.create(user=self.user, name='Dev', pattern=r'dev(eloper)?\b')
+        Rule.objects.create(user=self.user, name='Net', pattern='10.0.0.0/8', kind='ip')
+        copy = get_user_model().objects.create_user('copy@example.com', 'pass123')
+        path = os.path.join(self.tmpdir.name, 'rules.csv')
+
+        call_command('export_rules', 'user@example.com', output=path)
+        call_command('import_rules', 'copy@example.com', path, stderr=StringIO())
+
+        self.assertEqual(
+            sorted(Rule.objects.filter(user=copy).values_list('name', 'pattern', 'kind')),
+            [('Dev', r'dev(eloper)?\b', 'regex'), ('Net', '10.0.0.0/8', 'ip')],
+        )
+
+    def test_invalid_import(self):
+        """Test an invalid file or unknown user is an error."""
+        path = os.path.join(self.tmpdir.name, 'rules.jsonl')
+        with open(path, 'w') as fp:
+            fp.write('{"name": "Lunch", "pattern": "eggs"}\nnot json\n')
+
+        with self.assertRaises(CommandError):
+            call_command('import_rules', 'user@example.com', path)
+        with self.assertRaises(CommandError):
+            call_command('export_rules', 'nobody@example.com')
+        self.assertFalse(Rule.objects.exists())
@@ -1,6 +1,10 @@
 from unittest.mock import patch
 from decimal import Decimal
 
+from io import StringIO
+
+from django.core.management import call_command
+from django.db import IntegrityError
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 
@@ -52,3 +56,67 @@ class ModelTests(TestCase):
 
         self.assertTrue(user.is_superuser)
         self.assertTrue(user.is_staff)
+
+    def test_stale_user_save_keeps_rules_version(self):
+        """Test saving a stale user does not roll its rules version back."""
+        user = create_user()
+        stale = get_user_model().objects.get(pk=user.pk)
+        get_user_model().objects.filter(pk=user.pk).update(rules_version=5)
+
+        stale.name = 'Renamed'
+        stale.save()
+        user.refresh_from_db()
+
+        self.assertEqual(user.name, 'Renamed')
+        self.assertEqual(user.rules_version, 5)
+
+    def test_stale_ruleset_save_keeps_version(self):
+        """Test saving a stale ruleset does not roll its version back."""
+        ruleset = models.RuleSet.objects.create(user=create_user(), name='Jobs')
+        stale = models.RuleSet.objects.get(pk=ruleset.pk)
+        models.RuleSet.objects.filter(pk=ruleset.pk).update(version=5)
+
+        stale.name = 'Positions'
+        stale.save()
+        ruleset.refresh_from_db()
+
+        self.assertEqual(ruleset.name, 'Positions')
+        self.assertEqual(ruleset.version, 5)
+
+    def test_rule_identity_hash(self):
+        """Test the identity hash follows name, pattern and description."""
+        user = create_user()
+        rule = models.Rule.objects.create(user=user, name='Jobs', pattern='senior')
+        first_hash = rule.identity_hash
+
+        rule.description = 'Senior positions'
+        rule.save(update_fields=['description'])
+        rule.refresh_from_db()
+
+        self.assertEqual(len(first_hash), 64)
+        self.assertNotEqual(rule.identity_hash, first_hash)
+        self.assertEqual(
+            rule.identity_hash,
+            models.Rule.make_identity_hash('Jobs', 'senior', 'Senior positions'),
+        )
+
+    def test_rule_identity_hash_kind(self):
+        """Test the identity hash follows a kind other than the default one."""
+        make_hash = models.Rule.make_identity_hash
+
+        self.assertEqual(make_hash('x', 'a.c'), make_hash('x', 'a.c', kind='regex'))
+        self.assertEqual(make_hash('x', 'abc'), make_hash('x', 'abc', kind='literal'))
+        self.assertNotEqual(make_hash('x', 'a.c'), make_hash('x', 'a.c', kind='literal'))
+        self.assertNotEqual(make_hash('x', 'a.c'), make_hash('x', 'a.c', kind='glob'))
+
+    def test_identical_rules_rejected(self):
+        """Test a user cannot store the same rule twice."""
+        user = create_user()
+        models.Rule.objects.create(user=user, name='Jobs', pattern='senior')
+
+        with self.assertRaises(IntegrityError):
+            models.Rule.objects.create(user=user, name='Jobs', pattern='senior')
+
+    def test_migrations_up_to_date(self):
+        """Test the models have no changes missing a migration."""
+        call_command('makemigrations', '--check', '--dry-run', stdout=StringIO())
@@ -0,0 +1,19 @@
+"""
+Actions taken when a rule of a ruleset matches a message.
+"""
+
+# accept and reject decide the fate of the message, stop ends the
+# evaluation without a decision and tag only reports the match. The
+# first matching rule with a terminal action, in priority order, ends
+# the evaluation.
+ACTION_ACCEPT = 'accept'
+ACTION_REJECT = 'reject'
+ACTION_TAG = 'tag'
+ACTION_STOP = 'stop'
+ACTION_CHOICES = [
+    (ACTION_ACCEPT, 'Accept'),
+    (ACTION_REJECT, 'Reject'),
+    (ACTION_TAG, 'Tag'),
+    (ACTION_STOP, 'Stop'),
+]
+TERMINAL_ACTIONS = frozenset((ACTION_ACCEPT, ACTION_REJECT, ACTION_STOP))
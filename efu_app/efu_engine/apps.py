@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class EfuEngineConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'efu_engine'
+
+    def ready(self):
+        """Connect the signal handlers invalidating compiled rulesets."""
+        from efu_engine import signals  # noqa: F401
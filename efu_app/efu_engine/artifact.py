@@ -0,0 +1,201 @@
+"""
+Compact binary artifact of a compiled ruleset.
+
+Filtering agents load the artifact, usually memory mapped, instead of
+fetching rules from the API and analyzing their patterns again. All
+integers are little endian. The layout is:
+
+    header        HEADER
+    string index  (strings + 1) u32 offsets into the string data
+    rules         rules RULE records, sorted by rule id
+    lists         u32 string numbers: the atoms and set entries of every
+                  rule, one run each
+    string data   UTF-8 strings, each stored once
+
+Rule records refer to their source, prefilter, atoms, message field and
+set entries by string number, so a string shared by several rules is
+stored once.
+"""
+import mmap
+import struct
+import zlib
+
+from efu_engine.actions import (
+    ACTION_ACCEPT,
+    ACTION_REJECT,
+    ACTION_STOP,
+    ACTION_TAG,
+)
+from efu_engine.matcher import (
+    RuleSpec,
+    ShardedRuleSet,
+    ruleset_rules,
+)
+from efu_engine.patterns import (
+    KIND_GLOB,
+    KIND_LITERAL,
+    KIND_REGEX,
+)
+from efu_engine.sets import (
+    KIND_ADDRESS,
+    KIND_DOMAIN,
+    KIND_IP,
+)
+
+MAGIC = b'EFURULES'
+FORMAT_VERSION = 5
+CONTENT_TYPE = 'application/vnd.efu.ruleset'
+
+# magic, format version, flags, ruleset id, ruleset version, rules,
+# strings, list items, size of the string data, CRC32 of everything
+# after the header.
+HEADER = struct.Struct('<8sHHQIIIIII')
+# rule id, kind, flags, action, atom count, source, prefilter, first atom,
+# field, position, entry count, first entry.
+RULE = struct.Struct('<QBBBHIIIIIII')
+U32 = struct.Struct('<I')
+
+KIND_CODES = {
+    KIND_LITERAL: 0, KIND_REGEX: 1, KIND_GLOB: 2,
+    KIND_DOMAIN: 3, KIND_ADDRESS: 4, KIND_IP: 5,
+}
+KINDS = {code: kind for kind, code in KIND_CODES.items()}
+ACTION_CODES = {ACTION_TAG: 0, ACTION_ACCEPT: 1, ACTION_REJECT: 2, ACTION_STOP: 3}
+ACTIONS = {code: action for action, code in ACTION_CODES.items()}
+FLAG_NEEDS_BACKTRACKING = 1
+FLAG_NOT_LINEAR_SAFE = 2
+
+
+class ArtifactError(ValueError):
+    """Raised for data that is not a valid ruleset artifact."""
+
+
+def dump_ruleset(rules, ruleset_id=0, ruleset_version=0):
+    """Return the artifact of an iterable of RuleSpec as bytes."""
+    strings = {}
+
+    def intern(value):
+        return strings.setdefault(value, len(strings))
+
+    records = []
+    lists = []
+    for rule in sorted(rules, key=lambda rule: rule.id):
+        flags = FLAG_NEEDS_BACKTRACKING if rule.needs_backtracking else 0
+        if not rule.linear_safe:
+            flags |= FLAG_NOT_LINEAR_SAFE
+        records.append(RULE.pack(
+            rule.id, KIND_CODES[rule.kind], flags, ACTION_CODES[rule.action],
+            len(rule.atoms), intern(rule.source), intern(rule.prefilter),
+            len(lists), intern(rule.field), rule.position,
+            len(rule.entries), len(lists) + len(rule.atoms),
+        ))
+        lists.extend(intern(atom) for atom in rule.atoms)
+        lists.extend(intern(entry) for entry in rule.entries)
+
+    data = [value.encode() for value in strings]
+    offsets = [0]
+    for value in data:
+        offsets.append(offsets[-1] + len(value))
+    body = b''.join([
+        struct.pack('<%dI' % len(offsets), *offsets),
+        b''.join(records),
+        struct.pack('<%dI' % len(lists), *lists),
+        b''.join(data),
+    ])
+    header = HEADER.pack(
+        MAGIC, FORMAT_VERSION, 0, ruleset_id, ruleset_version,
+        len(records), len(data), len(lists), offsets[-1], zlib.crc32(body),
+    )
+    return header + body
+
+
+def dump_stored_ruleset(ruleset):
+    """Return the artifact of a RuleSet instance as bytes."""
+    return dump_ruleset(ruleset_rules(ruleset), ruleset.id, ruleset.version)
+
+
+class RuleSetArtifact:
+    """Read only view of an artifact in a bytes-like buffer or mmap.
+
+    Nothing is decoded up front; rule specs are read from the buffer
+    when iterated.
+    """
+
+    def __init__(self, buffer, verify=True):
+        """Check the header of buffer and locate the sections."""
+        if len(buffer) < HEADER.size:
+            raise ArtifactError('Truncated ruleset artifact.')
+        (
+            magic, version, _, self.ruleset_id, self.ruleset_version,
+            self.rule_count, string_count, list_size, string_size, crc,
+        ) = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ArtifactError('Not a ruleset artifact.')
+        if version != FORMAT_VERSION:
+            raise ArtifactError('Unsupported ruleset artifact version %d.' % version)
+        self._buffer = buffer
+        self._offsets = HEADER.size
+        self._rules = self._offsets + (string_count + 1) * U32.size
+        self._lists = self._rules + self.rule_count * RULE.size
+        self._strings = self._lists + list_size * U32.size
+        if len(buffer) != self._strings + string_size:
+            raise ArtifactError('Truncated ruleset artifact.')
+        if verify and zlib.crc32(memoryview(buffer)[HEADER.size:]) != crc:
+            raise ArtifactError('Corrupt ruleset artifact.')
+
+    def __len__(self):
+        return self.rule_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the underlying memory map, if any."""
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+
+    def _string(self, number):
+        start, end = struct.unpack_from('<2I', self._buffer, self._offsets + number * U32.size)
+        return bytes(self._buffer[self._strings + start:self._strings + end]).decode()
+
+    def _strings_at(self, first, count):
+        """Return the run of count strings of the lists section at first."""
+        numbers = struct.unpack_from(
+            '<%dI' % count, self._buffer, self._lists + first * U32.size,
+        )
+        return tuple(self._string(number) for number in numbers)
+
+    def rule_specs(self):
+        """Yield the RuleSpec of every rule."""
+        for index in range(self.rule_count):
+            (
+                rule_id, kind, flags, action, atom_count, source, prefilter,
+                first_atom, field, position, entry_count, first_entry,
+            ) = RULE.unpack_from(self._buffer, self._rules + index * RULE.size)
+            yield RuleSpec(
+                rule_id,
+                KINDS[kind],
+                self._string(source),
+                self._string(prefilter),
+                self._strings_at(first_atom, atom_count),
+                bool(flags & FLAG_NEEDS_BACKTRACKING),
+                not flags & FLAG_NOT_LINEAR_SAFE,
+                self._string(field),
+                position,
+                ACTIONS[action],
+                self._strings_at(first_entry, entry_count),
+            )
+
+    def compile(self):
+        """Return the ShardedRuleSet of the artifact, one shard per field."""
+        return ShardedRuleSet(self.rule_specs())
+
+
+def open_artifact(path, verify=True):
+    """Memory map an artifact file and return its RuleSetArtifact."""
+    with open(path, 'rb') as fp:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    return RuleSetArtifact(mapped, verify=verify)
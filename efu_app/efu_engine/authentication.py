@@ -0,0 +1,26 @@
+"""
+Authentication classes of the engine API.
+"""
+import copy
+
+from rest_framework.authentication import TokenAuthentication
+
+from efu_engine.cache import token_cache
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """Token authentication answering repeated tokens from a cache.
+
+    A valid token costs one database query per TOKEN_CACHE_TTL seconds
+    instead of one per request. Deleting the token or saving its user
+    invalidates the entry, see efu_engine.signals.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is None:
+            cached = super().authenticate_credentials(key)
+            token_cache.set(key, cached)
+        user, token = cached
+        # Views may modify request.user, which must not leak into the cache.
+        return copy.copy(user), token
@@ -0,0 +1,56 @@
+"""
+Benchmarks of the matching engine and the API.
+
+Every benchmark is a module runnable with python -m that prints its
+results as JSON.
+"""
+import random
+import statistics
+import time
+
+WORDS = (
+    'account action address agent alert amount answer apply approve '
+    'archive balance bank bonus budget build call card case cash check '
+    'claim client close code confirm contact contract credit customer data '
+    'deal delivery deposit design detail developer discount document domain '
+    'draft email event expire fee file form free gift group hello help '
+    'invoice issue item job limit link login lunch manager market meeting '
+    'member message money month notice offer order package password payment '
+    'phone plan policy price prize profile project refund reply report '
+    'request reset review reward sale schedule secure senior service '
+    'session shipping signup status subscribe support team ticket transfer '
+    'trial update upgrade urgent user verify video wallet week winner'
+).split()
+
+
+def synthetic_text(rnd, words=60):
+    """Return a random message text of space separated words."""
+    return ' '.join(rnd.choice(WORDS) for _ in range(words))
+
+
+def best_of(func, repeat=3):
+    """Return the best wall time in seconds of repeat calls of func."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def latency_stats(samples):
+    """Summarize wall times in seconds as milliseconds."""
+    samples = sorted(samples)
+    return {
+        'runs': len(samples),
+        'mean_ms': round(statistics.mean(samples) * 1000, 3),
+        'median_ms': round(statistics.median(samples) * 1000, 3),
+        'p95_ms': round(samples[int(0.95 * (len(samples) - 1))] * 1000, 3),
+        'min_ms': round(samples[0] * 1000, 3),
+    }
+
+
+def seeded_random(seed=0):
+    """Return a random generator so runs are reproducible."""
+    return random.Random(seed)
@@ -0,0 +1,86 @@
+"""
+Run the benchmark suite and write its results as JSON.
+
+    python -m efu_engine.benchmarks --users 10 --rulesets 10 --rules 100 \
+        --output results.json
+
+The database is a throwaway SQLite test database, see settings.py next
+to this file; set DJANGO_SETTINGS_MODULE to benchmark another one.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m efu_engine.benchmarks')
+    parser.add_argument('--users', type=int, default=10, help='Users to seed (N).')
+    parser.add_argument('--rulesets', type=int, default=10, help='Rulesets per user (M).')
+    parser.add_argument('--rules', type=int, default=100, help='Rules per user (K).')
+    parser.add_argument('--rules-per-ruleset', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20, help='Requests per API measurement.')
+    parser.add_argument('--throughput-rules', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--prefilter-rules', type=int, default=1000)
+    parser.add_argument('--prefilter-messages', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='-', help='Result file, - for stdout.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'efu_engine.benchmarks.settings')
+    import django
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import (
+        setup_test_environment,
+        teardown_test_environment,
+    )
+
+    from efu_engine.benchmarks import (
+        api,
+        prefilter,
+        seeded_random,
+        throughput,
+    )
+    from efu_engine.benchmarks.seed import seed
+
+    rnd = seeded_random(args.seed)
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        users = seed(rnd, args.users, args.rulesets, args.rules, args.rules_per_ruleset)
+        results = {
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'parameters': vars(args),
+            'api': api.run(users[0], repeat=args.repeat),
+            'throughput': throughput.run(
+                users[0], rnd, rules=args.throughput_rules, messages=args.messages,
+            ),
+            'prefilter': prefilter.run(
+                args.prefilter_rules, args.prefilter_messages, seed=args.seed,
+            ),
+        }
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+
+    if args.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Latency and query counts of the rule and ruleset API.
+"""
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from efu_auth.models import (
+    Rule,
+    RuleSet,
+)
+from efu_engine.benchmarks import latency_stats
+
+
+def measure(client, method, url, data=None, repeat=20):
+    """Time repeat requests and count the queries of each.
+
+    url and data may be callables of the run index for requests that must
+    differ between runs. Raises AssertionError on an error response.
+    """
+    samples = []
+    queries = set()
+    for index in range(repeat):
+        run_url = url(index) if callable(url) else url
+        run_data = data(index) if callable(data) else data
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            res = getattr(client, method)(run_url, run_data, format='json')
+            samples.append(time.perf_counter() - start)
+        if res.status_code >= 400:
+            raise AssertionError('%s %s returned %d' % (method.upper(), run_url, res.status_code))
+        queries.add(len(captured))
+    result = latency_stats(samples)
+    result['queries'] = max(queries)
+    return result
+
+
+def run(user, repeat=20, new_rules=10):
+    """Return the latency of the API endpoints as seen by user."""
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token %s' % user.auth_token.key)
+    rulesets_url = reverse('efu_engine:ruleset-list')
+    rules_url = reverse('efu_engine:rule-list')
+    ruleset = RuleSet.objects.filter(user=user).order_by('id').first()
+    rule_ids = list(Rule.objects.filter(user=user).values_list('id', flat=True)[:repeat])
+
+    def new_ruleset(index):
+        return {
+            'name': 'bench %d' % index,
+            'rules': [
+                {'name': 'bench %d.%d' % (index, number), 'pattern': 'bench%d-%d' % (index, number)}
+                for number in range(new_rules)
+            ],
+        }
+
+    return {
+        'rulesets': {
+            'list': measure(client, 'get', rulesets_url, repeat=repeat),
+            'retrieve': measure(
+                client, 'get',
+                reverse('efu_engine:ruleset-detail', args=[ruleset.id]),
+                repeat=repeat,
+            ),
+            'create': measure(client, 'post', rulesets_url, new_ruleset, repeat=repeat),
+        },
+        # RuleViewSet has no retrieve or create action; rules are created
+        # through rulesets.
+        'rules': {
+            'list': measure(client, 'get', rules_url, repeat=repeat),
+            'list_assigned_only': measure(
+                client, 'get', rules_url + '?assigned_only=1', repeat=repeat,
+            ),
+            'update': measure(
+                client, 'patch',
+                lambda index: reverse('efu_engine:rule-detail', args=[rule_ids[index % len(rule_ids)]]),
+                lambda index: {'description': 'bench %d' % index},
+                repeat=repeat,
+            ),
+        },
+    }
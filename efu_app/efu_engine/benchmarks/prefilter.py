@@ -0,0 +1,114 @@
+"""
+Benchmark the literal atom prefilter against naive per-rule evaluation.
+
+Run with python -m efu_engine.benchmarks.prefilter [--rules N]
+[--messages N]. Every engine must return the same matches as searching
+each rule on its own; the timings are printed as JSON.
+"""
+import argparse
+import json
+import re
+import string
+import sys
+
+from efu_engine.benchmarks import (
+    best_of,
+    seeded_random,
+    synthetic_text,
+)
+from efu_engine.matcher import (
+    CompiledRuleSet,
+    ahocorasick,
+    make_rule_spec,
+)
+
+# (pattern, example) templates of synthetic rules formatted with two
+# random tokens. Examples are planted into messages so some rules match.
+RULE_TEMPLATES = (
+    (r'\b(?:%s|%s)-\d+\b', '%s-42 %s'),
+    (r'%s\s+\w+\s+%s', '%s word %s'),
+    (r'[A-Z]{2}%s\d*%s', 'QX%s7%s'),
+    (r'%s(?:ing|ed)? %s', '%sing %s'),
+    (r'(?P<tag>%s)\.%s', '%s.%s'),
+    ('%s%s', '%s%s'),
+)
+
+
+def _token(rnd):
+    return ''.join(rnd.choice(string.ascii_lowercase) for _ in range(6))
+
+
+def make_rules(rnd, count):
+    """Return (rule_id, pattern, example) triples of synthetic rules."""
+    rules = []
+    for rule_id in range(1, count + 1):
+        pattern, example = RULE_TEMPLATES[rule_id % len(RULE_TEMPLATES)]
+        tokens = (_token(rnd), _token(rnd))
+        rules.append((rule_id, pattern % tokens, example % tokens))
+    return rules
+
+
+def make_messages(rnd, rules, count, hit_rate):
+    """Return message texts, hit_rate of them containing a rule example."""
+    messages = []
+    for _ in range(count):
+        text = synthetic_text(rnd)
+        if rnd.random() < hit_rate:
+            text += ' ' + rnd.choice(rules)[2]
+        messages.append(text)
+    return messages
+
+
+def naive_match(rules, text):
+    """Search every rule on its own, the reference result."""
+    return [rule_id for rule_id, regex in rules if regex.search(text)]
+
+
+def run(rule_count=1000, message_count=300, hit_rate=0.2, seed=0):
+    """Run the benchmark and return its results as a dict."""
+    rnd = seeded_random(seed)
+    rules = make_rules(rnd, rule_count)
+    messages = make_messages(rnd, rules, message_count, hit_rate)
+    specs = [make_rule_spec(rule_id, pattern) for rule_id, pattern, _ in rules]
+    naive = [(spec.id, re.compile(spec.source)) for spec in specs]
+    engines = {
+        'naive': lambda text: naive_match(naive, text),
+        'alternation': CompiledRuleSet(specs, use_atoms=False).match,
+        'atoms': CompiledRuleSet(specs).match,
+    }
+    expected = [naive_match(naive, text) for text in messages]
+    results = {
+        'rules': rule_count,
+        'messages': message_count,
+        'hit_rate': hit_rate,
+        'native_automaton': ahocorasick is not None,
+        'engines': {},
+    }
+    for name, match in engines.items():
+        if [match(text) for text in messages] != expected:
+            raise AssertionError('%s engine disagrees with naive evaluation' % name)
+        seconds = best_of(lambda: [match(text) for text in messages])
+        results['engines'][name] = {
+            'seconds': round(seconds, 6),
+            'messages_per_second': round(message_count / seconds, 1),
+        }
+    naive_seconds = results['engines']['naive']['seconds']
+    for engine in results['engines'].values():
+        engine['speedup'] = round(naive_seconds / engine['seconds'], 2)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rules', type=int, default=1000)
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--hit-rate', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    results = run(args.rules, args.messages, args.hit_rate, args.seed)
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
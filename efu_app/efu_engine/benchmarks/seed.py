@@ -0,0 +1,89 @@
+"""
+Seed the database with synthetic users, rulesets and rules.
+"""
+from django.contrib.auth import get_user_model
+from rest_framework.authtoken.models import Token
+
+from efu_auth.models import (
+    Rule,
+    RuleSet,
+    RuleSetRule,
+)
+from efu_engine.benchmarks.prefilter import make_rules
+
+BATCH_SIZE = 1000
+
+
+def _rule(user, name, pattern):
+    """Return an unsaved rule with its derived fields set for bulk_create."""
+    rule = Rule(user=user, name=name, pattern=pattern)
+    rule.set_identity_hash()
+    rule.set_compiled_pattern()
+    return rule
+
+
+def seed(rnd, users=10, rulesets=10, rules=100, rules_per_ruleset=20):
+    """Create users, each owning rulesets and rules, and return the users.
+
+    Every user gets a token. Each ruleset holds rules_per_ruleset rules
+    drawn from the rules of its user.
+    """
+    user_model = get_user_model()
+    created = []
+    for index in range(users):
+        user = user_model(email='bench%d@example.com' % index)
+        user.set_unusable_password()
+        created.append(user)
+    user_model.objects.bulk_create(created, batch_size=BATCH_SIZE)
+    created = list(user_model.objects.filter(email__startswith='bench').order_by('id'))
+    Token.objects.bulk_create(
+        [Token(user=user, key=Token.generate_key()) for user in created],
+        batch_size=BATCH_SIZE,
+    )
+
+    Rule.objects.bulk_create(
+        [
+            _rule(user, 'rule %d' % rule_id, pattern)
+            for user in created
+            for rule_id, pattern, _ in make_rules(rnd, rules)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    RuleSet.objects.bulk_create(
+        [
+            RuleSet(user=user, name='ruleset %d' % index)
+            for user in created
+            for index in range(rulesets)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+
+    rule_ids = {}
+    for rule_id, user_id in Rule.objects.values_list('id', 'user_id'):
+        rule_ids.setdefault(user_id, []).append(rule_id)
+    links = []
+    for ruleset_id, user_id in RuleSet.objects.values_list('id', 'user_id'):
+        choices = rule_ids.get(user_id, [])
+        for rule_id in rnd.sample(choices, min(rules_per_ruleset, len(choices))):
+            links.append(RuleSetRule(ruleset_id=ruleset_id, rule_id=rule_id))
+    RuleSetRule.objects.bulk_create(links, batch_size=BATCH_SIZE)
+    return created
+
+
+def seed_ruleset(user, name, rules):
+    """Create a ruleset of user holding (rule_id, pattern, example) rules."""
+    ruleset = RuleSet.objects.create(user=user, name=name)
+    Rule.objects.bulk_create(
+        [_rule(user, '%s %d' % (name, rule_id), pattern) for rule_id, pattern, _ in rules],
+        batch_size=BATCH_SIZE,
+    )
+    RuleSetRule.objects.bulk_create(
+        [
+            RuleSetRule(ruleset=ruleset, rule_id=rule_id)
+            for rule_id in Rule.objects.filter(
+                user=user, name__startswith='%s ' % name,
+            ).values_list('id', flat=True)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    return ruleset
@@ -0,0 +1,12 @@
+"""
+Settings of the benchmark suite: the project settings on SQLite, so no
+PostgreSQL service is needed.
+"""
+from efu_app.settings import *  # noqa: F401,F403
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
+}
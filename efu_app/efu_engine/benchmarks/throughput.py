@@ -0,0 +1,77 @@
+"""
+Rule evaluation throughput in messages per second.
+"""
+import json
+import time
+
+from django.urls import reverse
+from rest_framework.test import APIClient
+
+from efu_engine.benchmarks import best_of
+from efu_engine.benchmarks.prefilter import (
+    make_messages,
+    make_rules,
+)
+from efu_engine.benchmarks.seed import seed_ruleset
+from efu_engine.cache import ruleset_cache
+from efu_engine.matcher import compile_ruleset
+from efu_engine.message import SubmittedMessage
+
+
+def _rate(count, seconds):
+    return {
+        'seconds': round(seconds, 6),
+        'messages_per_second': round(count / seconds, 1),
+    }
+
+
+def run(user, rnd, rules=1000, messages=2000, hit_rate=0.2, batch=500):
+    """Return the throughput of the engine and the evaluate endpoint.
+
+    A ruleset of synthetic rules is created for user and evaluated against
+    a corpus of synthetic messages, some containing a rule example.
+    """
+    rule_triples = make_rules(rnd, rules)
+    ruleset = seed_ruleset(user, 'throughput', rule_triples)
+    corpus = [
+        {'subject': 'benchmark', 'body': text}
+        for text in make_messages(rnd, rule_triples, messages, hit_rate)
+    ]
+
+    start = time.perf_counter()
+    compiled = compile_ruleset(ruleset)
+    compile_seconds = time.perf_counter() - start
+    engine = _rate(messages, best_of(
+        lambda: [compiled.match(SubmittedMessage(data)) for data in corpus]
+    ))
+
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION='Token %s' % user.auth_token.key)
+    url = reverse('efu_engine:ruleset-evaluate', args=[ruleset.id])
+    batches = [corpus[index:index + batch] for index in range(0, messages, batch)]
+    ndjson = ['\n'.join(json.dumps(data) for data in chunk) for chunk in batches]
+    ruleset_cache.clear()
+    # The first request compiles the ruleset into the cache.
+    client.post(url, batches[0][:1], format='json')
+
+    def post_json():
+        for chunk in batches:
+            res = client.post(url, chunk, format='json')
+            assert res.status_code == 200, res.status_code
+
+    def post_ndjson():
+        for body in ndjson:
+            res = client.post(url, body, content_type='application/x-ndjson')
+            assert res.status_code == 200, res.status_code
+            b''.join(res.streaming_content)
+
+    return {
+        'rules': rules,
+        'messages': messages,
+        'hit_rate': hit_rate,
+        'batch': batch,
+        'compile_seconds': round(compile_seconds, 6),
+        'engine': engine,
+        'evaluate_json': _rate(messages, best_of(post_json)),
+        'evaluate_ndjson': _rate(messages, best_of(post_ndjson)),
+    }
@@ -0,0 +1,291 @@
+"""
+Process wide caches of compiled rulesets, evaluation results and
+authenticated tokens.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+from efu_engine.conf import engine_setting
+from efu_engine.matcher import compile_ruleset
+from efu_engine.message import fingerprint
+
+
+class CompiledRuleSetCache:
+    """LRU cache of compiled rulesets keyed by (ruleset id, version).
+
+    The size is bounded both by the number of entries and by the number of
+    rules summed over the entries, which is what dominates memory. Every
+    entry of a set rule counts as a rule.
+    """
+
+    def __init__(self, max_entries=None, max_rules=None):
+        self.max_entries = max_entries or engine_setting('RULESET_CACHE_SIZE')
+        self.max_rules = max_rules or engine_setting('RULESET_CACHE_MAX_RULES')
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._rules = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compiled_shards = 0
+
+    def get(self, ruleset):
+        """Return the compiled form of a RuleSet instance.
+
+        A cached older version of the ruleset lends its unchanged shards
+        to the new one.
+        """
+        key = (ruleset.id, ruleset.version)
+        with self._lock:
+            compiled = self._entries.get(key)
+            if compiled is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return compiled
+            self.misses += 1
+            previous = next(
+                (self._entries[k] for k in reversed(self._entries) if k[0] == key[0]),
+                None,
+            )
+        # Compile outside the lock so other rulesets are still served.
+        compiled = compile_ruleset(ruleset, previous)
+        with self._lock:
+            self.compiled_shards += compiled.compiled_shards
+            self._store(key, compiled)
+        return compiled
+
+    def _store(self, key, compiled):
+        """Insert an entry, dropping stale versions and LRU entries."""
+        if key in self._entries:
+            return
+        for old_key in [k for k in self._entries if k[0] == key[0]]:
+            self._discard(old_key)
+        self._entries[key] = compiled
+        self._rules += self._weight(compiled)
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries
+            or self._rules > self.max_rules
+        ):
+            self._discard(next(iter(self._entries)))
+            self.evictions += 1
+
+    @staticmethod
+    def _weight(compiled):
+        return len(compiled) + compiled.entry_count
+
+    def _discard(self, key):
+        self._rules -= self._weight(self._entries.pop(key))
+
+    def invalidate(self, ruleset_id):
+        """Drop every cached version of a ruleset."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == ruleset_id]:
+                self._discard(key)
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._rules = 0
+            self.hits = self.misses = self.evictions = self.compiled_shards = 0
+
+    def stats(self):
+        """Return the cache counters."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'compiled_shards': self.compiled_shards,
+                'entries': len(self._entries),
+                'rules': self._rules,
+            }
+
+
+class ResultCache:
+    """LRU cache of evaluation results keyed by message fingerprint.
+
+    Keys are the serial of the compiled ruleset and a digest of the
+    message fields its rules read, so a repeated message, or any message
+    agreeing on those fields, is answered without matching. A new
+    version of a ruleset compiles to a new serial and its old results
+    age out. The size is bounded by the number of entries and by their
+    approximate size in bytes.
+    """
+    # Rough size of an entry besides its rule ids: key, digest, result
+    # and LRU links.
+    ENTRY_OVERHEAD = 250
+    RULE_ID_SIZE = 8
+
+    def __init__(self, max_entries=None, max_bytes=None):
+        if max_entries is None:
+            max_entries = engine_setting('RESULT_CACHE_SIZE')
+        if max_bytes is None:
+            max_bytes = engine_setting('RESULT_CACHE_MAX_BYTES')
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _size(self, result):
+        return self.ENTRY_OVERHEAD + self.RULE_ID_SIZE * len(result[0])
+
+    def evaluate(self, compiled, message):
+        """Return compiled.evaluate(message), from the cache if possible."""
+        if not self.max_entries or not compiled.cacheable:
+            return compiled.evaluate(message)
+        key = (compiled.serial, fingerprint(message, compiled.read_fields))
+        with self._lock:
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return list(result[0]), result[1]
+            self.misses += 1
+        rules, action = compiled.evaluate(message)
+        with self._lock:
+            self._store(key, (tuple(rules), action))
+        return rules, action
+
+    def _store(self, key, result):
+        """Insert an entry and drop LRU entries over the bounds."""
+        if key in self._entries:
+            return
+        self._entries[key] = result
+        self._bytes += self._size(result)
+        while self._entries and (
+            len(self._entries) > self.max_entries or self._bytes > self.max_bytes
+        ):
+            self._bytes -= self._size(self._entries.popitem(last=False)[1])
+            self.evictions += 1
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Return the cache counters."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+
+class TokenCache:
+    """TTL and LRU bounded cache of authenticated (user, token) pairs.
+
+    Entries are keyed by token key and kept for ttl seconds, in process
+    or, with a Django cache alias, in that cache shared with the other
+    processes. Only the shared cache is read then: invalidation cannot
+    reach the local caches of other processes, which would accept a
+    deleted token or deactivated user until their entry expired.
+    """
+    PREFIX = 'efu:token:'
+
+    def __init__(self, max_entries=None, ttl=None, alias=None):
+        if max_entries is None:
+            max_entries = engine_setting('TOKEN_CACHE_SIZE')
+        self.max_entries = max_entries
+        self.ttl = ttl if ttl is not None else engine_setting('TOKEN_CACHE_TTL')
+        self.alias = alias if alias is not None else engine_setting('TOKEN_CACHE_ALIAS')
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def _shared(self):
+        return caches[self.alias] if self.alias else None
+
+    def get(self, key):
+        """Return the cached (user, token) pair of a token key or None."""
+        shared = self._shared
+        if shared is not None:
+            value = shared.get(self.PREFIX + key)
+            with self._lock:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return value
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        """Cache the (user, token) pair of a token key."""
+        shared = self._shared
+        if shared is not None:
+            shared.set(self.PREFIX + key, value, self.ttl)
+            return
+        with self._lock:
+            self._store(key, value, time.monotonic())
+
+    def _store(self, key, value, now):
+        """Insert a local entry, evicting the least recently used ones."""
+        if not self.max_entries:
+            return
+        self._entries[key] = (now + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        """Drop the entries of token keys."""
+        shared = self._shared
+        if shared is not None:
+            if keys:
+                shared.delete_many([self.PREFIX + key for key in keys])
+            return
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        """Drop every local entry and reset the counters."""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """Return the cache counters."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self._entries),
+            }
+
+
+ruleset_cache = CompiledRuleSetCache()
+result_cache = ResultCache()
+token_cache = TokenCache()
+
+
+def get_compiled_ruleset(ruleset):
+    """Return the cached compiled form of a RuleSet instance."""
+    return ruleset_cache.get(ruleset)
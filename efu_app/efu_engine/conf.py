@@ -0,0 +1,61 @@
+"""
+Settings for the filtering engine.
+
+Every value can be overridden through the EFU_ENGINE dict in settings.
+"""
+import os
+
+from django.conf import settings
+
+
+DEFAULTS = {
+    # Maximum number of compiled rulesets kept per process.
+    'RULESET_CACHE_SIZE': 256,
+    # Maximum number of rules summed over all cached rulesets.
+    'RULESET_CACHE_MAX_RULES': 200000,
+    # Rules per independently compiled shard of a ruleset. Changing a
+    # rule only recompiles its shard.
+    'RULESET_SHARD_SIZE': 1000,
+    # Authenticated tokens kept per process and for how many seconds.
+    'TOKEN_CACHE_SIZE': 10000,
+    'TOKEN_CACHE_TTL': 60,
+    # Alias of a Django cache sharing authenticated tokens between
+    # processes instead of the process local cache, or None.
+    'TOKEN_CACHE_ALIAS': None,
+    # Evaluation results cached by message fingerprint, bounded by entries
+    # and by their approximate size in bytes. A size of 0 disables it.
+    'RESULT_CACHE_SIZE': 100000,
+    'RESULT_CACHE_MAX_BYTES': 64 * 1024 * 1024,
+    # Time budgets of regexes that may backtrack exponentially and cannot
+    # run on re2: per rule and message, and over all such rules of one
+    # message. They are searched in this many worker processes.
+    'MATCH_RULE_TIMEOUT_MS': 50,
+    'MATCH_MESSAGE_TIMEOUT_MS': 200,
+    'ISOLATION_WORKERS': 2,
+    # Maximum number of messages in a JSON array sent to evaluate/.
+    'EVALUATE_MAX_BATCH': 10000,
+    # Number of NDJSON result lines written per chunk of a streamed response.
+    'EVALUATE_STREAM_CHUNK': 100,
+    # Threads matching messages for the async evaluate view, per process.
+    'ASYNC_EVALUATE_WORKERS': os.cpu_count() or 1,
+    # Request profiling, see efu_engine.middleware.ProfilingMiddleware.
+    'PROFILING': False,
+    # Directory cProfile stats of slow requests are written to, if any.
+    'PROFILING_DIR': None,
+    # Fraction of requests run under cProfile when PROFILING_DIR is set.
+    'PROFILING_SAMPLE_RATE': 0.1,
+    # Sampled requests taking at least this long are dumped.
+    'PROFILING_SLOW_MS': 500,
+    # Rules inserted per bulk_create of an import, and read per query and
+    # written per chunk of an export.
+    'IMPORT_BATCH_SIZE': 1000,
+    'EXPORT_CHUNK_SIZE': 1000,
+    # Default and maximum page size of the rule and ruleset lists.
+    'PAGE_SIZE': 100,
+    'MAX_PAGE_SIZE': 1000,
+}
+
+
+def engine_setting(name):
+    """Return an engine setting, falling back to its default."""
+    return getattr(settings, 'EFU_ENGINE', {}).get(name, DEFAULTS[name])
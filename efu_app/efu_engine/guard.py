@@ -0,0 +1,184 @@
+"""
+Protection of the evaluator against slow rules.
+
+Regexes that may backtrack catastrophically and cannot run on a linear time
+engine are searched in worker processes, which are killed when a search
+outlives its time budget. The cost of every regex search is recorded per
+rule so slow rules can be found through the API.
+"""
+import multiprocessing
+import re
+import threading
+
+from efu_engine.conf import engine_setting
+
+
+def _search_worker(conn):
+    """Answer (source, text) requests with whether source matches text."""
+    while True:
+        try:
+            source, text = conn.recv()
+        except EOFError:
+            return
+        conn.send(re.search(source, text) is not None)
+
+
+class _Worker:
+    """A worker process and the parent end of its pipe."""
+
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=_search_worker, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+
+    def kill(self):
+        """Stop the worker, whatever it is doing."""
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+class IsolatedSearch:
+    """Pool of worker processes searching regexes under a time budget.
+
+    Workers are started on first use and at most size of them run at a
+    time; callers beyond that wait for an idle one. A worker whose
+    search times out is killed and replaced on the next search.
+    """
+
+    def __init__(self, size=None):
+        self._size = size
+        self._idle = []
+        self._started = 0
+        self._condition = threading.Condition()
+        self._context = multiprocessing.get_context()
+        self.searches = 0
+        self.timeouts = 0
+
+    def _acquire(self):
+        """Return an idle worker, starting one if the pool is not full."""
+        size = self._size or engine_setting('ISOLATION_WORKERS')
+        with self._condition:
+            while not self._idle and self._started >= size:
+                self._condition.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._started += 1
+        try:
+            return _Worker(self._context)
+        except Exception:
+            self._discard()
+            raise
+
+    def _release(self, worker):
+        with self._condition:
+            self._idle.append(worker)
+            self._condition.notify()
+
+    def _discard(self):
+        with self._condition:
+            self._started -= 1
+            self._condition.notify()
+
+    def search(self, source, text, timeout):
+        """Return whether source matches text, or None after timeout seconds."""
+        worker = self._acquire()
+        try:
+            worker.conn.send((source, text))
+            if worker.conn.poll(max(timeout, 0)):
+                result = worker.conn.recv()
+                self._release(worker)
+                worker = None
+                self.searches += 1
+                return result
+        except (EOFError, OSError):
+            pass
+        finally:
+            if worker is not None:
+                worker.kill()
+                self._discard()
+        self.timeouts += 1
+        return None
+
+    def close(self):
+        """Stop every idle worker."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._started -= len(idle)
+        for worker in idle:
+            worker.kill()
+
+    def stats(self):
+        """Return the pool counters."""
+        return {
+            'workers': self._started,
+            'searches': self.searches,
+            'timeouts': self.timeouts,
+        }
+
+
+isolated_search = IsolatedSearch()
+
+
+class RuleCosts:
+    """Per process counters of the time spent searching each rule.
+
+    Evaluations add (rule_id, seconds, timed_out) entries once per message,
+    so the lock is taken once per message and not once per rule.
+    """
+
+    def __init__(self):
+        self._costs = {}
+        self._lock = threading.Lock()
+
+    def record(self, entries):
+        """Add a list of (rule_id, seconds, timed_out) entries."""
+        with self._lock:
+            costs = self._costs
+            for rule_id, seconds, timed_out in entries:
+                cost = costs.get(rule_id)
+                if cost is None:
+                    cost = costs[rule_id] = [0, 0.0, 0.0, 0]
+                cost[0] += 1
+                cost[1] += seconds
+                if seconds > cost[2]:
+                    cost[2] = seconds
+                if timed_out:
+                    cost[3] += 1
+
+    def get(self, rule_id):
+        """Return the counters of a rule, or None if it was never searched."""
+        with self._lock:
+            cost = self._costs.get(rule_id)
+            return None if cost is None else self._as_dict(cost)
+
+    def slowest(self, rule_ids, limit):
+        """Return (rule_id, counters) of the costliest of rule_ids.
+
+        Rules are ranked by total search time, most expensive first.
+        """
+        with self._lock:
+            costs = [
+                (rule_id, list(self._costs[rule_id]))
+                for rule_id in rule_ids if rule_id in self._costs
+            ]
+        costs.sort(key=lambda item: item[1][1], reverse=True)
+        return [(rule_id, self._as_dict(cost)) for rule_id, cost in costs[:limit]]
+
+    @staticmethod
+    def _as_dict(cost):
+        searches, seconds, max_seconds, timeouts = cost
+        return {
+            'searches': searches,
+            'total_ms': round(seconds * 1000, 3),
+            'max_ms': round(max_seconds * 1000, 3),
+            'timeouts': timeouts,
+        }
+
+    def clear(self):
+        with self._lock:
+            self._costs.clear()
+
+
+rule_costs = RuleCosts()
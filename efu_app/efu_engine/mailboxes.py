@@ -0,0 +1,87 @@
+"""
+Streaming readers for mbox files and Maildir directories.
+
+Every reader is a generator yielding one (key, raw bytes) pair per message,
+so memory use does not depend on the size of the mailbox.
+"""
+import mmap
+import os
+import re
+
+from efu_engine.cache import result_cache
+from efu_engine.message import RawMessage
+
+MBOX_SEPARATOR = b'\nFrom '
+# mboxrd escapes body lines starting with 'From ' with one more '>'.
+MBOX_QUOTED_FROM_RE = re.compile(rb'(?m)^>(>*From )')
+
+
+def _mbox_message(data):
+    """Strip the envelope line of an mbox entry and unquote its body."""
+    start = data.find(b'\n') + 1
+    return MBOX_QUOTED_FROM_RE.sub(rb'\1', data[start:])
+
+
+def iter_mbox(path):
+    """Yield (index, raw message) pairs from an mbox file.
+
+    The file is memory mapped and split on 'From ' lines, so only the
+    current message is ever copied into memory.
+    """
+    with open(path, 'rb') as fp:
+        if os.fstat(fp.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:5] == b'From ':
+                start = 0
+            else:
+                start = mapped.find(MBOX_SEPARATOR)
+                if start == -1:
+                    return
+                start += 1
+            index = 0
+            while start < len(mapped):
+                end = mapped.find(MBOX_SEPARATOR, start)
+                end = len(mapped) if end == -1 else end + 1
+                yield index, _mbox_message(mapped[start:end])
+                index += 1
+                start = end
+
+
+def iter_maildir(path):
+    """Yield (file name, raw message) pairs from a Maildir directory."""
+    for folder in ('new', 'cur'):
+        directory = os.path.join(path, folder)
+        if not os.path.isdir(directory):
+            continue
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                with open(entry.path, 'rb') as fp:
+                    yield os.path.join(folder, entry.name), fp.read()
+
+
+def iter_mailbox(path, mailbox_format='auto'):
+    """Yield (key, raw message) pairs from an mbox file or Maildir."""
+    if mailbox_format == 'auto':
+        mailbox_format = 'maildir' if os.path.isdir(path) else 'mbox'
+    if mailbox_format == 'maildir':
+        return iter_maildir(path)
+    return iter_mbox(path)
+
+
+def evaluate_email(compiled, raw):
+    """Return the identity and matching rules of a raw email.
+
+    Only the parts of the email the rules read are parsed, and an email
+    agreeing with an earlier one on those parts reuses its result.
+    """
+    msg = RawMessage(raw)
+    rules, action = result_cache.evaluate(compiled, msg)
+    return {
+        'message_id': msg.header('Message-ID'),
+        'subject': msg.header('Subject'),
+        'rules': rules,
+        'action': action,
+    }
@@ -0,0 +1,583 @@
+"""
+Compiled matching engine for rulesets.
+"""
+import itertools
+import re
+import sys
+import threading
+import time
+import weakref
+from collections import namedtuple
+
+try:
+    import ahocorasick
+except ImportError:  # optional C implementation of the automaton
+    ahocorasick = None
+
+try:
+    import re2
+except ImportError:  # optional linear time engine for risky regexes
+    re2 = None
+
+from efu_engine.actions import (
+    ACTION_TAG,
+    TERMINAL_ACTIONS,
+)
+from efu_engine.conf import engine_setting
+from efu_engine.guard import (
+    isolated_search,
+    rule_costs,
+)
+from efu_engine.message import (
+    TARGET_MESSAGE,
+    target_field,
+)
+from efu_engine.patterns import (
+    KIND_LITERAL,
+    analyze_pattern,
+    re2_source,
+)
+from efu_engine.sets import (
+    SET_KINDS,
+    SetIndex,
+)
+
+# Precompiled form of a rule as stored on Rule by efu_engine.patterns.
+# source is the pattern of literal rules and the compiled_pattern of the
+# others; field is the message field the rule reads, see
+# efu_engine.message.target_field. position and action come from the
+# membership of the rule in its ruleset. entries are the stored entries
+# of set rules, whose source is their first entry.
+RuleSpec = namedtuple(
+    'RuleSpec',
+    'id kind source prefilter atoms needs_backtracking linear_safe field'
+    ' position action entries',
+    defaults=(0, ACTION_TAG, ()),
+)
+
+# Fields of RuleSetRule read by ruleset_rules, in rule_spec order.
+RULE_SPEC_FIELDS = (
+    'rule_id', 'rule__kind', 'rule__pattern', 'rule__compiled_pattern',
+    'rule__prefilter', 'rule__atoms', 'rule__needs_backtracking',
+    'rule__linear_safe', 'rule__target', 'rule__header', 'position', 'action',
+)
+
+
+def rule_spec(rule_id, kind, pattern, compiled_pattern, prefilter, atoms,
+              needs_backtracking, linear_safe, target=TARGET_MESSAGE, header='',
+              position=0, action=ACTION_TAG, entries=()):
+    """Return the RuleSpec of stored rule fields.
+
+    Its strings are interned, so rules of different users with the same
+    pattern share them.
+    """
+    source = pattern if kind == KIND_LITERAL else compiled_pattern
+    return RuleSpec(
+        rule_id,
+        kind,
+        sys.intern(source),
+        sys.intern(prefilter),
+        tuple(sys.intern(atom) for atom in atoms),
+        needs_backtracking,
+        linear_safe,
+        sys.intern(target_field(target, header)),
+        position,
+        action,
+        tuple(sys.intern(entry) for entry in entries),
+    )
+
+
+def make_rule_spec(rule_id, pattern, kind='', target=TARGET_MESSAGE, header='',
+                   position=0, action=ACTION_TAG, entries=()):
+    """Analyze a pattern that was not stored and return its RuleSpec.
+
+    entries of set rules must already be normalized.
+    """
+    analyzed = analyze_pattern(pattern, kind)
+    return rule_spec(
+        rule_id, pattern=pattern, target=target, header=header,
+        position=position, action=action, entries=entries, **analyzed
+    )
+
+
+class PatternPool:
+    """Process wide pool of compiled regexes keyed by their source.
+
+    Every ruleset using the same pattern, whichever user owns it, shares
+    one compiled regex. Entries are weak and go away with the last
+    compiled ruleset using them.
+    """
+
+    def __init__(self):
+        self._patterns = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def compile(self, source):
+        """Return the shared compiled regex of source."""
+        with self._lock:
+            compiled = self._patterns.get(source)
+            if compiled is not None:
+                self.hits += 1
+                return compiled
+        # Compile outside the lock; a concurrent compile of the same source
+        # is resolved by setdefault.
+        compiled = re.compile(source)
+        with self._lock:
+            self.misses += 1
+            return self._patterns.setdefault(source, compiled)
+
+    def stats(self):
+        """Return the pool counters."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'patterns': len(self._patterns),
+            }
+
+
+pattern_pool = PatternPool()
+
+# Serial numbers telling compiled rulesets apart for the lifetime of the
+# process, unlike id() which is reused.
+_serials = itertools.count(1)
+
+
+class AhoCorasick:
+    """Aho-Corasick automaton reporting every keyword found in a text.
+
+    Uses the pyahocorasick C extension when it is installed and a pure
+    Python automaton otherwise.
+    """
+
+    def __init__(self, keywords, native=None):
+        """Build the automaton from a mapping of keyword to values."""
+        if native is None:
+            native = ahocorasick is not None
+        self.native = native
+        # The empty keyword occurs in every text.
+        self._empty = tuple(keywords.get('', ()))
+        keywords = {keyword: values for keyword, values in keywords.items() if keyword}
+        if native:
+            self._build_native(keywords)
+        else:
+            self._build(keywords)
+
+    def _build_native(self, keywords):
+        """Build a pyahocorasick automaton."""
+        self._automaton = None
+        if keywords:
+            self._automaton = ahocorasick.Automaton()
+            for keyword, values in keywords.items():
+                self._automaton.add_word(keyword, tuple(values))
+            self._automaton.make_automaton()
+
+    def _build(self, keywords):
+        """Build the pure Python automaton."""
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for keyword, values in keywords.items():
+            state = 0
+            for char in keyword:
+                nxt = self._goto[state].get(char)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][char] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = nxt
+            self._out[state] += tuple(values)
+        self._link()
+        first = ''.join(sorted(self._goto[0]))
+        # Jump straight to the next character that can start a keyword
+        # instead of stepping through the root state one char at a time.
+        self._start = re.compile('[%s]' % re.escape(first)) if first else None
+
+    def _link(self):
+        """Compute failure links breadth first and merge their outputs."""
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, nxt in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                self._fail[nxt] = fail
+                self._out[nxt] += self._out[fail]
+                queue.append(nxt)
+
+    def search(self, text):
+        """Return the set of values whose keyword occurs in text."""
+        found = set(self._empty)
+        if self.native:
+            if self._automaton is not None:
+                for _, values in self._automaton.iter(text):
+                    found.update(values)
+            return found
+        if self._start is None:
+            return found
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        pos = 0
+        end = len(text)
+        while pos < end:
+            if not state:
+                match = self._start.search(text, pos)
+                if match is None:
+                    break
+                pos = match.start()
+            char = text[pos]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+            pos += 1
+        return found
+
+
+class _RegexTree:
+    """Binary tree of alternations used to find every rule matching a text
+    without searching the rules one by one.
+
+    A subtree is searched further only while its alternation matches and
+    some of its rules are not found yet, so each node is searched at most
+    once per text.
+    """
+
+    def __init__(self, entries):
+        """Build the tree from (rule_id, compiled regex) pairs."""
+        self.rule_ids = frozenset(rule_id for rule_id, _ in entries)
+        if len(entries) == 1:
+            self.rule_id, self.regex = entries[0]
+            self.left = self.right = None
+            return
+        self.rule_id = None
+        self.regex = pattern_pool.compile(
+            '|'.join('(?:%s)' % compiled.pattern for _, compiled in entries)
+        )
+        middle = len(entries) // 2
+        self.left = _RegexTree(entries[:middle])
+        self.right = _RegexTree(entries[middle:])
+
+    def search(self, text, found):
+        """Add the ids of the rules matching anywhere in text to found."""
+        if self.rule_ids <= found or self.regex.search(text) is None:
+            return
+        if self.rule_id is not None:
+            found.add(self.rule_id)
+            return
+        self.left.search(text, found)
+        self.right.search(text, found)
+
+
+class _Re2Regex:
+    """A re2 regex searched like a compiled re regex."""
+    # re2 needs texts it can encode as UTF-8. Translated regexes never
+    # name a surrogate and treat them like U+FFFD, so they are replaced.
+    SURROGATES_RE = re.compile('[\ud800-\udfff]')
+
+    def __init__(self, regex):
+        self._regex = regex
+
+    def search(self, text):
+        try:
+            return self._regex.search(text)
+        except UnicodeEncodeError:
+            return self._regex.search(self.SURROGATES_RE.sub('\ufffd', text))
+
+
+class CompiledRuleSet:
+    """Every rule of a ruleset compiled into one combined matcher.
+
+    Literal patterns and the literal atoms of regex patterns go into one
+    Aho-Corasick automaton, so a text is scanned once for all of them. A
+    regex with atoms is only searched when one of its atoms was found.
+    Regexes without atoms go into a single alternation. Patterns needing
+    backtracking features or defining named groups cannot be merged and
+    are searched one by one, skipped when their literal prefilter is
+    absent from the text.
+
+    Regexes efu_engine.patterns flags as risky never join the alternation.
+    They run on the re2 engine when it is installed and can match them
+    like re, see efu_engine.patterns.re2_source, and otherwise in
+    efu_engine.guard.isolated_search under the MATCH_RULE_TIMEOUT_MS
+    and MATCH_MESSAGE_TIMEOUT_MS budgets. Other
+    regexes run in process without a budget: the classification is
+    conservative but not a proof of linear time, so the time of every
+    regex searched on its own is added to efu_engine.guard.rule_costs.
+
+    Set rules go into an efu_engine.sets.SetIndex, looked up once per
+    text for all of them.
+
+    With use_atoms false, atoms are ignored and every regex takes the
+    alternation or standalone path. linear_engine false disables re2.
+    """
+
+    def __init__(self, rules, use_atoms=True, linear_engine=None):
+        """Compile an iterable of RuleSpec."""
+        if linear_engine is None:
+            linear_engine = re2 is not None
+        keywords = {}
+        combined = []
+        # Regexes to confirm when one of their atoms is found, by rule id.
+        self._confirm = {}
+        self._standalone = []
+        # Sources of the regexes searched in isolation, by rule id, and
+        # the prefilters of those without atoms.
+        self._isolated = {}
+        self._isolated_unindexed = []
+        set_rules = []
+        self.rule_ids = []
+        for rule in rules:
+            self.rule_ids.append(rule.id)
+            if rule.kind == KIND_LITERAL:
+                keywords.setdefault(rule.source, []).append(rule.id)
+                continue
+            if rule.kind in SET_KINDS:
+                set_rules.append(rule)
+                continue
+            if rule.linear_safe:
+                compiled = pattern_pool.compile(rule.source)
+            else:
+                compiled = self._compile_linear(rule) if linear_engine else None
+                if compiled is None:
+                    self._isolated[rule.id] = rule.source
+            indexed = use_atoms and rule.atoms
+            if indexed:
+                for atom in rule.atoms:
+                    keywords.setdefault(atom, []).append(rule.id)
+            if rule.id in self._isolated:
+                if not indexed:
+                    self._isolated_unindexed.append((rule.id, rule.prefilter))
+            elif indexed:
+                self._confirm[rule.id] = compiled
+            elif not rule.linear_safe or rule.needs_backtracking or compiled.groupindex:
+                self._standalone.append((rule.id, rule.prefilter, compiled))
+            else:
+                combined.append((rule.id, compiled))
+        # Results depend on timing when isolated regexes may time out.
+        self.time_bounded = bool(self._isolated)
+        self._keywords = AhoCorasick(keywords) if keywords else None
+        self._sets = SetIndex(set_rules) if set_rules else None
+        self._tree = _RegexTree(combined) if combined else None
+        self._rule_timeout = engine_setting('MATCH_RULE_TIMEOUT_MS') / 1000
+        self._message_timeout = engine_setting('MATCH_MESSAGE_TIMEOUT_MS') / 1000
+
+    @staticmethod
+    def _compile_linear(rule):
+        """Return the re2 regex of a rule, or None if re2 cannot run it
+        with the semantics of re."""
+        source = re2_source(rule.source)
+        if source is None:
+            return None
+        try:
+            return _Re2Regex(re2.compile(source))
+        except re2.error:
+            return None
+
+    def __len__(self):
+        return len(self.rule_ids)
+
+    def _search_tree(self, text, found):
+        """Add every rule of the alternation tree matching text to found."""
+        hits = set()
+        self._tree.search(text, hits)
+        found.update(hits)
+
+    def _search_isolated(self, rule_ids, text, found, costs, deadline):
+        """Search isolated regexes until the message budget is spent.
+
+        Rules left when the budget runs out count as timed out and do
+        not match.
+        """
+        clock = time.monotonic
+        for rule_id in rule_ids:
+            start = clock()
+            budget = min(self._rule_timeout, deadline - start)
+            matched = None
+            if budget > 0:
+                matched = isolated_search.search(self._isolated[rule_id], text, budget)
+            costs.append((rule_id, clock() - start, matched is None))
+            if matched:
+                found.add(rule_id)
+
+    def match(self, text, deadline=None):
+        """Return the sorted ids of the rules matching text.
+
+        deadline is the time.monotonic() value at which isolated regexes
+        stop being searched; by default the message budget from now.
+        """
+        clock = time.perf_counter
+        found = set()
+        costs = []
+        isolated = []
+        if self._keywords is not None:
+            confirm = self._confirm
+            for rule_id in self._keywords.search(text):
+                compiled = confirm.get(rule_id)
+                if compiled is not None:
+                    start = clock()
+                    if compiled.search(text):
+                        found.add(rule_id)
+                    costs.append((rule_id, clock() - start, False))
+                elif rule_id in self._isolated:
+                    isolated.append(rule_id)
+                else:
+                    found.add(rule_id)
+        if self._sets is not None:
+            found.update(self._sets.match(text))
+        if self._tree is not None:
+            self._search_tree(text, found)
+        for rule_id, prefilter, compiled in self._standalone:
+            if prefilter in text:
+                start = clock()
+                if compiled.search(text):
+                    found.add(rule_id)
+                costs.append((rule_id, clock() - start, False))
+        isolated.extend(
+            rule_id for rule_id, prefilter in self._isolated_unindexed
+            if prefilter in text
+        )
+        if isolated:
+            if deadline is None:
+                deadline = time.monotonic() + self._message_timeout
+            self._search_isolated(sorted(isolated), text, found, costs, deadline)
+        if costs:
+            rule_costs.record(costs)
+        return sorted(found)
+
+    @classmethod
+    def from_patterns(cls, patterns, **kwargs):
+        """Compile (rule_id, pattern) pairs that were not stored."""
+        return cls(
+            (make_rule_spec(rule_id, pattern) for rule_id, pattern in patterns),
+            **kwargs
+        )
+
+
+class ShardedRuleSet:
+    """A ruleset compiled as independent shards evaluated in priority order.
+
+    Rules are sorted by priority, ascending position then id, and cut
+    into consecutive stages of at most shard_size rules. Within a stage,
+    rules are grouped by the message field they read and every group is
+    compiled into its own CompiledRuleSet, a shard. Stages are evaluated
+    in order, and evaluation ends with the stage holding the first
+    matching rule with a terminal action, so later stages are never
+    searched.
+
+    Given the previous compiled form of the same ruleset, shards whose
+    rules are unchanged are reused, so editing one rule or appending
+    rules rebuilds a single shard. Without shard_size all rules form a
+    single stage.
+
+    serial identifies the compiled ruleset within the process and
+    read_fields lists every message field its rules read. Results are
+    cacheable unless they depend on isolated regexes timing out.
+    entry_count is the number of set rule entries.
+    """
+
+    def __init__(self, rules, shard_size=None, previous=None):
+        """Compile an iterable of RuleSpec, reusing shards of previous."""
+        rules = sorted(rules, key=lambda rule: (rule.position, rule.id))
+        reusable = dict(previous.shards) if previous is not None else {}
+        self.shards = []
+        # Lists of (field, shard) pairs, in priority order.
+        self.stages = []
+        self.compiled_shards = 0
+        size = shard_size or len(rules) or 1
+        for start in range(0, len(rules), size):
+            by_field = {}
+            for rule in rules[start:start + size]:
+                by_field.setdefault(rule.field, []).append(rule)
+            stage = []
+            for field in sorted(by_field):
+                specs = tuple(by_field[field])
+                shard = reusable.get(specs)
+                if shard is None:
+                    shard = CompiledRuleSet(specs)
+                    self.compiled_shards += 1
+                self.shards.append((specs, shard))
+                stage.append((field, shard))
+            self.stages.append(stage)
+        self.rule_ids = [rule.id for rule in rules]
+        self.entry_count = sum(len(rule.entries) for rule in rules)
+        self.serial = next(_serials)
+        self.read_fields = tuple(sorted({rule.field for rule in rules}))
+        self.cacheable = not any(shard.time_bounded for _, shard in self.shards)
+        self._rank = {rule.id: rank for rank, rule in enumerate(rules)}
+        self._terminal = {
+            rule.id: rule.action for rule in rules if rule.action in TERMINAL_ACTIONS
+        }
+        self._message_timeout = engine_setting('MATCH_MESSAGE_TIMEOUT_MS') / 1000
+
+    def __len__(self):
+        return len(self.rule_ids)
+
+    def evaluate(self, message):
+        """Return the ids of the rules matching a message and its action.
+
+        message is an efu_engine.message.Message, whose fields are only
+        extracted if a rule reads them, or a text read by every rule
+        whatever its target. Ids are in priority order and end with the
+        first matching rule with a terminal action, whose action is
+        returned; the action is None if no such rule matched. All shards
+        share one per message budget for isolated regexes.
+        """
+        deadline = time.monotonic() + self._message_timeout
+        terminal = self._terminal
+        found = []
+        for stage in self.stages:
+            for field, shard in stage:
+                text = message if isinstance(message, str) else message.field(field)
+                found.extend(shard.match(text, deadline))
+            if terminal and not terminal.keys().isdisjoint(found):
+                break
+        found.sort(key=self._rank.__getitem__)
+        if terminal:
+            for index, rule_id in enumerate(found):
+                action = terminal.get(rule_id)
+                if action is not None:
+                    return found[:index + 1], action
+        return found, None
+
+    def match(self, message):
+        """Return the ids of the rules matching a message, see evaluate."""
+        return self.evaluate(message)[0]
+
+
+def ruleset_rules(ruleset):
+    """Return the RuleSpec of every rule of a RuleSet instance.
+
+    The entries of its set rules are read with one more query.
+    """
+    from efu_auth.models import RuleEntry
+
+    rows = list(ruleset.rulesetrule_set.values_list(*RULE_SPEC_FIELDS))
+    set_rule_ids = [row[0] for row in rows if row[1] in SET_KINDS]
+    entries = {}
+    if set_rule_ids:
+        stored = RuleEntry.objects.filter(
+            rule_id__in=set_rule_ids,
+        ).order_by('rule_id', 'value').values_list('rule_id', 'value')
+        for rule_id, value in stored.iterator(chunk_size=10000):
+            entries.setdefault(rule_id, []).append(value)
+    return [rule_spec(*row, entries=entries.get(row[0], ())) for row in rows]
+
+
+def compile_ruleset(ruleset, previous=None, shard_size=None):
+    """Compile the rules of a RuleSet instance into a ShardedRuleSet.
+
+    previous is an earlier ShardedRuleSet of the same ruleset whose
+    unchanged shards are reused.
+    """
+    return ShardedRuleSet(
+        ruleset_rules(ruleset),
+        shard_size or engine_setting('RULESET_SHARD_SIZE'),
+        previous,
+    )
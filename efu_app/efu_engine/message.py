@@ -0,0 +1,310 @@
+"""
+Conversion of submitted messages to the text matched by rules.
+
+Every rule targets one part of a message. The parts are only extracted
+when a rule of the evaluated ruleset targets them, so a ruleset reading
+headers never has the body of a message decoded.
+"""
+import hashlib
+import re
+from email import policy
+from email.parser import (
+    BytesHeaderParser,
+    BytesParser,
+)
+
+# Parts of a message a rule can target. The whole message is rendered by
+# message_text; a header target names the header in Rule.header.
+TARGET_MESSAGE = 'message'
+TARGET_HEADER = 'header'
+TARGET_SUBJECT = 'subject'
+TARGET_BODY = 'body'
+TARGET_HTML = 'html'
+TARGET_ATTACHMENTS = 'attachments'
+TARGET_RAW = 'raw'
+TARGET_CHOICES = [
+    (TARGET_MESSAGE, 'Whole message'),
+    (TARGET_HEADER, 'Header'),
+    (TARGET_SUBJECT, 'Subject'),
+    (TARGET_BODY, 'Plain text body'),
+    (TARGET_HTML, 'HTML body'),
+    (TARGET_ATTACHMENTS, 'Attachment names'),
+    (TARGET_RAW, 'Raw source'),
+]
+# Prefix of the field of a header target, followed by the lower case
+# header name.
+HEADER_FIELD_PREFIX = 'header:'
+
+# End of the header block of a raw message.
+HEADER_END_RE = re.compile(rb'\r?\n\r?\n')
+
+
+def _check_str(value, name):
+    """Return value if it is a string, raise ValueError otherwise."""
+    if not isinstance(value, str):
+        raise ValueError('%s must be a string.' % name)
+    return value
+
+
+def iter_headers(headers):
+    """Yield (name, value) pairs from a header dict or list of pairs."""
+    if isinstance(headers, dict):
+        headers = headers.items()
+    elif not isinstance(headers, list):
+        raise ValueError('headers must be an object or a list of pairs.')
+    for pair in headers:
+        if not isinstance(pair, (list, tuple)) or len(pair) != 2:
+            raise ValueError('headers must be an object or a list of pairs.')
+        yield _check_str(pair[0], 'Header name'), _check_str(pair[1], 'Header value')
+
+
+def message_text(message):
+    """Return the text of a message dict that rules are matched against.
+
+    The message is rendered like its source: one 'Name: value' line per
+    header, the subject, a blank line and the body.
+    """
+    if not isinstance(message, dict):
+        raise ValueError('Message must be an object.')
+    lines = [
+        '%s: %s' % pair for pair in iter_headers(message.get('headers') or {})
+    ]
+    subject = message.get('subject')
+    if subject is not None:
+        lines.append('Subject: %s' % _check_str(subject, 'subject'))
+    lines.append('')
+    lines.append(_check_str(message.get('body') or '', 'body'))
+    return '\n'.join(lines)
+
+
+def parse_email(raw):
+    """Parse the raw bytes of an RFC 5322 message."""
+    return BytesParser(policy=policy.default).parsebytes(raw)
+
+
+def _content(part):
+    """Return the decoded text of a MIME part."""
+    try:
+        return part.get_content()
+    except (LookupError, UnicodeError):
+        payload = part.get_payload(decode=True) or b''
+        return payload.decode('utf-8', 'replace')
+
+
+def email_body(msg):
+    """Return the decoded text body of a parsed email, preferring plain."""
+    part = msg.get_body(preferencelist=('plain', 'html'))
+    if part is None:
+        return ''
+    return _content(part)
+
+
+def email_to_message(msg):
+    """Convert a parsed email to the message dict accepted by message_text."""
+    return {
+        'headers': [(name, str(value)) for name, value in msg.items()],
+        'body': email_body(msg),
+    }
+
+
+def target_field(target, header=''):
+    """Return the message field read by rules with a target and header."""
+    if target == TARGET_HEADER:
+        return HEADER_FIELD_PREFIX + header.lower()
+    return target
+
+
+class Message:
+    """A message whose fields are extracted the first time a rule reads them.
+
+    Subclasses implement _extract(field) for the fields named by
+    target_field.
+    """
+
+    def __init__(self):
+        self._fields = {}
+
+    def field(self, name):
+        """Return the text of a message field."""
+        try:
+            return self._fields[name]
+        except KeyError:
+            value = self._fields[name] = self._extract(name)
+            return value
+
+    @property
+    def fields_read(self):
+        """Return the names of the fields extracted so far."""
+        return set(self._fields)
+
+    def fingerprint(self, fields):
+        """Return a digest of the given fields.
+
+        Messages whose fields hold the same text get the same digest,
+        however the rest of them differs. Subclasses digest what the
+        fields are extracted from when extracting them up front would
+        cost more than evaluation may need.
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        for name in fields:
+            value = self._fingerprint_text(name).encode('utf-8', 'surrogatepass')
+            digest.update(b'%d:' % len(value))
+            digest.update(value)
+        return digest.digest()
+
+    def _fingerprint_text(self, name):
+        return self.field(name)
+
+    def _extract(self, name):
+        raise NotImplementedError
+
+
+class SubmittedMessage(Message):
+    """A message dict submitted to the API.
+
+    The structure is checked up front, since that is cheap; rendering is
+    left to the fields that are read.
+    """
+
+    def __init__(self, data):
+        super().__init__()
+        if not isinstance(data, dict):
+            raise ValueError('Message must be an object.')
+        self.headers = list(iter_headers(data.get('headers') or {}))
+        self.subject = data.get('subject')
+        if self.subject is not None:
+            _check_str(self.subject, 'subject')
+        self.body = _check_str(data.get('body') or '', 'body')
+        self.html = _check_str(data.get('html') or '', 'html')
+        attachments = data.get('attachments') or []
+        if not isinstance(attachments, list):
+            raise ValueError('attachments must be a list of file names.')
+        self.attachments = [_check_str(name, 'Attachment name') for name in attachments]
+        self._data = data
+
+    def _header(self, name):
+        values = [value for key, value in self.headers if key.lower() == name]
+        if name == 'subject' and self.subject is not None:
+            values.append(self.subject)
+        return '\n'.join(values)
+
+    def _extract(self, name):
+        if name == TARGET_MESSAGE:
+            return message_text(self._data)
+        if name == TARGET_RAW:
+            # The rendered message is the only source of a submitted one.
+            return self.field(TARGET_MESSAGE)
+        if name.startswith(HEADER_FIELD_PREFIX):
+            return self._header(name[len(HEADER_FIELD_PREFIX):])
+        if name == TARGET_SUBJECT:
+            return self._header('subject')
+        if name == TARGET_BODY:
+            return self.body
+        if name == TARGET_HTML:
+            return self.html
+        if name == TARGET_ATTACHMENTS:
+            return '\n'.join(self.attachments)
+        raise ValueError('Unknown message field %r.' % name)
+
+    def _fingerprint_text(self, name):
+        # Fields of a submitted message are cheap to render but are
+        # only stored once a rule reads them.
+        if name in self._fields:
+            return self._fields[name]
+        return self._extract(TARGET_MESSAGE if name == TARGET_RAW else name)
+
+
+class RawMessage(Message):
+    """A raw RFC 5322 message.
+
+    Header fields only parse the header block. The MIME structure is
+    parsed when a body, attachment or whole message field is read, and
+    only the parts those fields need are decoded.
+    """
+
+    def __init__(self, raw):
+        super().__init__()
+        self.raw = raw
+        self._headers = None
+        self._email = None
+
+    @property
+    def headers(self):
+        """Return the parsed header block."""
+        if self._headers is None:
+            if self._email is not None:
+                self._headers = self._email
+            else:
+                match = HEADER_END_RE.search(self.raw)
+                block = self.raw[:match.end()] if match else self.raw
+                self._headers = BytesHeaderParser(policy=policy.default).parsebytes(block)
+        return self._headers
+
+    @property
+    def email(self):
+        """Return the fully parsed message."""
+        if self._email is None:
+            self._email = parse_email(self.raw)
+        return self._email
+
+    def header(self, name):
+        """Return the first value of a header, or None."""
+        value = self.headers.get(name)
+        return None if value is None else str(value)
+
+    def _part_content(self, preference):
+        part = self.email.get_body(preferencelist=preference)
+        return '' if part is None else _content(part)
+
+    def _extract(self, name):
+        if name.startswith(HEADER_FIELD_PREFIX):
+            values = self.headers.get_all(name[len(HEADER_FIELD_PREFIX):]) or []
+            return '\n'.join(str(value) for value in values)
+        if name == TARGET_SUBJECT:
+            return self.header('Subject') or ''
+        if name == TARGET_MESSAGE:
+            return message_text(email_to_message(self.email))
+        if name == TARGET_RAW:
+            return self.raw.decode('utf-8', 'replace')
+        if name == TARGET_BODY:
+            return self._part_content(('plain',))
+        if name == TARGET_HTML:
+            return self._part_content(('html',))
+        if name == TARGET_ATTACHMENTS:
+            return '\n'.join(
+                part.get_filename() for part in self.email.walk()
+                if part.get_filename()
+            )
+        raise ValueError('Unknown message field %r.' % name)
+
+    def fingerprint(self, fields):
+        """Return a digest of the raw message, which holds every field.
+
+        Unlike the digest of the fields it needs no parsing, though
+        messages differing in fields no rule reads get different digests.
+        """
+        digest = hashlib.blake2b(self.raw, digest_size=16, person=b'raw')
+        return digest.digest()
+
+
+def fingerprint(message, fields):
+    """Return the digest of the given fields of a Message, or of a text."""
+    if isinstance(message, str):
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(message.encode('utf-8', 'surrogatepass'))
+        return digest.digest()
+    return message.fingerprint(fields)
+
+
+def as_message(message):
+    """Return the Message of a raw email, message dict or Message."""
+    if isinstance(message, Message):
+        return message
+    if isinstance(message, bytes):
+        return RawMessage(message)
+    return SubmittedMessage(message)
+
+
+def match_message(compiled, message):
+    """Return the ids of the rules matching a raw email or message dict."""
+    return compiled.match(as_message(message))
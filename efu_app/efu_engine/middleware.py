@@ -0,0 +1,143 @@
+"""
+Opt-in request profiling middleware.
+"""
+import asyncio
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import time
+from contextlib import (
+    ExitStack,
+    contextmanager,
+)
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from efu_engine.conf import engine_setting
+from efu_engine.profiling import (
+    RequestProfile,
+    activate,
+)
+
+logger = logging.getLogger(__name__)
+
+PATH_SLUG_RE = re.compile(r'[^A-Za-z0-9]+')
+
+
+class ProfilingMiddleware:
+    """Record where the time of each request goes.
+
+    Enabled by the PROFILING engine setting. Wall time, the number and
+    duration of database queries and the serializer and rule evaluation
+    times are sent in a Server-Timing header and logged as one JSON line
+    on the efu_engine.middleware logger. With PROFILING_DIR set, a
+    PROFILING_SAMPLE_RATE fraction of requests runs under cProfile and
+    the stats of those slower than PROFILING_SLOW_MS are dumped there.
+
+    Only the work done before the response is returned is measured, not
+    the iteration of a streaming response.
+
+    Under ASGI the middleware runs on the event loop. Queries made in
+    sync_to_async threads are not counted there, and sampled cProfile
+    stats include the other requests the loop served meanwhile.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not engine_setting('PROFILING'):
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.async_mode = asyncio.iscoroutinefunction(get_response)
+        if self.async_mode:
+            # Marks the instance as a coroutine function for Django.
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+        self.profile_dir = engine_setting('PROFILING_DIR')
+        self.sample_rate = engine_setting('PROFILING_SAMPLE_RATE')
+        self.slow_ms = engine_setting('PROFILING_SLOW_MS')
+        if self.profile_dir:
+            os.makedirs(self.profile_dir, exist_ok=True)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        profile, profiler = RequestProfile(), self.sampled_profiler()
+        with self.measure(profile, profiler):
+            response = self.get_response(request)
+        return self.finish(request, response, profile, profiler)
+
+    async def __acall__(self, request):
+        profile, profiler = RequestProfile(), self.sampled_profiler()
+        with self.measure(profile, profiler):
+            response = await self.get_response(request)
+        return self.finish(request, response, profile, profiler)
+
+    def sampled_profiler(self):
+        """Return a cProfile profiler for a sampled request, else None."""
+        if self.profile_dir and random.random() < self.sample_rate:
+            return cProfile.Profile()
+        return None
+
+    @contextmanager
+    def measure(self, profile, profiler):
+        """Record the duration and queries of the block in profile."""
+        with ExitStack() as stack:
+            stack.enter_context(activate(profile))
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(profile.execute_wrapper))
+            start = time.perf_counter()
+            if profiler is not None:
+                profiler.enable()
+            try:
+                yield
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+            profile.add('total', time.perf_counter() - start)
+
+    def finish(self, request, response, profile, profiler):
+        """Report the profile of a request and return its response."""
+        response['Server-Timing'] = self.server_timing(profile)
+        total_ms = profile.durations['total'] * 1000
+        logger.info(json.dumps(self.record(request, response, profile), sort_keys=True))
+        if profiler is not None and total_ms >= self.slow_ms:
+            self.dump(profiler, request, total_ms)
+        return response
+
+    @staticmethod
+    def server_timing(profile):
+        """Return the Server-Timing header value of a profile."""
+        metrics = []
+        for name, seconds in sorted(profile.durations.items()):
+            metric = '%s;dur=%.3f' % (name, seconds * 1000)
+            if name == 'db':
+                metric += ';desc="%d queries"' % profile.queries
+            metrics.append(metric)
+        return ', '.join(metrics)
+
+    @staticmethod
+    def record(request, response, profile):
+        """Return the log record of a profiled request."""
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': profile.queries,
+        }
+        for name, seconds in profile.durations.items():
+            record['%s_ms' % name] = round(seconds * 1000, 3)
+        return record
+
+    def dump(self, profiler, request, total_ms):
+        """Write the cProfile stats of a slow request to the profile dir."""
+        name = '%d-%s-%s-%dms.prof' % (
+            time.time() * 1000,
+            request.method,
+            PATH_SLUG_RE.sub('_', request.path).strip('_') or 'root',
+            total_ms,
+        )
+        profiler.dump_stats(os.path.join(self.profile_dir, name))
@@ -0,0 +1,28 @@
+"""
+Cursor pagination for the engine API.
+"""
+from rest_framework.pagination import CursorPagination
+
+from efu_engine.conf import engine_setting
+
+
+class EngineCursorPagination(CursorPagination):
+    """Keyset pagination with a client page size capped by settings."""
+    page_size_query_param = 'page_size'
+
+    def get_page_size(self, request):
+        """Return the page size asked by the client, capped by settings."""
+        self.page_size = engine_setting('PAGE_SIZE')
+        self.max_page_size = engine_setting('MAX_PAGE_SIZE')
+        return super().get_page_size(request)
+
+
+class RuleCursorPagination(EngineCursorPagination):
+    """Paginate rules on the (user, name, id) index."""
+    # id breaks ties between rules with the same name.
+    ordering = ('-name', '-id')
+
+
+class RuleSetCursorPagination(EngineCursorPagination):
+    """Paginate rulesets on the (user, id) index."""
+    ordering = '-id'
@@ -0,0 +1,105 @@
+"""
+Parallel evaluation of message batches.
+"""
+import itertools
+import os
+import threading
+from collections import deque
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+
+from efu_engine.conf import engine_setting
+from efu_engine.matcher import ShardedRuleSet
+from efu_engine.message import match_message
+
+# Compiled ruleset of the current worker process, set by _init_worker.
+_worker_ruleset = None
+
+# Thread pool of the async views, created on first use.
+_evaluation_pool = None
+_evaluation_pool_lock = threading.Lock()
+
+
+def evaluation_pool():
+    """Return the bounded thread pool async views evaluate messages in.
+
+    Its size is the ASYNC_EVALUATE_WORKERS engine setting, so CPU bound
+    matching never runs on the event loop and the number of threads does
+    not grow with the number of open connections.
+    """
+    global _evaluation_pool
+    if _evaluation_pool is None:
+        with _evaluation_pool_lock:
+            if _evaluation_pool is None:
+                _evaluation_pool = ThreadPoolExecutor(
+                    max_workers=engine_setting('ASYNC_EVALUATE_WORKERS'),
+                    thread_name_prefix='efu-evaluate',
+                )
+    return _evaluation_pool
+
+
+def _init_worker(rules):
+    """Compile the ruleset once when a worker process starts."""
+    global _worker_ruleset
+    _worker_ruleset = ShardedRuleSet(rules)
+
+
+def _evaluate_chunk(evaluate, chunk):
+    """Evaluate (key, message) pairs in a worker process."""
+    return [(key, evaluate(_worker_ruleset, message)) for key, message in chunk]
+
+
+def _chunks(messages, chunk_size):
+    """Yield lists of at most chunk_size (key, message) pairs."""
+    messages = iter(messages)
+    while True:
+        chunk = list(itertools.islice(messages, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def evaluate_parallel(rules, messages, workers=None, chunk_size=256,
+                      ordered=True, max_pending=None, evaluate=match_message):
+    """Evaluate (key, message) pairs over a pool of worker processes.
+
+    rules are the rule specs of the ruleset; every worker compiles them
+    once in its initializer instead of receiving them with each task.
+    Messages are sent in chunks of chunk_size and evaluated with
+    evaluate(compiled, message), a module level function. Yields
+    (key, result) pairs, in input order if ordered is true or as soon as
+    each chunk completes otherwise. At most max_pending chunks are in
+    flight, so the input can be an unbounded stream.
+    """
+    rules = list(rules)
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 2
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(rules,),
+    ) as executor:
+        chunks = _chunks(messages, chunk_size)
+        if ordered:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_evaluate_chunk, evaluate, chunk))
+                if len(pending) >= max_pending:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        else:
+            pending = set()
+            for chunk in chunks:
+                pending.add(executor.submit(_evaluate_chunk, evaluate, chunk))
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield from future.result()
+            for future in as_completed(pending):
+                yield from future.result()
@@ -0,0 +1,61 @@
+"""
+Request parsers for the engine API.
+"""
+import codecs
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+from efu_engine.transfer import read_csv
+
+
+class NDJSONParser(BaseParser):
+    """Parse newline delimited JSON into a lazy iterator of objects.
+
+    The request stream is read one line at a time while the iterator is
+    consumed, so the body is never buffered as a whole.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if stream is None:
+            return iter(())
+        return self._iter_objects(stream, encoding)
+
+    @staticmethod
+    def _iter_objects(stream, encoding):
+        for lineno, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line.decode(encoding))
+            except ValueError as exc:
+                raise ParseError('NDJSON parse error on line %d - %s' % (lineno, exc))
+
+
+class CSVParser(BaseParser):
+    """Parse CSV with a header row into a lazy iterator of rule dicts.
+
+    Like NDJSONParser, the request stream is read while the iterator is
+    consumed.
+    """
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if stream is None:
+            return iter(())
+        return self._iter_rows(stream, encoding)
+
+    @staticmethod
+    def _iter_rows(stream, encoding):
+        try:
+            yield from read_csv(codecs.iterdecode(stream, encoding))
+        except ValueError as exc:
+            raise ParseError('CSV parse error - %s' % exc)
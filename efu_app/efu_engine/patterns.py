@@ -0,0 +1,605 @@
+"""
+Validation and normalization of rule patterns at write time.
+
+The result is stored on Rule so the evaluator never parses a pattern.
+"""
+import functools
+import re
+import sys
+
+from efu_engine.sets import (
+    KIND_ADDRESS,
+    KIND_DOMAIN,
+    KIND_IP,
+    SET_KINDS,
+    normalize_entry,
+)
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+KIND_LITERAL = 'literal'
+KIND_REGEX = 'regex'
+KIND_GLOB = 'glob'
+KIND_CHOICES = [
+    (KIND_LITERAL, 'Literal'),
+    (KIND_REGEX, 'Regular expression'),
+    (KIND_GLOB, 'Glob'),
+    (KIND_DOMAIN, 'Domain set'),
+    (KIND_ADDRESS, 'Email address set'),
+    (KIND_IP, 'IP network set'),
+]
+
+# Characters with a special meaning in a regular expression. A pattern
+# without any of them is a plain substring.
+REGEX_METACHARS = frozenset('.^$*+?{}[]\\|()')
+
+# Leading global inline flags such as (?i) or (?ms).
+GLOBAL_FLAGS_RE = re.compile(r'\(\?([aiLmsux]+)\)')
+
+# Operators a linear time automaton cannot run.
+BACKTRACKING_OPS = frozenset(
+    getattr(sre_constants, name)
+    for name in (
+        'GROUPREF', 'GROUPREF_EXISTS', 'GROUPREF_IGNORE', 'GROUPREF_LOC_IGNORE',
+        'GROUPREF_UNI_IGNORE', 'ASSERT', 'ASSERT_NOT', 'ATOMIC_GROUP',
+        'POSSESSIVE_REPEAT',
+    )
+    if hasattr(sre_constants, name)
+)
+# Atom sets are only indexed when every atom is at least this long and
+# there are at most this many of them; otherwise they filter too little.
+MIN_ATOM_LENGTH = 3
+MAX_ATOMS = 32
+
+# Repeats with at least this upper bound are treated as unbounded when
+# looking for adjacent repeats that backtrack polynomially.
+UNBOUNDED_REPEAT = 32
+
+# Characters tried, along with the literals and range bounds of both
+# sides, to tell whether two single character repeats can match the same
+# character.
+SAMPLE_CHARS = '\x00\t\n\x0b\r\x1c -/09:@AZ[`_az{~\x7f\x85\xa0\xe9\u0660\u2028\u3000'
+CATEGORY_CLASSES = {
+    sre_constants.CATEGORY_DIGIT: r'\d',
+    sre_constants.CATEGORY_NOT_DIGIT: r'\D',
+    sre_constants.CATEGORY_SPACE: r'\s',
+    sre_constants.CATEGORY_NOT_SPACE: r'\S',
+    sre_constants.CATEGORY_WORD: r'\w',
+    sre_constants.CATEGORY_NOT_WORD: r'\W',
+}
+
+REPEAT_OPS = frozenset(
+    getattr(sre_constants, name)
+    for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+    if hasattr(sre_constants, name)
+)
+
+# Tests of the characters in the categories of str patterns. re2 has
+# ASCII only \d, \s and \w and an older Unicode database, so classes of
+# these characters are built for it; see _re2_category.
+UNICODE_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: str.isdecimal,
+    sre_constants.CATEGORY_SPACE: str.isspace,
+    sre_constants.CATEGORY_WORD: lambda char: char.isalnum() or char == '_',
+}
+ASCII_CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: '0-9',
+    sre_constants.CATEGORY_SPACE: r'\t-\r ',
+    sre_constants.CATEGORY_WORD: '0-9A-Za-z_',
+}
+NEGATED_CATEGORIES = {
+    sre_constants.CATEGORY_NOT_DIGIT: sre_constants.CATEGORY_DIGIT,
+    sre_constants.CATEGORY_NOT_SPACE: sre_constants.CATEGORY_SPACE,
+    sre_constants.CATEGORY_NOT_WORD: sre_constants.CATEGORY_WORD,
+}
+# Characters re ignoring case also matches with i and I, unlike re2.
+DOTTED_I = r'\x{130}\x{131}'
+
+
+class PatternError(ValueError):
+    """Raised for a pattern that cannot be compiled."""
+
+
+def is_literal(pattern):
+    """Return True if the pattern has no regex metacharacters."""
+    return not REGEX_METACHARS.intersection(pattern)
+
+
+def default_kind(pattern):
+    """Return the kind of a pattern stored without one."""
+    return KIND_LITERAL if is_literal(pattern) else KIND_REGEX
+
+
+def _glob_members(members):
+    """Return the escaped members of a glob character set.
+
+    Ranges are kept and reversed ranges, which match nothing, dropped as
+    fnmatch does.
+    """
+    parts = []
+    pos = 0
+    while pos < len(members):
+        if members[pos + 1:pos + 2] == '-' and pos + 2 < len(members):
+            low, high = members[pos], members[pos + 2]
+            if low <= high:
+                parts.append('%s-%s' % (re.escape(low), re.escape(high)))
+            pos += 3
+        else:
+            parts.append(re.escape(members[pos]))
+            pos += 1
+    return ''.join(parts)
+
+
+def glob_to_regex(pattern):
+    """Translate a glob into an unanchored regex matching within a line."""
+    parts = []
+    pos = 0
+    end = len(pattern)
+    while pos < end:
+        char = pattern[pos]
+        pos += 1
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        elif char == '[':
+            negated = pattern[pos:pos + 1] == '!'
+            start = pos + negated
+            # A ] right after [ or [! is a member, not the end of the set.
+            close = pattern.find(']', start + 1)
+            if close == -1:
+                parts.append('\\[')
+                continue
+            members = _glob_members(pattern[start:close])
+            pos = close + 1
+            if not members:
+                parts.append('.' if negated else '(?!)')
+            else:
+                parts.append('[%s%s]' % ('^' if negated else '', members))
+        else:
+            parts.append(re.escape(char))
+    return ''.join(parts)
+
+
+def normalize_regex(source):
+    """Turn leading global inline flags into a scoped group.
+
+    Global flags are only valid at the start of an expression, which would
+    prevent merging the pattern into an alternation with other patterns.
+    """
+    flags = ''
+    match = GLOBAL_FLAGS_RE.match(source)
+    while match:
+        flags += match.group(1)
+        source = source[match.end():]
+        match = GLOBAL_FLAGS_RE.match(source)
+    if not flags:
+        return source
+    if 'x' in flags:
+        # A trailing comment of a verbose pattern runs to the end of line.
+        source += '\n'
+    return '(?%s:%s)' % (''.join(sorted(set(flags))), source)
+
+
+def _children(av):
+    """Yield the parsed subpatterns nested in the argument of an op."""
+    if isinstance(av, sre_parse.SubPattern):
+        yield av
+    elif isinstance(av, (list, tuple)):
+        for item in av:
+            if isinstance(item, sre_parse.SubPattern):
+                yield item
+            elif isinstance(item, (list, tuple)):
+                for sub in item:
+                    if isinstance(sub, sre_parse.SubPattern):
+                        yield sub
+
+
+def _walk(parsed):
+    """Yield every (op, av) pair of a parsed pattern, nested ones included."""
+    for op, av in parsed:
+        yield op, av
+        for child in _children(av):
+            yield from _walk(child)
+
+
+def _sequences(parsed):
+    """Yield a parsed pattern and every subpattern nested in it."""
+    yield parsed
+    for _, av in parsed:
+        for child in _children(av):
+            yield from _sequences(child)
+
+
+def _literal_runs(parsed):
+    """Return literal strings that every match of a parsed pattern contains."""
+    runs = []
+    current = []
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            current.append(chr(av))
+            continue
+        if op is sre_constants.AT:
+            # Anchors do not consume characters.
+            continue
+        runs.append(''.join(current))
+        current = []
+        if op is sre_constants.SUBPATTERN:
+            add_flags = av[1]
+            if not add_flags & re.IGNORECASE:
+                runs.extend(_literal_runs(av[-1]))
+        elif op in REPEAT_OPS and av[0] >= 1:
+            runs.extend(_literal_runs(av[2]))
+    runs.append(''.join(current))
+    return [run for run in runs if run]
+
+
+def _atom_score(atoms):
+    """Rank atom sets: longest shortest atom first, then fewest atoms."""
+    return min(len(atom) for atom in atoms), -len(atoms)
+
+
+def _atoms(parsed):
+    """Return a set of literals one of which every match contains.
+
+    Returns None when no usable set can be derived from the pattern.
+    """
+    candidates = []
+    current = []
+    for op, av in parsed:
+        if op is sre_constants.LITERAL:
+            current.append(chr(av))
+            continue
+        if op is sre_constants.AT:
+            continue
+        if current:
+            candidates.append({''.join(current)})
+            current = []
+        if op is sre_constants.SUBPATTERN:
+            if not av[1] & re.IGNORECASE:
+                candidates.append(_atoms(av[-1]))
+        elif op in REPEAT_OPS and av[0] >= 1:
+            candidates.append(_atoms(av[2]))
+        elif op is sre_constants.BRANCH:
+            branches = [_atoms(branch) for branch in av[1]]
+            if all(branches):
+                candidates.append(set().union(*branches))
+    if current:
+        candidates.append({''.join(current)})
+    candidates = [
+        atoms for atoms in candidates
+        if atoms and len(atoms) <= MAX_ATOMS
+        and min(len(atom) for atom in atoms) >= MIN_ATOM_LENGTH
+    ]
+    return max(candidates, key=_atom_score, default=None)
+
+
+def _unwrap(op, av):
+    """Return the single item a group holds, or the item itself."""
+    while op is sre_constants.SUBPATTERN and len(av[-1]) == 1:
+        op, av = av[-1][0]
+    return op, av
+
+
+def _is_unbounded(op, av):
+    """Return True for a repeat that can consume arbitrarily many items."""
+    return op in REPEAT_OPS and av[1] >= UNBOUNDED_REPEAT
+
+
+def _is_variable(op, av):
+    """Return True for a repeat of variable count, optional items included."""
+    return op in REPEAT_OPS and av[1] != av[0]
+
+
+def _char_class(parsed):
+    """Return the regex source of a single character pattern and its chars.
+
+    The chars are its literals and range bounds. Returns None for a
+    pattern that may match more or less than one character.
+    """
+    if len(parsed) != 1:
+        return None
+    op, av = _unwrap(*parsed[0])
+    if op is sre_constants.LITERAL:
+        return re.escape(chr(av)), chr(av)
+    if op is sre_constants.NOT_LITERAL:
+        return '[^%s]' % re.escape(chr(av)), chr(av)
+    if op is sre_constants.ANY:
+        return '(?s:.)', ''
+    if op is not sre_constants.IN:
+        return None
+    members = []
+    chars = []
+    for item_op, item_av in av:
+        if item_op is sre_constants.NEGATE:
+            members.insert(0, '^')
+        elif item_op is sre_constants.LITERAL:
+            members.append(re.escape(chr(item_av)))
+            chars.append(chr(item_av))
+        elif item_op is sre_constants.RANGE:
+            low, high = chr(item_av[0]), chr(item_av[1])
+            members.append('%s-%s' % (re.escape(low), re.escape(high)))
+            chars.extend((low, high))
+        elif item_av in CATEGORY_CLASSES:
+            members.append(CATEGORY_CLASSES[item_av])
+        else:
+            return None
+    return '[%s]' % ''.join(members), ''.join(chars)
+
+
+def _may_overlap(first, second, flags):
+    """Return False only if two repeat bodies never match the same character.
+
+    Two character sets overlap when one contains a bound of a range or
+    a literal of the other; characters of every category are tried too.
+    """
+    first = _char_class(first)
+    second = _char_class(second)
+    if first is None or second is None:
+        return True
+    first_re = re.compile(first[0], flags)
+    second_re = re.compile(second[0], flags)
+    return any(
+        first_re.fullmatch(char) and second_re.fullmatch(char)
+        for char in set(first[1] + second[1] + SAMPLE_CHARS)
+    )
+
+
+def _is_linear_safe(parsed, flags=0):
+    """Return False if a parsed pattern can backtrack catastrophically.
+
+    The check is conservative. A repeat of more than one count over an
+    alternation or a repeat of variable length, as in (a|aa)+, (a+)+,
+    (.*a){12} or (a?){27}, may try exponentially many ways to split a
+    failing text.
+    Adjacent unbounded repeats able to match the same character, as in
+    a*.* or a*-?a*, try polynomially many.
+    """
+    for op, av in _walk(parsed):
+        if op in BACKTRACKING_OPS:
+            return False
+        if op in REPEAT_OPS and av[1] > 1:
+            for inner_op, inner_av in _walk(av[2]):
+                if inner_op is sre_constants.BRANCH or _is_variable(inner_op, inner_av):
+                    return False
+    for sequence in _sequences(parsed):
+        previous = None
+        for op, av in sequence:
+            op, av = _unwrap(op, av)
+            if op is sre_constants.AT or op in REPEAT_OPS and not av[0] and not _is_unbounded(op, av):
+                # Anchors and short optional items can be skipped over.
+                continue
+            if not _is_unbounded(op, av):
+                previous = None
+                continue
+            if previous is not None and _may_overlap(previous, av[2], flags):
+                return False
+            previous = av[2]
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def _re2_category(category):
+    """Return the re2 class members of the characters of a Unicode category.
+
+    Computed once per process from the Unicode database of Python.
+    """
+    test = UNICODE_CATEGORIES[category]
+    ranges = []
+    for code in range(sys.maxunicode + 1):
+        if test(chr(code)):
+            if ranges and ranges[-1][1] == code - 1:
+                ranges[-1][1] = code
+            else:
+                ranges.append([code, code])
+    return ''.join(
+        r'\x{%x}' % low if low == high else r'\x{%x}-\x{%x}' % (low, high)
+        for low, high in ranges
+    )
+
+
+def _re2_members(low, high, flags):
+    """Return the re2 class members of the range of codes low to high.
+
+    Ignoring case, re2 and re only agree on ASCII letters, once i is
+    given the dotted and dotless forms re adds.
+    """
+    if low <= 0xdfff and high >= 0xd800:
+        raise PatternError('No re2 equivalent of surrogates.')
+    members = r'\x{%x}' % low if low == high else r'\x{%x}-\x{%x}' % (low, high)
+    if flags & re.IGNORECASE:
+        if high > 0x7f:
+            raise PatternError('No re2 equivalent of non ASCII case folding.')
+        if low <= ord('i') <= high or low <= ord('I') <= high:
+            members += DOTTED_I
+    return members
+
+
+def _re2_class(items, flags):
+    """Return the re2 character class of the items of an IN op."""
+    if flags & re.ASCII:
+        category = ASCII_CATEGORIES.__getitem__
+    else:
+        category = _re2_category
+    if len(items) == 1 and items[0][1] in NEGATED_CATEGORIES:
+        return '(?-i:[^%s])' % category(NEGATED_CATEGORIES[items[0][1]])
+    negate = ''
+    members = []
+    # re matches categories whatever the case flag, re2 folds them.
+    categories = []
+    for op, av in items:
+        if op is sre_constants.NEGATE:
+            negate = '^'
+        elif op is sre_constants.LITERAL:
+            members.append(_re2_members(av, av, flags))
+        elif op is sre_constants.RANGE:
+            members.append(_re2_members(*av, flags))
+        elif op is sre_constants.CATEGORY and av in ASCII_CATEGORIES:
+            categories.append(category(av))
+        else:
+            raise PatternError('No re2 equivalent of %s.' % op)
+    if not flags & re.IGNORECASE or not categories:
+        return '[%s%s]' % (negate, ''.join(members + categories))
+    if negate:
+        raise PatternError('No re2 equivalent of a negated class ignoring case.')
+    categories = '(?-i:[%s])' % ''.join(categories)
+    if not members:
+        return categories
+    return '(?:%s|[%s])' % (categories, ''.join(members))
+
+
+def _re2_sequence(parsed, flags, at_end):
+    """Return the re2 source of a parsed sequence matched under flags.
+
+    at_end tells whether nothing follows the sequence in the pattern.
+    """
+    parts = []
+    last = len(parsed) - 1
+    for index, (op, av) in enumerate(parsed):
+        item_at_end = at_end and index == last
+        if op is sre_constants.LITERAL:
+            parts.append('[%s]' % _re2_members(av, av, flags))
+        elif op is sre_constants.NOT_LITERAL:
+            parts.append('[^%s]' % _re2_members(av, av, flags))
+        elif op is sre_constants.ANY:
+            parts.append('(?s:.)' if flags & re.DOTALL else r'[^\n]')
+        elif op is sre_constants.IN:
+            parts.append(_re2_class(av, flags))
+        elif op is sre_constants.BRANCH:
+            parts.append('(?:%s)' % '|'.join(
+                _re2_sequence(branch, flags, item_at_end) for branch in av[1]
+            ))
+        elif op is sre_constants.SUBPATTERN:
+            inner = (flags | av[1]) & ~av[2]
+            case = ''
+            if inner & re.IGNORECASE != flags & re.IGNORECASE:
+                case = 'i' if inner & re.IGNORECASE else '-i'
+            parts.append('(?%s:%s)' % (case, _re2_sequence(av[-1], inner, item_at_end)))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            low, high, item = av
+            bounds = '{%d,}' % low if high == sre_constants.MAXREPEAT else '{%d,%d}' % (low, high)
+            parts.append('(?:%s)%s' % (_re2_sequence(item, flags, False), bounds))
+        elif op is sre_constants.AT:
+            parts.append(_re2_at(av, flags, item_at_end))
+        else:
+            raise PatternError('No re2 equivalent of %s.' % op)
+    return ''.join(parts)
+
+
+def _re2_at(at, flags, at_end):
+    """Return the re2 source of an anchor."""
+    if at is sre_constants.AT_BEGINNING:
+        return '(?m:^)' if flags & re.MULTILINE else r'\A'
+    if at is sre_constants.AT_BEGINNING_STRING:
+        return r'\A'
+    if at is sre_constants.AT_END_STRING:
+        return r'\z'
+    if at is sre_constants.AT_END:
+        if flags & re.MULTILINE:
+            return '(?m:$)'
+        # $ also matches before a final newline. Consuming it is only
+        # harmless when nothing follows.
+        if at_end:
+            return r'(?:\n?\z)'
+    elif flags & re.ASCII:
+        # Only ASCII word boundaries agree between the engines.
+        if at is sre_constants.AT_BOUNDARY:
+            return r'\b'
+        if at is sre_constants.AT_NON_BOUNDARY:
+            return r'\B'
+    raise PatternError('No re2 equivalent of %s.' % at)
+
+
+def re2_source(source):
+    """Return a re2 regex matching the same texts as a Python regex.
+
+    re2 differs from re on $ before a final newline, on Unicode classes,
+    case folding and word boundaries and on the syntax it accepts, so the
+    source is rebuilt from the parsed regex. Returns None for regexes re2
+    cannot match the same way, such as ones with backreferences,
+    lookarounds, Unicode word boundaries or non ASCII letters ignoring
+    case.
+    """
+    try:
+        parsed = sre_parse.parse(source)
+        flags = parsed.state.flags
+        translated = _re2_sequence(parsed, flags, True)
+    except (re.error, OverflowError, RecursionError, PatternError):
+        return None
+    return '(?i:%s)' % translated if flags & re.IGNORECASE else translated
+
+
+def analyze_regex(source):
+    """Return the prefilter, atoms and backtracking flags of a regex."""
+    try:
+        compiled = re.compile(source)
+        parsed = sre_parse.parse(source)
+    except (re.error, OverflowError, RecursionError) as exc:
+        raise PatternError('Invalid regular expression: %s' % exc)
+    needs_backtracking = any(op in BACKTRACKING_OPS for op, _ in _walk(parsed))
+    # Character sets are compared case insensitively if any part of the
+    # pattern is.
+    flags = compiled.flags & re.IGNORECASE or next((
+        re.IGNORECASE for op, av in _walk(parsed)
+        if op is sre_constants.SUBPATTERN and av[1] & re.IGNORECASE
+    ), 0)
+    prefilter = ''
+    atoms = []
+    if not compiled.flags & re.IGNORECASE:
+        prefilter = max(_literal_runs(parsed), key=len, default='')
+        atoms = sorted(_atoms(parsed) or ())
+    return prefilter, atoms, needs_backtracking, _is_linear_safe(parsed, flags)
+
+
+def analyze_pattern(pattern, kind=''):
+    """Validate a pattern and return its precompiled form.
+
+    The result maps the Rule fields kind, compiled_pattern, prefilter,
+    atoms, needs_backtracking and linear_safe to their values. Without a
+    kind, patterns without regex metacharacters are literal and all others
+    regexes. The pattern of a set kind is one entry of the set, stored
+    normalized as compiled_pattern; see efu_engine.sets.
+    """
+    kind = kind or default_kind(pattern)
+    if kind == KIND_LITERAL:
+        return {
+            'kind': kind,
+            'compiled_pattern': '',
+            'prefilter': pattern,
+            'atoms': [pattern],
+            'needs_backtracking': False,
+            'linear_safe': True,
+        }
+    if kind in SET_KINDS:
+        try:
+            entry = normalize_entry(kind, pattern)
+        except ValueError as exc:
+            raise PatternError(str(exc))
+        return {
+            'kind': kind,
+            'compiled_pattern': entry,
+            'prefilter': '',
+            'atoms': [],
+            'needs_backtracking': False,
+            'linear_safe': True,
+        }
+    if kind == KIND_GLOB:
+        source = glob_to_regex(pattern)
+    elif kind == KIND_REGEX:
+        source = normalize_regex(pattern)
+    else:
+        raise PatternError('Unknown pattern kind %r.' % kind)
+    prefilter, atoms, needs_backtracking, linear_safe = analyze_regex(source)
+    return {
+        'kind': kind,
+        'compiled_pattern': source,
+        'prefilter': prefilter,
+        'atoms': atoms,
+        'needs_backtracking': needs_backtracking,
+        'linear_safe': linear_safe,
+    }
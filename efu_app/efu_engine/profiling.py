@@ -0,0 +1,66 @@
+"""
+Per-request timing of the phases of a request.
+
+The profiling middleware starts a RequestProfile for each request; code
+measures a phase with the timing context manager, which does nothing
+when no profile is active.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current_profile = ContextVar('efu_request_profile', default=None)
+
+
+class RequestProfile:
+    """Accumulated durations and counters of one request."""
+
+    def __init__(self):
+        self.durations = {}
+        self.queries = 0
+        # Phases being timed, so nested timings of a phase count once.
+        self._active = set()
+
+    def add(self, name, seconds):
+        """Add seconds to the duration of a phase."""
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def execute_wrapper(self, execute, sql, params, many, context):
+        """Database execute wrapper counting and timing queries."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.add('db', time.perf_counter() - start)
+
+
+def current_profile():
+    """Return the profile of the current request or None."""
+    return _current_profile.get()
+
+
+@contextmanager
+def activate(profile):
+    """Make profile the current request profile within the block."""
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+
+
+@contextmanager
+def timing(name):
+    """Add the duration of the block to the phase name of the profile."""
+    profile = _current_profile.get()
+    if profile is None or name in profile._active:
+        yield
+        return
+    profile._active.add(name)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start)
+        profile._active.discard(name)
@@ -1,21 +1,92 @@
+from django.db import transaction
+from django.utils.translation import gettext as _
 from rest_framework import serializers
 
 from efu_auth.models import (
     Rule,
     RuleSet
 )
+from efu_engine.actions import ACTION_CHOICES
+from efu_engine.message import (
+    TARGET_HEADER,
+    TARGET_MESSAGE,
+)
+from efu_engine.patterns import (
+    PatternError,
+    analyze_pattern,
+)
+from efu_engine.profiling import timing
+from efu_engine.sets import (
+    SET_KINDS,
+    normalize_entry,
+)
+
+
+class ProfiledSerializerMixin:
+    """Time validation and representation in the request profile."""
+
+    def run_validation(self, data=serializers.empty):
+        with timing('serializer'):
+            return super().run_validation(data)
+
+    def to_representation(self, instance):
+        with timing('serializer'):
+            return super().to_representation(instance)
 
 
-class RuleSerializer(serializers.ModelSerializer):
+class RuleSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     """Serializer for rules."""
 
     class Meta:
         model = Rule
-        fields = ['id', 'name', 'pattern', 'description']
-        read_only_fields = ['id']
+        fields = [
+            'id', 'name', 'kind', 'pattern', 'description', 'target', 'header',
+            'linear_safe',
+        ]
+        read_only_fields = ['id', 'linear_safe']
+
+    def validate(self, attrs):
+        """Validate the pattern and target and reject duplicates of another rule."""
+        target = attrs.get('target', getattr(self.instance, 'target', TARGET_MESSAGE))
+        header = attrs.get('header', getattr(self.instance, 'header', ''))
+        if target == TARGET_HEADER and not header:
+            raise serializers.ValidationError({'header': _('Header rules must name a header.')})
+        if target != TARGET_HEADER and header:
+            raise serializers.ValidationError({'header': _('Only header rules name a header.')})
+        pattern = attrs.get('pattern', getattr(self.instance, 'pattern', ''))
+        kind = attrs.get('kind', getattr(self.instance, 'kind', ''))
+        if 'pattern' in attrs and 'kind' not in attrs and kind not in SET_KINDS:
+            # A new pattern sent without a kind has its kind inferred again.
+            attrs['kind'] = kind = ''
+        if (
+            self.instance is not None
+            and self.instance.kind in SET_KINDS
+            and kind != self.instance.kind
+            and self.instance.entries.exists()
+        ):
+            # Entries are only valid for the kind they were normalized for.
+            raise serializers.ValidationError({
+                'kind': _('Remove the entries of a set rule before changing its kind.'),
+            })
+        try:
+            analyze_pattern(pattern, kind)
+        except PatternError as exc:
+            raise serializers.ValidationError({'pattern': str(exc)})
+        if self.instance is not None:
+            identity = {
+                field: attrs.get(field, getattr(self.instance, field))
+                for field in Rule.IDENTITY_FIELDS
+            }
+            duplicate = Rule.objects.filter(
+                user=self.instance.user,
+                identity_hash=Rule.make_identity_hash(**identity),
+            ).exclude(pk=self.instance.pk)
+            if duplicate.exists():
+                raise serializers.ValidationError(_('An identical rule already exists.'))
+        return attrs
 
 
-class RuleSetSerializer(serializers.ModelSerializer):
+class RuleSetSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     """Serializer for recipes."""
     rules = RuleSerializer(many=True, required=False)
 
@@ -24,31 +95,125 @@ class RuleSetSerializer(serializers.ModelSerializer):
         fields = ['id', 'name', 'description', 'rules']
         read_only_fields = ['id']
 
-    def _get_or_create_rules(self, rules, ruleset):
-        """Handle getting or creating rules as needed."""
-        auth_user = self.context['request'].user
-        for rule in rules:
-            rule_obj, created = Rule.objects.get_or_create(
-                user=auth_user,
-                **rule,
+    def _rules_by_hash(self, hashes):
+        """Return the rules of the user with the given identity hashes."""
+        return {
+            rule_obj.identity_hash: rule_obj
+            for rule_obj in Rule.objects.filter(
+                user=self.context['request'].user,
+                identity_hash__in=hashes,
             )
-            ruleset.rules.add(rule_obj)
+        }
+
+    def _get_or_create_rules(self, rules):
+        """Return the rule objects for rule dicts, creating missing ones.
+
+        Existing rules are found with one probe of the identity index and
+        missing ones are inserted with one bulk_create.
+        """
+        if not rules:
+            return []
+        wanted = {}
+        for rule in rules:
+            rule_obj = Rule(user=self.context['request'].user, **rule)
+            rule_obj.set_identity_hash()
+            rule_obj.set_compiled_pattern()
+            wanted.setdefault(rule_obj.identity_hash, rule_obj)
+        existing = self._rules_by_hash(wanted)
+        missing = [obj for key, obj in wanted.items() if key not in existing]
+        if missing:
+            # Conflicts come from concurrent requests creating the same
+            # rules; the rows they inserted are read back below.
+            Rule.objects.bulk_create(missing, ignore_conflicts=True)
+            existing = self._rules_by_hash(wanted)
+        return [existing[key] for key in wanted]
 
     def create(self, validated_data):
         """Create a ruleset."""
         rules = validated_data.pop('rules', [])
-        ruleset = RuleSet.objects.create(**validated_data)
-        self._get_or_create_rules(rules, ruleset)
+        with transaction.atomic():
+            ruleset = RuleSet.objects.create(**validated_data)
+            ruleset.rules.add(*self._get_or_create_rules(rules))
         return ruleset
 
     def update(self, instance, validated_data):
-        """Update ruleset."""
-        rules = validated_data.pop('rules', [])
-        if rules is not None:
-            instance.rules.clear()
-            self._get_or_create_rules(rules, instance)
-        for attr, value in validated_data.items():
-            setattr(instance, attr, value)
-        instance.save()
+        """Update ruleset, only adding and removing the rules that changed."""
+        rules = validated_data.pop('rules', None)
+        with transaction.atomic():
+            if rules is not None:
+                wanted = self._get_or_create_rules(rules)
+                current = set(instance.rules.values_list('id', flat=True))
+                wanted_ids = {rule_obj.pk for rule_obj in wanted}
+                instance.rules.remove(*(current - wanted_ids))
+                instance.rules.add(*(r for r in wanted if r.pk not in current))
+            for attr, value in validated_data.items():
+                setattr(instance, attr, value)
+            instance.save()
         return instance
 
+
+class MessageSerializer(serializers.Serializer):
+    """Serializer for a message submitted for evaluation."""
+    headers = serializers.DictField(child=serializers.CharField(), required=False)
+    subject = serializers.CharField(required=False, allow_blank=True)
+    body = serializers.CharField(required=False, allow_blank=True)
+    html = serializers.CharField(required=False, allow_blank=True)
+    attachments = serializers.ListField(child=serializers.CharField(), required=False)
+
+
+class RuleSetMemberSerializer(serializers.Serializer):
+    """Serializer for the priority and action of a rule in a ruleset."""
+    rule = serializers.IntegerField(source='rule_id')
+    position = serializers.IntegerField(min_value=0)
+    action = serializers.ChoiceField(choices=ACTION_CHOICES)
+
+
+class EvaluationResultSerializer(serializers.Serializer):
+    """Serializer for the rules matching one evaluated message.
+
+    rules are in priority order; action is the action of the last one if
+    it ended the evaluation and null otherwise.
+    """
+    index = serializers.IntegerField()
+    rules = serializers.ListField(child=serializers.IntegerField())
+    action = serializers.ChoiceField(choices=ACTION_CHOICES, allow_null=True)
+
+
+class RuleEntriesSerializer(serializers.Serializer):
+    """Serializer for changes to the entries of a set rule."""
+    add = serializers.ListField(
+        child=serializers.CharField(max_length=255), required=False, default=list,
+    )
+    remove = serializers.ListField(
+        child=serializers.CharField(max_length=255), required=False, default=list,
+    )
+
+    def _normalized(self, values):
+        """Return the normalized entries of the rule's kind."""
+        kind = self.context['rule'].kind
+        normalized = []
+        errors = {}
+        for index, value in enumerate(values):
+            try:
+                normalized.append(normalize_entry(kind, value))
+            except ValueError as exc:
+                errors[index] = [str(exc)]
+        if errors:
+            raise serializers.ValidationError(errors)
+        return normalized
+
+    def validate_add(self, values):
+        return self._normalized(values)
+
+    def validate_remove(self, values):
+        return self._normalized(values)
+
+
+class RuleCostSerializer(serializers.Serializer):
+    """Serializer for the evaluation cost of a rule."""
+    id = serializers.IntegerField()
+    name = serializers.CharField()
+    searches = serializers.IntegerField()
+    total_ms = serializers.FloatField()
+    max_ms = serializers.FloatField()
+    timeouts = serializers.IntegerField()
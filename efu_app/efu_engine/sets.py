@@ -0,0 +1,195 @@
+"""
+Set rules: membership of the senders, domains or IP addresses of a
+message in large lists.
+
+A set rule matches when a value of its kind found in the text it reads
+is one of its entries. Addresses are looked up in a hash table, domains
+in a trie of reversed labels matching listed domains and their
+subdomains, and IP addresses in sorted arrays of merged CIDR ranges.
+"""
+import bisect
+import ipaddress
+import re
+
+KIND_DOMAIN = 'domain'
+KIND_ADDRESS = 'address'
+KIND_IP = 'ip'
+SET_KINDS = frozenset((KIND_DOMAIN, KIND_ADDRESS, KIND_IP))
+
+_LABEL = r'[a-z0-9](?:[a-z0-9-]{0,61}[a-z0-9])?'
+DOMAIN_RE = re.compile(r'(?i)(?<![\w.-])%s(?:\.%s)+' % (_LABEL, _LABEL))
+ADDRESS_RE = re.compile(
+    r"(?i)(?<![\w.+-])[\w.+'-]+@%s(?:\.%s)+" % (_LABEL, _LABEL)
+)
+IPV4_RE = re.compile(r'(?<![\d.])(?:\d{1,3}\.){3}\d{1,3}(?![\d.])')
+IPV6_RE = re.compile(r'(?i)(?<![0-9a-f:])[0-9a-f]{0,4}(?::[0-9a-f]{0,4}){2,7}(?![0-9a-f:])')
+
+# IPv4 addresses are looked up as IPv4-mapped IPv6 addresses, so both
+# families share one integer range.
+IPV4_MAPPED = 0xFFFF00000000
+
+
+def normalize_domain(value):
+    """Return the canonical form of a listed domain.
+
+    A leading '*.' or '.' is accepted since a domain always covers its
+    subdomains. Raises ValueError for an invalid domain.
+    """
+    domain = value.strip().lower().rstrip('.')
+    for prefix in ('*.', '.'):
+        if domain.startswith(prefix):
+            domain = domain[len(prefix):]
+    try:
+        domain = domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        raise ValueError('Invalid domain %r.' % value)
+    if not DOMAIN_RE.fullmatch(domain):
+        raise ValueError('Invalid domain %r.' % value)
+    return domain
+
+
+def normalize_address(value):
+    """Return the canonical form of a listed email address."""
+    address = value.strip().lower()
+    if not ADDRESS_RE.fullmatch(address):
+        raise ValueError('Invalid email address %r.' % value)
+    return address
+
+
+def normalize_network(value):
+    """Return the canonical form of a listed IP address or CIDR range."""
+    try:
+        return str(ipaddress.ip_network(value.strip(), strict=False))
+    except ValueError:
+        raise ValueError('Invalid IP address or network %r.' % value)
+
+
+NORMALIZERS = {
+    KIND_DOMAIN: normalize_domain,
+    KIND_ADDRESS: normalize_address,
+    KIND_IP: normalize_network,
+}
+
+
+def normalize_entry(kind, value):
+    """Return the canonical form of an entry of a set rule of kind."""
+    return NORMALIZERS[kind](value)
+
+
+def _ip_value(address):
+    """Return the lookup integer of an ipaddress address."""
+    if address.version == 4:
+        return int(address) + IPV4_MAPPED
+    return int(address)
+
+
+def _network_range(network):
+    """Return the first and last lookup integers of an ipaddress network."""
+    return (
+        _ip_value(network.network_address),
+        _ip_value(network.broadcast_address),
+    )
+
+
+def iter_ips(text):
+    """Yield the lookup integer of every IP address in text."""
+    for regex in (IPV4_RE, IPV6_RE):
+        for match in regex.finditer(text):
+            try:
+                yield _ip_value(ipaddress.ip_address(match.group()))
+            except ValueError:
+                continue
+
+
+class DomainTrie:
+    """Trie of domain labels from the top level down.
+
+    Looking up a domain walks its labels once and reports the values of
+    every listed domain it equals or is a subdomain of.
+    """
+    # Key of the values of a node; labels are never empty.
+    VALUES = ''
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, domain, value):
+        node = self._root
+        for label in reversed(domain.split('.')):
+            node = node.setdefault(label, {})
+        node.setdefault(self.VALUES, []).append(value)
+
+    def lookup(self, domain, found):
+        """Add the values of domain and its parent domains to found."""
+        node = self._root
+        for label in reversed(domain.split('.')):
+            node = node.get(label)
+            if node is None:
+                return
+            values = node.get(self.VALUES)
+            if values:
+                found.update(values)
+
+
+class IntervalSet:
+    """Sorted, merged integer ranges of a list of CIDR networks."""
+
+    def __init__(self, networks):
+        ranges = sorted(
+            _network_range(ipaddress.ip_network(network, strict=False))
+            for network in networks
+        )
+        self.starts = []
+        self.ends = []
+        for start, end in ranges:
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, value):
+        index = bisect.bisect_right(self.starts, value) - 1
+        return index >= 0 and value <= self.ends[index]
+
+
+class SetIndex:
+    """Every set rule of a shard indexed for lookup.
+
+    rules are RuleSpec of set kinds; the entries of a rule are its
+    source followed by its stored entries.
+    """
+
+    def __init__(self, rules):
+        self._addresses = {}
+        self._domains = None
+        self._networks = []
+        for rule in rules:
+            entries = (rule.source,) + tuple(rule.entries)
+            if rule.kind == KIND_ADDRESS:
+                for entry in entries:
+                    self._addresses.setdefault(entry, []).append(rule.id)
+            elif rule.kind == KIND_DOMAIN:
+                if self._domains is None:
+                    self._domains = DomainTrie()
+                for entry in entries:
+                    self._domains.add(entry, rule.id)
+            else:
+                self._networks.append((rule.id, IntervalSet(entries)))
+
+    def match(self, text):
+        """Return the set of ids of the rules matching text."""
+        found = set()
+        if self._addresses:
+            addresses = self._addresses
+            for match in ADDRESS_RE.finditer(text):
+                found.update(addresses.get(match.group().lower(), ()))
+        if self._domains is not None:
+            for match in DOMAIN_RE.finditer(text):
+                self._domains.lookup(match.group().lower(), found)
+        if self._networks:
+            ips = set(iter_ips(text))
+            for rule_id, intervals in self._networks:
+                if any(ip in intervals for ip in ips):
+                    found.add(rule_id)
+        return found
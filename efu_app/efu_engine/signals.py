@@ -0,0 +1,122 @@
+"""
+Signal handlers keeping RuleSet.version and the rules version of users
+in step with rulesets and rules, and the token cache in step with tokens
+and users.
+"""
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import F
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+    pre_delete,
+)
+from django.dispatch import receiver
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from efu_auth.models import (
+    Rule,
+    RuleSet,
+)
+from efu_engine.cache import (
+    ruleset_cache,
+    token_cache,
+)
+
+
+def bump_ruleset_versions(queryset):
+    """Bump the version of every ruleset in queryset."""
+    queryset.update(version=F('version') + 1, updated_at=timezone.now())
+
+
+def bump_rules_version(user_id):
+    """Bump the rules version of a user after a ruleset or rule change."""
+    get_user_model().objects.filter(pk=user_id).update(
+        rules_version=F('rules_version') + 1,
+        rules_updated_at=timezone.now(),
+    )
+
+
+def bump_rule_entries(rule):
+    """Invalidate the rulesets using a rule whose set entries were written.
+
+    Entries are written in bulk without signals, so writers call this.
+    """
+    bump_ruleset_versions(RuleSet.objects.filter(rules=rule))
+    bump_rules_version(rule.user_id)
+
+
+@receiver(post_save, sender=Rule)
+def rule_saved(sender, instance, created, raw=False, **kwargs):
+    """Invalidate the rulesets using an updated rule."""
+    if raw:
+        return
+    bump_rules_version(instance.user_id)
+    if not created:
+        bump_ruleset_versions(RuleSet.objects.filter(rules=instance))
+
+
+@receiver(pre_delete, sender=Rule)
+def rule_deleted(sender, instance, **kwargs):
+    """Invalidate the rulesets using a rule about to be deleted."""
+    bump_ruleset_versions(RuleSet.objects.filter(rules=instance))
+    bump_rules_version(instance.user_id)
+
+
+@receiver(post_save, sender=RuleSet)
+def ruleset_saved(sender, instance, raw=False, **kwargs):
+    """Invalidate the ruleset reads of the owner of a saved ruleset."""
+    if not raw:
+        bump_rules_version(instance.user_id)
+
+
+@receiver(post_delete, sender=RuleSet)
+def ruleset_deleted(sender, instance, **kwargs):
+    """Drop the cached matchers of a deleted ruleset.
+
+    Some databases reuse the id of a deleted row, which would otherwise
+    collide with the cache key of the old ruleset.
+    """
+    ruleset_cache.invalidate(instance.pk)
+    bump_rules_version(instance.user_id)
+
+
+@receiver(m2m_changed, sender=RuleSet.rules.through)
+def ruleset_rules_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Invalidate the rulesets whose set of rules changed."""
+    if action in ('post_add', 'post_remove') and not pk_set:
+        return
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    # Rules and rulesets are linked within one user only.
+    bump_rules_version(instance.user_id)
+    if not reverse:
+        bump_ruleset_versions(RuleSet.objects.filter(pk=instance.pk))
+        # Callers key caches and artifacts by the version of the instance.
+        instance.refresh_from_db(fields=['version'])
+    elif action == 'pre_clear':
+        bump_ruleset_versions(RuleSet.objects.filter(rules=instance))
+    else:
+        bump_ruleset_versions(RuleSet.objects.filter(pk__in=pk_set))
+
+
+@receiver(post_delete, sender=Token)
+def token_deleted(sender, instance, **kwargs):
+    """Drop the cached authentication of a deleted token."""
+    token_cache.invalidate(instance.key)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved(sender, instance, created, raw=False, **kwargs):
+    """Drop the cached authentication of a changed user.
+
+    This covers deactivation and keeps request.user in step with the
+    database. Bulk updates send no signal and expire with the cache TTL.
+    """
+    if created or raw:
+        return
+    token_cache.invalidate(
+        *Token.objects.filter(user_id=instance.pk).values_list('key', flat=True)
+    )
@@ -0,0 +1,105 @@
+"""
+Tests for the binary ruleset artifact.
+"""
+import os
+import tempfile
+
+from efu_engine.tests import init_test
+init_test()
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from efu_auth.models import (
+    Rule,
+    RuleSet,
+)
+from efu_engine.artifact import (
+    ArtifactError,
+    RuleSetArtifact,
+    dump_ruleset,
+    open_artifact,
+)
+from efu_engine.matcher import (
+    CompiledRuleSet,
+    make_rule_spec,
+)
+
+RULES = [
+    make_rule_spec(3, 'senior'),
+    make_rule_spec(1, r'\b(?:cash|money)-\d+'),
+    make_rule_spec(2, r'(\w)\1'),
+    make_rule_spec(4, '*@spam.com', 'glob'),
+    make_rule_spec(5, 'senior'),
+    make_rule_spec(6, r'(a+)+$'),
+    make_rule_spec(7, 'spam.com', target='header', header='From', position=2, action='reject'),
+    make_rule_spec(8, '192.0.2.0/24', 'ip', entries=('10.0.0.0/8', '2001:db8::/32')),
+]
+
+
+class ArtifactTests(SimpleTestCase):
+    """Test dumping and loading artifacts."""
+
+    def test_round_trip(self):
+        """Test the rule specs are read back unchanged and sorted by id."""
+        artifact = RuleSetArtifact(dump_ruleset(RULES, ruleset_id=7, ruleset_version=3))
+
+        self.assertEqual((artifact.ruleset_id, artifact.ruleset_version), (7, 3))
+        self.assertEqual(list(artifact.rule_specs()), sorted(RULES))
+        text = 'senior: money-12 from bob@spam.com, aa via 10.1.2.3'
+        self.assertEqual(sorted(artifact.compile().match(text)), CompiledRuleSet(RULES).match(text))
+
+    def test_strings_stored_once(self):
+        """Test a pattern shared by several rules is stored once."""
+        once = dump_ruleset([make_rule_spec(1, 'a shared pattern')])
+        twice = dump_ruleset([
+            make_rule_spec(1, 'a shared pattern'),
+            make_rule_spec(2, 'a shared pattern'),
+        ])
+
+        self.assertNotIn(b'a shared pattern' * 2, twice)
+        self.assertEqual(twice.count(b'a shared pattern'), 1)
+        self.assertGreater(len(twice), len(once))
+
+    def test_memory_mapped(self):
+        """Test an artifact file is read through a memory map."""
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'rules.efurs')
+            with open(path, 'wb') as fp:
+                fp.write(dump_ruleset(RULES))
+            with open_artifact(path) as artifact:
+                self.assertEqual(artifact.compile().match('aa senior'), [2, 3, 5])
+
+    def test_invalid_artifacts(self):
+        """Test foreign, corrupt and truncated data is rejected."""
+        data = dump_ruleset(RULES)
+        corrupt = data[:-1] + bytes([data[-1] ^ 1])
+        for invalid in [b'', b'NOTRULES' + data[8:], corrupt, data[:-1]]:
+            with self.subTest(invalid=invalid[:8]), self.assertRaises(ArtifactError):
+                RuleSetArtifact(invalid)
+
+
+class ArtifactApiTests(TestCase):
+    """Test downloading the artifact of a ruleset."""
+
+    def test_download_artifact(self):
+        """Test the artifact of a ruleset of the user is returned."""
+        user = get_user_model().objects.create_user('user@example.com', 'pass123')
+        ruleset = RuleSet.objects.create(user=user, name='Jobs')
+        rule = Rule.objects.create(user=user, name='Senior', pattern='senior')
+        ruleset.rules.add(rule)
+        client = APIClient()
+        client.force_authenticate(user)
+        url = reverse('efu_engine:ruleset-artifact', args=[ruleset.id])
+
+        res = client.get(url)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        artifact = RuleSetArtifact(res.content)
+        self.assertEqual([spec.id for spec in artifact.rule_specs()], [rule.id])
+        cached = client.get(url, HTTP_IF_NONE_MATCH=res['ETag'])
+        self.assertEqual(cached.status_code, status.HTTP_304_NOT_MODIFIED)
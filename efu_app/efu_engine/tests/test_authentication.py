@@ -0,0 +1,100 @@
+"""
+Tests for the cached token authentication.
+"""
+from efu_engine.tests import init_test
+init_test()
+
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+)
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from efu_engine.cache import (
+    TokenCache,
+    token_cache,
+)
+
+RULES_URL = reverse('efu_engine:rule-list')
+
+
+class TokenCacheTests(SimpleTestCase):
+    """Test the token cache bounds and sharing."""
+
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted."""
+        cache = TokenCache(max_entries=2, ttl=60, alias='')
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['entries'], 2)
+
+    def test_ttl_expiry(self):
+        """Test entries expire after the TTL."""
+        cache = TokenCache(max_entries=10, ttl=0, alias='')
+        cache.set('a', 1)
+
+        self.assertIsNone(cache.get('a'))
+
+    def test_shared_cache(self):
+        """Test entries are shared and invalidated through a Django cache."""
+        caches['default'].clear()
+        writer = TokenCache(max_entries=10, ttl=60, alias='default')
+        reader = TokenCache(max_entries=10, ttl=60, alias='default')
+        writer.set('a', 1)
+
+        self.assertEqual(reader.get('a'), 1)
+        reader.invalidate('a')
+        # The entry the writer cached is gone for it too.
+        self.assertIsNone(writer.get('a'))
+        self.assertEqual(writer.stats()['entries'], 0)
+
+
+class CachedTokenAuthenticationTests(TestCase):
+    """Test authenticating API requests through the token cache."""
+
+    def setUp(self):
+        token_cache.clear()
+        self.user = get_user_model().objects.create_user('user@example.com', 'pass123')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token %s' % self.token.key)
+
+    def test_repeated_token_skips_query(self):
+        """Test a cached token is authenticated without a query."""
+        self.client.get(RULES_URL)
+
+        with self.assertNumQueries(1):
+            res = self.client.get(RULES_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(token_cache.stats()['hits'], 1)
+
+    def test_deleted_token_rejected(self):
+        """Test a deleted token is no longer accepted."""
+        self.client.get(RULES_URL)
+        self.token.delete()
+
+        res = self.client.get(RULES_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_deactivated_user_rejected(self):
+        """Test the token of a deactivated user is no longer accepted."""
+        self.client.get(RULES_URL)
+        self.user.is_active = False
+        self.user.save()
+
+        res = self.client.get(RULES_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
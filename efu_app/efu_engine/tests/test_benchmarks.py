@@ -0,0 +1,37 @@
+"""
+Smoke tests keeping the benchmark suite runnable.
+"""
+from efu_engine.tests import init_test
+init_test()
+
+from django.test import TestCase
+
+from efu_engine.benchmarks import (
+    api,
+    prefilter,
+    seeded_random,
+    throughput,
+)
+from efu_engine.benchmarks.seed import seed
+
+
+class BenchmarkTests(TestCase):
+    """Test the benchmarks run on a tiny dataset."""
+
+    def test_prefilter(self):
+        """Test the prefilter benchmark agrees with naive evaluation."""
+        results = prefilter.run(rule_count=30, message_count=20)
+
+        self.assertEqual(set(results['engines']), {'naive', 'alternation', 'atoms'})
+
+    def test_api_and_throughput(self):
+        """Test the API and throughput benchmarks report their metrics."""
+        rnd = seeded_random()
+        users = seed(rnd, users=2, rulesets=2, rules=5, rules_per_ruleset=3)
+
+        latency = api.run(users[0], repeat=2, new_rules=2)
+        rates = throughput.run(users[0], rnd, rules=10, messages=20, batch=10)
+
+        self.assertEqual(latency['rulesets']['list']['runs'], 2)
+        self.assertGreater(latency['rulesets']['create']['queries'], 0)
+        self.assertGreater(rates['engine']['messages_per_second'], 0)
@@ -0,0 +1,268 @@
+"""
+Tests for the compiled ruleset cache and its invalidation.
+"""
+from efu_engine.tests import init_test
+init_test()
+
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from rest_framework import status
+from rest_framework.test import APIClient
+
+from efu_auth.models import (
+    Rule,
+    RuleSet,
+)
+from efu_engine.cache import (
+    CompiledRuleSetCache,
+    ResultCache,
+)
+from efu_engine.matcher import (
+    ShardedRuleSet,
+    make_rule_spec,
+)
+from efu_engine.message import (
+    RawMessage,
+    SubmittedMessage,
+)
+
+
+CACHE_STATS_URL = reverse('efu_engine:ruleset-cache-stats')
+
+
+def detail_url(ruleset_id):
+    """Create and return a ruleset detail URL."""
+    return reverse('efu_engine:ruleset-detail', args=[ruleset_id])
+
+
+def create_user(email='user@example.com', password='testpass123'):
+    """Create and return a user."""
+    return get_user_model().objects.create_user(email=email, password=password)
+
+
+class RuleSetVersionTests(TestCase):
+    """Test writes to rules and rulesets bump the ruleset version."""
+
+    def setUp(self):
+        self.user = create_user()
+        self.rule = Rule.objects.create(user=self.user, name='Jobs', pattern='senior')
+        self.ruleset = RuleSet.objects.create(user=self.user, name='Inbox')
+
+    def assertBumped(self, version):
+        """Assert the stored version is greater than version."""
+        self.ruleset.refresh_from_db()
+        self.assertGreater(self.ruleset.version, version)
+        return self.ruleset.version
+
+    def test_version_bumped_on_rule_changes(self):
+        """Test adding, updating, removing and deleting rules."""
+        version = self.ruleset.version
+        self.ruleset.rules.add(self.rule)
+        self.assertEqual(self.ruleset.version, version + 1)
+        version = self.assertBumped(version)
+
+        self.rule.pattern = 'junior'
+        self.rule.save()
+        version = self.assertBumped(version)
+
+        self.rule.ruleset_set.clear()
+        version = self.assertBumped(version)
+
+        self.ruleset.rules.add(self.rule)
+        self.rule.delete()
+        self.assertBumped(version)
+
+    def test_version_bumped_by_serializer_update(self):
+        """Test updating the rules through the API bumps the version."""
+        client = APIClient()
+        client.force_authenticate(self.user)
+        version = self.ruleset.version
+
+        payload = {'rules': [{'name': 'Lunch', 'pattern': 'eggs'}]}
+        res = client.patch(detail_url(self.ruleset.id), payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertBumped(version)
+
+
+class CompiledRuleSetCacheTests(TestCase):
+    """Test the compiled ruleset cache."""
+
+    def setUp(self):
+        self.user = create_user()
+        self.cache = CompiledRuleSetCache(max_entries=2, max_rules=10)
+
+    def create_ruleset(self, name, *patterns):
+        """Create and return a ruleset with one rule per pattern."""
+        ruleset = RuleSet.objects.create(user=self.user, name=name)
+        for pattern in patterns:
+            ruleset.rules.add(
+                Rule.objects.create(user=self.user, name=pattern, pattern=pattern)
+            )
+        return ruleset
+
+    def test_hit_and_miss_counters(self):
+        """Test a ruleset is compiled once per version."""
+        ruleset = self.create_ruleset('Jobs', 'senior')
+
+        first = self.cache.get(ruleset)
+        second = self.cache.get(RuleSet.objects.get(id=ruleset.id))
+
+        self.assertIs(first, second)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_stale_version_not_served(self):
+        """Test a rule update is visible on the next lookup."""
+        ruleset = self.create_ruleset('Jobs', 'senior')
+        self.assertTrue(self.cache.get(ruleset).match('senior'))
+
+        Rule.objects.filter(user=self.user).get().delete()
+        ruleset.refresh_from_db()
+
+        self.assertEqual(self.cache.get(ruleset).match('senior'), [])
+        self.assertEqual(self.cache.stats()['entries'], 1)
+
+    def test_rule_edit_recompiles_one_shard(self):
+        """Test editing a rule only recompiles the shard holding it."""
+        with override_settings(EFU_ENGINE={'RULESET_SHARD_SIZE': 2}):
+            ruleset = self.create_ruleset('Jobs', 'alpha', 'bravo', 'charlie', 'delta', 'echo')
+            self.cache.get(ruleset)
+            rule = ruleset.rules.order_by('id')[2]
+            rule.pattern = 'xray'
+            rule.save()
+            ruleset.refresh_from_db()
+
+            compiled = self.cache.get(ruleset)
+
+        self.assertEqual(self.cache.stats()['compiled_shards'], 3 + 1)
+        self.assertEqual(compiled.match('xray alpha charlie'), sorted(
+            ruleset.rules.filter(pattern__in=['alpha', 'xray']).values_list('id', flat=True)
+        ))
+
+    def test_bounded_size(self):
+        """Test least recently used entries are evicted."""
+        rulesets = [
+            self.create_ruleset('First', 'a', 'b', 'c', 'd'),
+            self.create_ruleset('Second', 'e', 'f', 'g', 'h'),
+            self.create_ruleset('Third', 'i', 'j', 'k', 'l'),
+        ]
+        for ruleset in rulesets:
+            self.cache.get(ruleset)
+
+        stats = self.cache.stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['rules'], 8)
+        self.assertEqual(stats['evictions'], 1)
+
+
+class ResultCacheTests(SimpleTestCase):
+    """Test evaluation results are cached by message fingerprint."""
+
+    def setUp(self):
+        self.compiled = ShardedRuleSet([
+            make_rule_spec(1, 'invoice', target='subject'),
+            make_rule_spec(2, 'billing@', target='header', header='From'),
+        ])
+
+    def message(self, subject, body=''):
+        return SubmittedMessage({
+            'headers': {'From': 'billing@example.com'},
+            'subject': subject,
+            'body': body,
+        })
+
+    def test_repeated_fields_hit(self):
+        """Test messages agreeing on the fields read share a result."""
+        cache = ResultCache(max_entries=10, max_bytes=10000)
+
+        first = cache.evaluate(self.compiled, self.message('Your invoice', 'one'))
+        second = cache.evaluate(self.compiled, self.message('Your invoice', 'two'))
+        other = cache.evaluate(self.compiled, self.message('Hello'))
+
+        self.assertEqual(first, ([1, 2], None))
+        self.assertEqual(second, first)
+        self.assertEqual(other, ([2], None))
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['hit_rate'], 0.3333)
+
+    def test_fields_extracted_lazily(self):
+        """Test the key does not extract fields evaluation never reaches."""
+        cache = ResultCache(max_entries=10, max_bytes=10000)
+        compiled = ShardedRuleSet([
+            make_rule_spec(1, 'invoice', target='subject', position=0, action='reject'),
+            make_rule_spec(2, 'paid', target='body', position=1),
+        ], shard_size=1)
+        raw = b'Subject: Your invoice\r\n\r\nAlready paid\r\n'
+        messages = [
+            lambda: self.message('Your invoice', 'Already paid'),
+            lambda: RawMessage(raw),
+        ]
+        for make_message in messages:
+            first = make_message()
+            second = make_message()
+            with self.subTest(message=type(first).__name__):
+                self.assertEqual(cache.evaluate(compiled, first), ([1], 'reject'))
+                self.assertEqual(first.fields_read, {'subject'})
+                self.assertEqual(cache.evaluate(compiled, second), ([1], 'reject'))
+                self.assertEqual(second.fields_read, set())
+        self.assertEqual(cache.stats()['hits'], 2)
+
+    def test_new_version_not_served(self):
+        """Test results of another compiled version are not reused."""
+        cache = ResultCache(max_entries=10, max_bytes=10000)
+        cache.evaluate(self.compiled, 'invoice')
+        recompiled = ShardedRuleSet([make_rule_spec(1, 'other')])
+
+        self.assertEqual(cache.evaluate(recompiled, 'invoice'), ([], None))
+        self.assertEqual(cache.stats()['hits'], 0)
+
+    def test_bounded_size(self):
+        """Test entries are evicted by count and by size."""
+        by_count = ResultCache(max_entries=2, max_bytes=10000)
+        by_size = ResultCache(max_entries=10, max_bytes=ResultCache.ENTRY_OVERHEAD * 2 + 40)
+        for text in ['a', 'b', 'c invoice', 'd']:
+            by_count.evaluate(self.compiled, text)
+            by_size.evaluate(self.compiled, text)
+
+        self.assertEqual(by_count.stats()['entries'], 2)
+        self.assertEqual(by_count.stats()['evictions'], 2)
+        self.assertEqual(by_size.stats()['entries'], 2)
+        self.assertLessEqual(by_size.stats()['bytes'], by_size.max_bytes)
+
+    def test_disabled(self):
+        """Test a cache without entries only evaluates."""
+        cache = ResultCache(max_entries=0, max_bytes=0)
+
+        self.assertEqual(cache.evaluate(self.compiled, 'invoice'), ([1], None))
+        self.assertEqual(cache.stats()['misses'], 0)
+
+
+class CacheStatsApiTests(TestCase):
+    """Test the cache statistics endpoint."""
+
+    def test_admin_required(self):
+        """Test only admin users can read the cache statistics."""
+        client = APIClient()
+        client.force_authenticate(create_user())
+
+        res = client.get(CACHE_STATS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_cache_stats(self):
+        """Test the counters are returned to admin users."""
+        admin = get_user_model().objects.create_superuser('admin@example.com', 'pass123')
+        client = APIClient()
+        client.force_authenticate(admin)
+
+        res = client.get(CACHE_STATS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn('hits', res.data)
+        self.assertIn('misses', res.data)
+        self.assertIn('patterns', res.data['patterns'])
+        self.assertIn('hit_rate', res.data['results'])
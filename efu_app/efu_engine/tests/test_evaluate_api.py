@@ -0,0 +1,238 @@
+"""
+Tests for the batch evaluation API.
+"""
+import json
+
+from efu_engine.tests import init_test
+init_test()
+
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.test import AsyncClient, TestCase
+
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from efu_auth.models import (
+    Rule,
+    RuleSet,
+    RuleSetRule,
+)
+from efu_engine.cache import ruleset_cache
+
+
+def evaluate_url(ruleset_id):
+    """Create and return a ruleset evaluate URL."""
+    return reverse('efu_engine:ruleset-evaluate', args=[ruleset_id])
+
+
+def evaluate_async_url(ruleset_id):
+    """Create and return a ruleset async evaluate URL."""
+    return reverse('efu_engine:ruleset-evaluate-async', args=[ruleset_id])
+
+
+def create_user(email='user@example.com', password='testpass123'):
+    """Create and return a user."""
+    return get_user_model().objects.create_user(email=email, password=password)
+
+
+class EvaluateApiTests(TestCase):
+    """Test evaluating messages against a ruleset."""
+
+    def setUp(self):
+        ruleset_cache.clear()
+        self.user = create_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.ruleset = RuleSet.objects.create(user=self.user, name='Jobs')
+        self.senior = Rule.objects.create(user=self.user, name='Senior', pattern='senior')
+        self.jason = Rule.objects.create(user=self.user, name='Jason', pattern='^From: .*jason')
+        self.ruleset.rules.add(self.senior, self.jason)
+
+    def test_evaluate_json_batch(self):
+        """Test each message of a JSON array gets its matching rules."""
+        payload = [
+            {'headers': {'From': 'jason@example.com'}, 'subject': 'senior role', 'body': ''},
+            {'subject': 'lunch', 'body': 'nothing to see'},
+            {'headers': [['From', 'a@example.com']], 'body': 'senior'},
+        ]
+
+        res = self.client.post(evaluate_url(self.ruleset.id), payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data, [
+            {'index': 0, 'rules': sorted([self.senior.id, self.jason.id]), 'action': None},
+            {'index': 1, 'rules': [], 'action': None},
+            {'index': 2, 'rules': [self.senior.id], 'action': None},
+        ])
+
+    def test_evaluate_targeted_rules(self):
+        """Test rules only match the part of the message they target."""
+        subject = Rule.objects.create(
+            user=self.user, name='Subject', pattern='invoice', target='subject',
+        )
+        sender = Rule.objects.create(
+            user=self.user, name='Sender', pattern='billing@', target='header', header='From',
+        )
+        self.ruleset.rules.add(subject, sender)
+        payload = [
+            {'headers': {'From': 'billing@example.com'}, 'subject': 'Your invoice'},
+            {'headers': {'To': 'billing@example.com'}, 'body': 'invoice attached'},
+        ]
+
+        res = self.client.post(evaluate_url(self.ruleset.id), payload, format='json')
+
+        self.assertEqual(res.data, [
+            {'index': 0, 'rules': sorted([subject.id, sender.id]), 'action': None},
+            {'index': 1, 'rules': [], 'action': None},
+        ])
+
+    def test_evaluate_stops_at_terminal_rule(self):
+        """Test rules run by priority and a terminal match ends evaluation."""
+        RuleSetRule.objects.filter(rule=self.jason).update(position=0, action='reject')
+        RuleSetRule.objects.filter(rule=self.senior).update(position=1)
+        ruleset_cache.clear()
+        payload = [
+            {'headers': {'From': 'jason@example.com'}, 'subject': 'senior role'},
+            {'subject': 'senior role'},
+        ]
+
+        res = self.client.post(evaluate_url(self.ruleset.id), payload, format='json')
+
+        self.assertEqual(res.data, [
+            {'index': 0, 'rules': [self.jason.id], 'action': 'reject'},
+            {'index': 1, 'rules': [self.senior.id], 'action': None},
+        ])
+
+    def test_evaluate_invalid_message(self):
+        """Test an invalid message is rejected."""
+        payload = [{'subject': 'ok'}, {'subject': 12}]
+
+        res = self.client.post(evaluate_url(self.ruleset.id), payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_evaluate_ndjson_stream(self):
+        """Test an NDJSON body is answered line by line."""
+        lines = [
+            json.dumps({'subject': 'senior'}),
+            '',
+            json.dumps({'body': 12}),
+            json.dumps({'headers': {'From': 'jason'}}),
+            '{broken',
+        ]
+
+        res = self.client.post(
+            evaluate_url(self.ruleset.id),
+            '\n'.join(lines),
+            content_type='application/x-ndjson',
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        results = [
+            json.loads(line)
+            for line in b''.join(res.streaming_content).decode().splitlines()
+        ]
+        self.assertEqual(results[0], {'index': 0, 'rules': [self.senior.id], 'action': None})
+        self.assertIn('error', results[1])
+        self.assertEqual(results[2], {'index': 2, 'rules': [self.jason.id], 'action': None})
+        self.assertEqual(results[3]['index'], 3)
+        self.assertIn('error', results[3])
+
+    def test_evaluate_other_users_ruleset(self):
+        """Test evaluating another user's ruleset is not found."""
+        other = RuleSet.objects.create(user=create_user('other@example.com'), name='x')
+
+        res = self.client.post(evaluate_url(other.id), [], format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AsyncEvaluateApiTests(TestCase):
+    """Test the async evaluate view."""
+
+    def setUp(self):
+        ruleset_cache.clear()
+        self.user = create_user()
+        token = Token.objects.create(user=self.user)
+        self.client = AsyncClient()
+        # AsyncClient sends extra keyword arguments as request headers.
+        self.auth = {'authorization': 'Token %s' % token.key}
+        self.ruleset = RuleSet.objects.create(user=self.user, name='Jobs')
+        self.senior = Rule.objects.create(user=self.user, name='Senior', pattern='senior')
+        self.ruleset.rules.add(self.senior)
+
+    async def test_evaluate_json_batch(self):
+        """Test a JSON array is answered with a JSON array."""
+        payload = [{'subject': 'senior role'}, {'body': 'nothing'}]
+
+        res = await self.client.post(
+            evaluate_async_url(self.ruleset.id),
+            json.dumps(payload),
+            content_type='application/json',
+            **self.auth
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.json(), [
+            {'index': 0, 'rules': [self.senior.id], 'action': None},
+            {'index': 1, 'rules': [], 'action': None},
+        ])
+
+    async def test_evaluate_ndjson(self):
+        """Test an NDJSON body is answered with NDJSON."""
+        body = '\n'.join(json.dumps({'body': body}) for body in ['senior', 'x'])
+
+        res = await self.client.post(
+            evaluate_async_url(self.ruleset.id),
+            body,
+            content_type='application/x-ndjson',
+            **self.auth
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            [json.loads(line) for line in res.content.decode().splitlines()],
+            [{'index': 0, 'rules': [self.senior.id], 'action': None}, {'index': 1, 'rules': [], 'action': None}],
+        )
+
+    async def test_evaluate_invalid_message(self):
+        """Test an invalid message is rejected."""
+        res = await self.client.post(
+            evaluate_async_url(self.ruleset.id),
+            json.dumps([{'subject': 12}]),
+            content_type='application/json',
+            **self.auth
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('0', res.json())
+
+    async def test_evaluate_requires_token(self):
+        """Test requests without a valid token are rejected."""
+        res = await AsyncClient().post(
+            evaluate_async_url(self.ruleset.id), '[]', content_type='application/json',
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(res['WWW-Authenticate'], 'Token')
+
+    async def test_evaluate_invalid_token(self):
+        """Test requests with an unknown token are challenged."""
+        res = await AsyncClient().post(
+            evaluate_async_url(self.ruleset.id), '[]', content_type='application/json',
+            authorization='Token unknown',
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(res['WWW-Authenticate'], 'Token')
+
+    async def test_evaluate_missing_ruleset(self):
+        """Test evaluating an unknown ruleset is not found."""
+        res = await self.client.post(
+            evaluate_async_url(self.ruleset.id + 1), '[]',
+            content_type='application/json', **self.auth
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
@@ -0,0 +1,335 @@
+"""
+Tests for the compiled ruleset matcher.
+"""
+from efu_engine.tests import init_test
+init_test()
+
+import re
+import time
+from unittest import skipIf
+
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from efu_auth.models import (
+    Rule,
+    RuleSet,
+)
+from efu_engine.matcher import (
+    AhoCorasick,
+    CompiledRuleSet,
+    PatternPool,
+    ShardedRuleSet,
+    ahocorasick,
+    compile_ruleset,
+    make_rule_spec,
+    re2,
+)
+from efu_engine.guard import (
+    isolated_search,
+    rule_costs,
+)
+from efu_engine.message import SubmittedMessage
+
+
+class AhoCorasickTests(SimpleTestCase):
+    """Test the literal automaton."""
+
+    def test_overlapping_keywords(self):
+        """Test overlapping and nested keywords are all reported."""
+        automaton = AhoCorasick({'he': [1], 'she': [2], 'hers': [3], 'x': [4]})
+
+        self.assertEqual(automaton.search('ushers'), {1, 2, 3})
+        self.assertEqual(automaton.search('nothing'), set())
+
+    def test_empty_keyword_always_matches(self):
+        """Test an empty keyword matches any text."""
+        automaton = AhoCorasick({'': [1], 'abc': [2]})
+
+        self.assertEqual(automaton.search(''), {1})
+        self.assertEqual(automaton.search('xabc'), {1, 2})
+
+    @skipIf(ahocorasick is None, 'pyahocorasick is not installed')
+    def test_native_matches_pure_python(self):
+        """Test the C and pure Python automatons report the same values."""
+        keywords = {'': [0], 'he': [1], 'she': [2], 'hers': [3, 4], 'x': [5]}
+        native = AhoCorasick(keywords, native=True)
+        pure = AhoCorasick(keywords, native=False)
+
+        for text in ['ushers', 'x', '', 'nothing', 'hehersx']:
+            with self.subTest(text=text):
+                self.assertEqual(native.search(text), pure.search(text))
+
+
+class PatternPoolTests(SimpleTestCase):
+    """Test compiled regexes are shared by source."""
+
+    def test_same_source_compiled_once(self):
+        """Test a source is compiled once while it is in use."""
+        pool = PatternPool()
+
+        first = pool.compile(r'spam-\d+')
+        second = pool.compile(r'spam-\d+')
+
+        self.assertIs(first, second)
+        self.assertEqual(pool.stats(), {'hits': 1, 'misses': 1, 'patterns': 1})
+
+    def test_unused_patterns_released(self):
+        """Test regexes no ruleset uses any more leave the pool."""
+        pool = PatternPool()
+        pool.compile(r'released-\d+')
+        # The re module keeps its own cache of recent regexes.
+        re.purge()
+
+        self.assertEqual(pool.stats()['patterns'], 0)
+
+    def test_rulesets_of_different_users_share_regexes(self):
+        """Test identical patterns under different rule ids are shared."""
+        first = CompiledRuleSet.from_patterns([(1, r'shared-\d+')])
+        second = CompiledRuleSet.from_patterns([(7, r'shared-\d+')])
+
+        self.assertIs(first._confirm[1], second._confirm[7])
+
+
+class CompiledRuleSetTests(SimpleTestCase):
+    """Test matching texts against compiled rules."""
+
+    def test_literal_and_regex_rules(self):
+        """Test literal and regex rules are matched in one call."""
+        compiled = CompiledRuleSet.from_patterns([
+            (1, 'senior'),
+            (2, r'subject:\s*developer'),
+            (3, '^diner$'),
+            (4, 'technology'),
+        ])
+
+        self.assertEqual(compiled.match('subject: developer, senior'), [1, 2])
+        self.assertEqual(compiled.match('diner'), [3])
+        self.assertEqual(compiled.match('nothing here'), [])
+
+    def test_shadowed_alternatives_are_reported(self):
+        """Test regex rules matching at the same position are all found."""
+        compiled = CompiledRuleSet.from_patterns([
+            (1, 'ab+'),
+            (2, 'a[b]c'),
+            (3, 'b.d'),
+            (4, '[a-z]{2}c'),
+        ])
+
+        self.assertEqual(compiled.match('xabcd'), [1, 2, 3, 4])
+
+    def test_found_rules_not_searched_again(self):
+        """Test a rule matching everywhere does not rescan the text for others."""
+        compiled = CompiledRuleSet.from_patterns([(1, r'\w'), (2, r'\d{3}-\d{4}x')])
+        text = 'a b ' * 250000
+
+        start = time.monotonic()
+        self.assertEqual(compiled.match(text), [1])
+        self.assertEqual(compiled.match(text + '555-0100x'), [1, 2])
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_backreference_rules(self):
+        """Test rules that cannot be merged are still evaluated."""
+        compiled = CompiledRuleSet.from_patterns([
+            (1, r'(\w)\1'),
+            (2, r'(?P<x>[xz])-(?P=x)'),
+            (3, '(?i)hello'),
+        ])
+
+        self.assertEqual(compiled.match('aa HELLO'), [1, 3])
+        self.assertEqual(compiled.match('z-z'), [2])
+
+    def test_atoms_prefilter(self):
+        """Test regexes are only confirmed when one of their atoms occurs."""
+        patterns = [
+            (1, r'\b(?:cash|money)-\d+\b'),
+            (2, r'(?P<tag>urgent)\.\w+'),
+            (3, r'senior\s+dev'),
+            (4, 'offer'),
+            (5, r'\d{3}-\d{4}'),
+        ]
+        compiled = CompiledRuleSet.from_patterns(patterns)
+        unfiltered = CompiledRuleSet.from_patterns(patterns, use_atoms=False)
+
+        for text in ['money-42 offer', 'cash-x', 'urgent.now', 'senior  dev 555-1234', '']:
+            with self.subTest(text=text):
+                self.assertEqual(compiled.match(text), unfiltered.match(text))
+        self.assertEqual(compiled.match('money-42 urgent.x'), [1, 2])
+        self.assertEqual(compiled.match('cash-x'), [])
+
+
+class MatchGuardTests(SimpleTestCase):
+    """Test regexes that may backtrack exponentially cannot stall matching."""
+    # Fails after trying every way to split the run of a's.
+    EVIL_TEXT = 'a' * 40 + '!'
+
+    def setUp(self):
+        rule_costs.clear()
+        self.addCleanup(isolated_search.close)
+
+    @skipIf(re2 is None, 're2 is not installed')
+    def test_risky_rule_on_linear_engine(self):
+        """Test risky regexes run on re2 when it is installed."""
+        compiled = CompiledRuleSet.from_patterns([(1, r'(a+)+$'), (2, 'hello')])
+
+        start = time.monotonic()
+        self.assertEqual(compiled.match(self.EVIL_TEXT * 100 + ' hello'), [2])
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(compiled.match('hello aaa'), [1, 2])
+        self.assertEqual(isolated_search.stats()['workers'], 0)
+
+    @skipIf(re2 is None, 're2 is not installed')
+    def test_linear_engine_matches_like_re(self):
+        """Test risky regexes on re2 match the texts re matches."""
+        patterns = [
+            r'(a+)+$', r'(a+)+\w', r'(\d+\s?)+x', r'(?i:(i+)+k)', r'(?m:(a+)+$)',
+            r'(a+)+[^a]', r'(?s:(a.)+)z', r'(\w+\s?)+\b',
+        ]
+        texts = ['aa\n', 'a\u00e9', '\u0663\u0664 x', 'I\u0130K', 'aa\nb', 'a\udcff', 'a\naz', 'ab c']
+        compiled = CompiledRuleSet.from_patterns(enumerate(patterns, 1))
+
+        for text in texts:
+            with self.subTest(text=text):
+                self.assertEqual(compiled.match(text), [
+                    rule_id for rule_id, pattern in enumerate(patterns, 1)
+                    if re.search(pattern, text)
+                ])
+        # Unicode word boundaries have no re2 equivalent.
+        self.assertEqual(list(compiled._isolated), [8])
+
+    @override_settings(EFU_ENGINE={'MATCH_RULE_TIMEOUT_MS': 200})
+    def test_risky_rule_isolated(self):
+        """Test risky regexes are searched in a worker under a time budget."""
+        compiled = CompiledRuleSet.from_patterns(
+            [(1, r'(a+)+$'), (2, 'hello')], linear_engine=False,
+        )
+
+        self.assertEqual(compiled.match('hello aaa'), [1, 2])
+        start = time.monotonic()
+        self.assertEqual(compiled.match(self.EVIL_TEXT + ' hello'), [2])
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(rule_costs.get(1)['searches'], 2)
+        self.assertEqual(rule_costs.get(1)['timeouts'], 1)
+        # The stuck worker was replaced.
+        self.assertEqual(compiled.match('aaa'), [1])
+
+    @override_settings(EFU_ENGINE={
+        'MATCH_RULE_TIMEOUT_MS': 1000,
+        'MATCH_MESSAGE_TIMEOUT_MS': 200,
+    })
+    def test_message_budget(self):
+        """Test risky regexes of one message share the message budget."""
+        compiled = CompiledRuleSet.from_patterns(
+            [(1, r'(a+)+$'), (2, r'(a|aa)+$')], linear_engine=False,
+        )
+
+        start = time.monotonic()
+        self.assertEqual(compiled.match(self.EVIL_TEXT), [])
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(rule_costs.get(1)['timeouts'], 1)
+        self.assertEqual(rule_costs.get(2)['timeouts'], 1)
+
+
+class ShardedRuleSetTests(SimpleTestCase):
+    """Test rulesets compiled in shards."""
+
+    def test_shards_match_like_one_ruleset(self):
+        """Test the shards together match like a single compiled ruleset."""
+        rules = [make_rule_spec(rule_id, pattern) for rule_id, pattern in [
+            (5, 'lunch'), (1, 'senior'), (4, r'dev(eloper)?\b'), (2, 'x+'), (3, 'lunch'),
+        ]]
+        sharded = ShardedRuleSet(rules, shard_size=2)
+
+        self.assertEqual(len(sharded.shards), 3)
+        self.assertEqual(sharded.compiled_shards, 3)
+        text = 'senior developer at lunch, xx'
+        self.assertEqual(sharded.match(text), CompiledRuleSet(rules).match(text))
+
+    def test_rules_read_their_target(self):
+        """Test rules only match the message field they target."""
+        rules = [
+            make_rule_spec(1, 'senior', target='subject'),
+            make_rule_spec(2, 'jason', target='header', header='From'),
+            make_rule_spec(3, 'senior', target='body'),
+            make_rule_spec(4, 'senior'),
+        ]
+        sharded = ShardedRuleSet(rules, shard_size=1)
+        message = SubmittedMessage({
+            'headers': {'From': 'jason@example.com', 'To': 'senior@example.com'},
+            'subject': 'Senior developer, senior role',
+        })
+
+        self.assertEqual(sharded.match(message), [1, 2, 4])
+        self.assertNotIn('html', message.fields_read)
+        # A plain text is read by every rule.
+        self.assertEqual(sharded.match('senior jason'), [1, 2, 3, 4])
+
+    def test_priority_order_and_short_circuit(self):
+        """Test evaluation stops at the first terminal match by priority."""
+        rules = [
+            make_rule_spec(1, 'offer', position=5, action='tag'),
+            make_rule_spec(2, 'casino', position=1, action='reject'),
+            make_rule_spec(3, 'free', position=0, action='tag'),
+            make_rule_spec(4, 'casino', position=2, action='accept'),
+            make_rule_spec(5, 'offer', target='body', position=9, action='reject'),
+        ]
+        sharded = ShardedRuleSet(rules, shard_size=2)
+        message = SubmittedMessage({'subject': 'free casino offer', 'body': 'offer'})
+
+        self.assertEqual(sharded.evaluate(message), ([3, 2], 'reject'))
+        # The stage holding the body rule was never reached.
+        self.assertNotIn('body', message.fields_read)
+        self.assertEqual(sharded.evaluate('free offer'), ([3, 1, 5], 'reject'))
+        self.assertEqual(sharded.evaluate('nothing'), ([], None))
+        self.assertEqual(sharded.match('an offer'), [1, 5])
+
+    def test_set_rules(self):
+        """Test set rules are matched with the other rules of their field."""
+        rules = [
+            make_rule_spec(1, 'spam.com', 'domain', target='header', header='From'),
+            make_rule_spec(2, '198.51.100.0/24', 'ip', target='header', header='Received'),
+            make_rule_spec(3, 'Casino', target='header', header='From'),
+            make_rule_spec(4, 'eve@spam.com', 'address', target='body'),
+        ]
+        sharded = ShardedRuleSet(rules)
+        message = SubmittedMessage({
+            'headers': {
+                'From': 'Casino <promo@mail.spam.com>',
+                'Received': 'from relay [198.51.100.7]',
+            },
+            'body': 'write to bob@spam.com',
+        })
+
+        self.assertEqual(sharded.match(message), [1, 2, 3])
+        self.assertEqual(sharded.entry_count, 0)
+
+    def test_only_changed_shard_recompiled(self):
+        """Test unchanged shards are reused from the previous version."""
+        rules = [make_rule_spec(rule_id, 'rule%d' % rule_id) for rule_id in range(1, 7)]
+        previous = ShardedRuleSet(rules, shard_size=2)
+        rules[2] = make_rule_spec(3, 'edited')
+
+        sharded = ShardedRuleSet(rules, shard_size=2, previous=previous)
+
+        self.assertEqual(sharded.compiled_shards, 1)
+        self.assertIs(sharded.shards[0][1], previous.shards[0][1])
+        self.assertIsNot(sharded.shards[1][1], previous.shards[1][1])
+        self.assertEqual(sharded.match('edited rule3 rule6'), [3, 6])
+
+
+class CompileRuleSetTests(TestCase):
+    """Test compiling a stored ruleset."""
+
+    def test_compile_ruleset(self):
+        """Test every rule of the ruleset is compiled."""
+        user = get_user_model().objects.create_user('user@example.com', 'pass123')
+        ruleset = RuleSet.objects.create(user=user, name='Jobs')
+        rule1 = Rule.objects.create(user=user, name='Senior', pattern='senior')
+        rule2 = Rule.objects.create(user=user, name='Dev', pattern='dev(eloper)?')
+        Rule.objects.create(user=user, name='Unused', pattern='unused')
+        ruleset.rules.add(rule1, rule2)
+
+        compiled = compile_ruleset(ruleset)
+
+        self.assertEqual(len(compiled), 2)
+        self.assertEqual(compiled.match('senior developer unused'), sorted([rule1.id, rule2.id]))
@@ -0,0 +1,82 @@
+"""
+Tests for lazily extracted message fields.
+"""
+from efu_engine.tests import init_test
+init_test()
+
+from email.message import EmailMessage
+
+from django.test import SimpleTestCase
+
+from efu_engine.message import (
+    RawMessage,
+    SubmittedMessage,
+    as_message,
+    target_field,
+)
+
+
+def make_email():
+    """Return the raw bytes of a multipart email with an attachment."""
+    msg = EmailMessage()
+    msg['From'] = 'jason@example.com'
+    msg['Subject'] = 'Senior developer'
+    msg.add_header('Received', 'from a')
+    msg.add_header('Received', 'from b')
+    msg.set_content('We are hiring.')
+    msg.add_alternative('<p>We are <b>hiring</b>.</p>', subtype='html')
+    msg.add_attachment(b'\0' * 1000, maintype='application', subtype='pdf', filename='cv.pdf')
+    return msg.as_bytes()
+
+
+class SubmittedMessageTests(SimpleTestCase):
+    """Test fields of messages submitted to the API."""
+
+    def test_fields(self):
+        """Test every field of a submitted message."""
+        msg = SubmittedMessage({
+            'headers': {'From': 'jason@example.com'},
+            'subject': 'Senior developer',
+            'body': 'We are hiring.',
+            'html': '<p>hiring</p>',
+            'attachments': ['cv.pdf', 'photo.png'],
+        })
+
+        self.assertEqual(msg.field(target_field('header', 'FROM')), 'jason@example.com')
+        self.assertEqual(msg.field('subject'), 'Senior developer')
+        self.assertEqual(msg.field('body'), 'We are hiring.')
+        self.assertEqual(msg.field('html'), '<p>hiring</p>')
+        self.assertEqual(msg.field('attachments'), 'cv.pdf\nphoto.png')
+        self.assertEqual(
+            msg.field('message'),
+            'From: jason@example.com\nSubject: Senior developer\n\nWe are hiring.',
+        )
+
+    def test_invalid_message(self):
+        """Test malformed messages are rejected up front."""
+        for data in ['text', {'body': 1}, {'attachments': 'cv.pdf'}, {'headers': 'x'}]:
+            with self.subTest(data=data), self.assertRaises(ValueError):
+                SubmittedMessage(data)
+
+
+class RawMessageTests(SimpleTestCase):
+    """Test fields of raw emails."""
+
+    def test_header_fields_skip_body(self):
+        """Test header fields never parse the MIME structure."""
+        msg = RawMessage(make_email())
+
+        self.assertEqual(msg.field('subject'), 'Senior developer')
+        self.assertEqual(msg.field(target_field('header', 'Received')), 'from a\nfrom b')
+        self.assertIsNone(msg._email)
+        self.assertEqual(msg.fields_read, {'subject', 'header:received'})
+
+    def test_body_fields(self):
+        """Test body, HTML and attachment fields are decoded."""
+        msg = as_message(make_email())
+
+        self.assertEqual(msg.field('body'), 'We are hiring.\n')
+        self.assertIn('<b>hiring</b>', msg.field('html'))
+        self.assertEqual(msg.field('attachments'), 'cv.pdf')
+        self.assertIn('Subject: Senior developer', msg.field('raw'))
+        self.assertIn('We are hiring.', msg.field('message'))
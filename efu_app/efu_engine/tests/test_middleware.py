@@ -0,0 +1,111 @@
+"""
+Tests for the request profiling middleware.
+"""
+import os
+import tempfile
+
+from efu_engine.tests import init_test
+init_test()
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.test import (
+    AsyncClient,
+    TestCase,
+    override_settings,
+)
+from django.urls import reverse
+
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from efu_auth.models import (
+    Rule,
+    RuleSet,
+)
+from efu_engine.cache import ruleset_cache
+
+RULESETS_URL = reverse('efu_engine:ruleset-list')
+
+
+class ProfilingMiddlewareTests(TestCase):
+    """Test requests are profiled when profiling is enabled."""
+
+    def setUp(self):
+        ruleset_cache.clear()
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profile_dir.cleanup)
+        self.user = get_user_model().objects.create_user('user@example.com', 'pass123')
+        self.ruleset = RuleSet.objects.create(user=self.user, name='Jobs')
+        self.ruleset.rules.add(
+            Rule.objects.create(user=self.user, name='Senior', pattern='senior')
+        )
+
+    def _client(self):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        return client
+
+    def test_server_timing_and_log(self):
+        """Test the phases of a request are reported and logged."""
+        with override_settings(EFU_ENGINE={'PROFILING': True}):
+            client = self._client()
+            with self.assertLogs('efu_engine.middleware', 'INFO') as logs:
+                res = client.get(RULESETS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        metrics = res['Server-Timing']
+        self.assertIn('total;dur=', metrics)
+        self.assertIn('serializer;dur=', metrics)
+        self.assertRegex(metrics, r'db;dur=[\d.]+;desc="\d+ queries"')
+        self.assertIn('"path": "%s"' % RULESETS_URL, logs.output[0])
+
+    def test_evaluation_time(self):
+        """Test rule evaluation is timed."""
+        with override_settings(EFU_ENGINE={'PROFILING': True}):
+            res = self._client().post(
+                reverse('efu_engine:ruleset-evaluate', args=[self.ruleset.id]),
+                [{'body': 'senior'}],
+                format='json',
+            )
+
+        self.assertIn('evaluate;dur=', res['Server-Timing'])
+
+    async def test_async_evaluation_time(self):
+        """Test async requests are profiled on the event loop."""
+        token = await sync_to_async(Token.objects.create)(user=self.user)
+        with override_settings(EFU_ENGINE={'PROFILING': True}):
+            with self.assertLogs('efu_engine.middleware', 'INFO'):
+                res = await AsyncClient().post(
+                    reverse('efu_engine:ruleset-evaluate-async', args=[self.ruleset.id]),
+                    '[{"body": "senior"}]',
+                    content_type='application/json',
+                    authorization='Token %s' % token.key,
+                )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn('total;dur=', res['Server-Timing'])
+        self.assertIn('evaluate;dur=', res['Server-Timing'])
+
+    def test_slow_request_profile_dump(self):
+        """Test the cProfile stats of a sampled slow request are written."""
+        engine = {
+            'PROFILING': True,
+            'PROFILING_DIR': self.profile_dir.name,
+            'PROFILING_SAMPLE_RATE': 1,
+            'PROFILING_SLOW_MS': 0,
+        }
+        with override_settings(EFU_ENGINE=engine):
+            self._client().get(RULESETS_URL)
+
+        dumps = os.listdir(self.profile_dir.name)
+        self.assertEqual(len(dumps), 1)
+        self.assertIn('GET-api_ruleset_rulesets', dumps[0])
+
+    def test_disabled_by_default(self):
+        """Test no timing header is sent unless profiling is enabled."""
+        with override_settings(EFU_ENGINE={}):
+            res = self._client().get(RULESETS_URL)
+
+        self.assertNotIn('Server-Timing', res)
@@ -0,0 +1,56 @@
+"""
+Tests for multi-process evaluation.
+"""
+from efu_engine.tests import init_test
+init_test()
+
+from django.test import SimpleTestCase
+
+from efu_engine.matcher import make_rule_spec
+from efu_engine.parallel import evaluate_parallel
+
+
+RULES = [
+    make_rule_spec(1, 'senior'),
+    make_rule_spec(2, r'dev(eloper)?\b'),
+    make_rule_spec(3, 'lunch'),
+]
+
+
+def make_messages(count):
+    """Return (key, message) pairs cycling over a few subjects."""
+    subjects = ['senior developer', 'lunch', 'nothing', 'dev lunch']
+    return [(i, {'subject': subjects[i % len(subjects)]}) for i in range(count)]
+
+
+class EvaluateParallelTests(SimpleTestCase):
+    """Test fanning messages out over worker processes."""
+
+    def test_ordered_results(self):
+        """Test results come back in input order."""
+        results = list(evaluate_parallel(RULES, make_messages(50), workers=2, chunk_size=3))
+
+        self.assertEqual([key for key, _ in results], list(range(50)))
+        self.assertEqual(results[0][1], [1, 2])
+        self.assertEqual(results[1][1], [3])
+        self.assertEqual(results[2][1], [])
+        self.assertEqual(results[3][1], [2, 3])
+
+    def test_unordered_results(self):
+        """Test unordered results cover every message once."""
+        results = evaluate_parallel(
+            RULES, make_messages(50), workers=2, chunk_size=4, ordered=False, max_pending=2,
+        )
+
+        self.assertEqual(
+            sorted(results),
+            list(evaluate_parallel(RULES, make_messages(50), workers=1)),
+        )
+
+    def test_raw_messages(self):
+        """Test raw email bytes are parsed in the workers."""
+        raw = b'Subject: lunch\r\n\r\nsenior\r\n'
+
+        results = list(evaluate_parallel(RULES, [('a', raw)], workers=1))
+
+        self.assertEqual(results, [('a', [1, 3])])
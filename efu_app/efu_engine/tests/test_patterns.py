@@ -0,0 +1,162 @@
+"""
+Tests for pattern analysis at write time.
+"""
+import fnmatch
+import re
+
+from efu_engine.tests import init_test
+init_test()
+
+from django.test import SimpleTestCase
+
+from efu_engine.patterns import (
+    KIND_GLOB,
+    KIND_LITERAL,
+    KIND_REGEX,
+    PatternError,
+    analyze_pattern,
+    glob_to_regex,
+    normalize_regex,
+    re2_source,
+)
+
+
+class AnalyzePatternTests(SimpleTestCase):
+    """Test patterns are validated and precompiled."""
+
+    def test_literal_inferred(self):
+        """Test a pattern without metacharacters is a literal."""
+        analyzed = analyze_pattern('subject:developer')
+
+        self.assertEqual(analyzed['kind'], KIND_LITERAL)
+        self.assertEqual(analyzed['prefilter'], 'subject:developer')
+        self.assertEqual(analyzed['compiled_pattern'], '')
+        self.assertFalse(analyzed['needs_backtracking'])
+
+    def test_regex_prefilter(self):
+        """Test the longest required literal of a regex is extracted."""
+        samples = [
+            (r'^From: .*jason', 'From: '),
+            (r'senior (developer|engineer)s?', 'senior '),
+            (r'(?:invoice)+ \d+ overdue', ' overdue'),
+            (r'a|bc', ''),
+            (r'(?i)viagra', ''),
+            (r'x?yz', 'yz'),
+        ]
+        for pattern, prefilter in samples:
+            with self.subTest(pattern=pattern):
+                analyzed = analyze_pattern(pattern)
+                self.assertEqual(analyzed['kind'], KIND_REGEX)
+                self.assertEqual(analyzed['prefilter'], prefilter)
+
+    def test_regex_atoms(self):
+        """Test a set of literals every match contains one of is extracted."""
+        samples = [
+            (r'senior (developer|engineer)s?', ['developer', 'engineer']),
+            (r'(?:invoice)+ \d+ due', ['invoice']),
+            (r'\b(?:cash|money)-\d+', ['cash', 'money']),
+            (r'ab\d+cd', []),
+            (r'(?i)viagra', []),
+            (r'(?i:prize) winner', [' winner']),
+            (r'(?:spam)? offer|deal', [' offer', 'deal']),
+            (r'(?:spam)? offer|ok', []),
+        ]
+        for pattern, atoms in samples:
+            with self.subTest(pattern=pattern):
+                self.assertEqual(analyze_pattern(pattern)['atoms'], atoms)
+        self.assertEqual(analyze_pattern('hi')['atoms'], ['hi'])
+
+    def test_needs_backtracking(self):
+        """Test back references and lookarounds are flagged."""
+        self.assertTrue(analyze_pattern(r'(\w)\1')['needs_backtracking'])
+        self.assertTrue(analyze_pattern(r'foo(?!bar)')['needs_backtracking'])
+        self.assertFalse(analyze_pattern(r'fo+[a-z]*')['needs_backtracking'])
+
+    def test_linear_safe(self):
+        """Test patterns that may backtrack catastrophically are flagged."""
+        samples = [
+            (r'(a+)+$', False),
+            (r'(\w+\s?)*:', False),
+            (r'(?:a|aa)*b', False),
+            (r'(\w)\1', False),
+            (r'(a|a){1,30}b', False),
+            (r'(.*a){12}x', False),
+            (r'\s*.*\s*.*\s*.*\s*=', False),
+            (r'\s*,?\s*;', False),
+            (r'(?i:[a-z]*[A-Z]*)x', False),
+            (r'(a?){27}a{27}', False),
+            (r'(?:\s?){40}\S', False),
+            (r'(x?y?){30}z', False),
+            (r'\d+\s+\w+', True),
+            (r'[a-z]*[A-Z]*x', True),
+            (r'^From: .*jason', True),
+            (r'(?:ab){2,5}c+', True),
+            (r'(?:a|b)c+', True),
+        ]
+        for pattern, linear_safe in samples:
+            with self.subTest(pattern=pattern):
+                self.assertEqual(analyze_pattern(pattern)['linear_safe'], linear_safe)
+        self.assertTrue(analyze_pattern('*@*', KIND_GLOB)['linear_safe'])
+        self.assertTrue(analyze_pattern('plain text')['linear_safe'])
+
+    def test_re2_source(self):
+        """Test regexes are rebuilt with the semantics of re for re2."""
+        self.assertEqual(re2_source(r'a$'), r'[\x{61}](?:\n?\z)')
+        self.assertEqual(re2_source(r'(?a)\bx'), r'\b[\x{78}]')
+        self.assertIn(r'\x{660}-\x{669}', re2_source(r'\d'))
+        for source in [r'(\w)\1', r'a(?=b)', r'a$b', r'\bx', r'(?i)\u00e9', '[\ud800-\udfff]']:
+            with self.subTest(source=source):
+                self.assertIsNone(re2_source(source))
+
+    def test_invalid_pattern(self):
+        """Test an invalid regex raises PatternError."""
+        for pattern, kind in [('(unclosed', ''), ('x{2,1}', KIND_REGEX), ('x', 'other')]:
+            with self.subTest(pattern=pattern), self.assertRaises(PatternError):
+                analyze_pattern(pattern, kind)
+
+    def test_set_kinds(self):
+        """Test the pattern of a set rule is its first, normalized entry."""
+        analyzed = analyze_pattern('*.Spam.com', 'domain')
+
+        self.assertEqual(analyzed['compiled_pattern'], 'spam.com')
+        self.assertEqual(analyzed['prefilter'], '')
+        with self.assertRaises(PatternError):
+            analyze_pattern('not an address', 'address')
+
+    def test_glob(self):
+        """Test globs are translated to regexes."""
+        analyzed = analyze_pattern('*@spam.[ce]?m', KIND_GLOB)
+        regex = re.compile(analyzed['compiled_pattern'])
+
+        self.assertEqual(analyzed['kind'], KIND_GLOB)
+        self.assertEqual(analyzed['prefilter'], '@spam.')
+        self.assertTrue(regex.search('From: bob@spam.com'))
+        self.assertFalse(regex.search('From: bob@spam.org'))
+        self.assertEqual(glob_to_regex('[!a]b'), '[^a]b')
+
+    def test_glob_matches_like_fnmatch(self):
+        """Test translated globs match the names fnmatch matches."""
+        globs = [
+            '[^a]', '[!]a]', '[]]', '[!]]', '[a-c]x', '[z-a]x', '[!z-a]', '[\\]',
+            '[a-]', '[[]', '[&&a]', '[~~]', '[', 'a[!b', '*.[ch]', '?[!.]*',
+        ]
+        names = ['a', 'b', '^', ']', '!', 'bx', 'zx', '\\', '-', '[', '&', '~', 'a[!b', 'x.c', 'ab']
+        for glob in globs:
+            regex = re.compile('(?:%s)\\Z' % glob_to_regex(glob))
+            for name in names:
+                with self.subTest(glob=glob, name=name):
+                    self.assertEqual(bool(regex.match(name)), fnmatch.fnmatchcase(name, glob))
+
+    def test_normalize_global_flags(self):
+        """Test leading global flags become a scoped group."""
+        self.assertEqual(normalize_regex('(?i)(?s)a.b'), '(?is:a.b)')
+        self.assertEqual(normalize_regex('a(?i:b)'), 'a(?i:b)')
+
+    def test_verbose_pattern_ending_in_comment(self):
+        """Test a verbose pattern ending in a comment keeps its group closed."""
+        analyzed = analyze_pattern('(?x)foo # comment')
+        regex = re.compile(analyzed['compiled_pattern'])
+
+        self.assertEqual(analyzed['compiled_pattern'], '(?x:foo # comment\n)')
+        self.assertTrue(regex.search('a foo'))
+        self.assertFalse(regex.search('f o o'))
@@ -1,13 +1,14 @@
 """
 Tests for the rules API.
 """
+import json
 from decimal import Decimal
 from efu_engine.tests import init_test
 init_test()
 
 from django.contrib.auth import get_user_model
 from django.urls import reverse
-from django.test import TestCase
+from django.test import TestCase, override_settings
 
 from unittest import skip
 from rest_framework import status
@@ -17,10 +18,15 @@ from efu_auth.models import (
     Rule,
     RuleSet,
 )
+from efu_engine.cache import ruleset_cache
+from efu_engine.guard import rule_costs
 from efu_engine.serializers import RuleSerializer
 
 
 RULES_URL = reverse('efu_engine:rule-list')
+COSTS_URL = reverse('efu_engine:rule-costs')
+IMPORT_URL = reverse('efu_engine:rule-import')
+EXPORT_URL = reverse('efu_engine:rule-export')
 
 
 def detail_url(rule_id):
@@ -28,6 +34,11 @@ def detail_url(rule_id):
     return reverse('efu_engine:rule-detail', args=[rule_id])
 
 
+def entries_url(rule_id):
+    """Create and return a rule entries url."""
+    return reverse('efu_engine:rule-entries', args=[rule_id])
+
+
 def create_user(email='user@example.com', password='testpass123'):
     """Create and return a user."""
     return get_user_model().objects.create_user(email=email, password=password)
@@ -64,7 +75,7 @@ class PrivateRulesApiTests(TestCase):
         rules = Rule.objects.all().order_by('-name')
         serializer = RuleSerializer(rules, many=True)
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(res.data, serializer.data)
+        self.assertEqual(res.data['results'], serializer.data)
 
     def test_rules_limited_to_user(self):
         """Test list of rules is limited to authenticated user."""
@@ -75,9 +86,9 @@ class PrivateRulesApiTests(TestCase):
         res = self.client.get(RULES_URL)
 
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(res.data), 1)
-        self.assertEqual(res.data[0]['name'], rule.name)
-        self.assertEqual(res.data[0]['id'], rule.id)
+        self.assertEqual(len(res.data['results']), 1)
+        self.assertEqual(res.data['results'][0]['name'], rule.name)
+        self.assertEqual(res.data['results'][0]['id'], rule.id)
 
 
     def test_update_rule(self):
@@ -118,8 +129,8 @@ class PrivateRulesApiTests(TestCase):
 
         s1 = RuleSerializer(rule1)
         s2 = RuleSerializer(rule2)
-        self.assertIn(s1.data, res.data)
-        self.assertNotIn(s2.data, res.data)
+        self.assertIn(s1.data, res.data['results'])
+        self.assertNotIn(s2.data, res.data['results'])
 
     def test_filtered_rules_unique(self):
         """Test filtered rules returns a unique list."""
@@ -138,4 +149,275 @@ class PrivateRulesApiTests(TestCase):
 
         res = self.client.get(RULES_URL, {'assigned_only': 1})
 
-        self.assertEqual(len(res.data), 1)
\ No newline at end of file
+        self.assertEqual(len(res.data['results']), 1)
+
+    def test_rules_paginated_by_cursor(self):
+        """Test rules are paginated with a stable order on equal names."""
+        for i in range(5):
+            Rule.objects.create(user=self.user, name='Same', pattern=f'p{i}')
+        Rule.objects.create(user=self.user, name='Other', pattern='o')
+
+        seen = []
+        res = self.client.get(RULES_URL, {'page_size': 2})
+        while True:
+            self.assertEqual(res.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(res.data['results']), 2)
+            seen.extend(rule['id'] for rule in res.data['results'])
+            if not res.data['next']:
+                break
+            res = self.client.get(res.data['next'])
+
+        rules = Rule.objects.filter(user=self.user).order_by('-name', '-id')
+        self.assertEqual(seen, [rule.id for rule in rules])
+
+    @override_settings(EFU_ENGINE={'MAX_PAGE_SIZE': 3})
+    def test_page_size_capped(self):
+        """Test the page size asked by the client is capped."""
+        for i in range(6):
+            Rule.objects.create(user=self.user, name=f'Rule {i}', pattern='x')
+
+        res = self.client.get(RULES_URL, {'page_size': 1000})
+
+        self.assertEqual(len(res.data['results']), 3)
+
+
+    def test_update_rule_to_duplicate_rejected(self):
+        """Test updating a rule into a copy of another rule fails."""
+        Rule.objects.create(user=self.user, name='Lunch', pattern='eggs')
+        rule = Rule.objects.create(user=self.user, name='Dinner', pattern='eggs')
+
+        res = self.client.patch(detail_url(rule.id), {'name': 'Lunch'})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_assigned_only_query_count(self):
+        """Test filtering assigned rules runs a single query."""
+        rule = Rule.objects.create(user=self.user, name='Assigned', pattern='a')
+        Rule.objects.create(user=self.user, name='Unassigned', pattern='u')
+        for name in ('First', 'Second'):
+            RuleSet.objects.create(user=self.user, name=name).rules.add(rule)
+
+        with self.assertNumQueries(1):
+            res = self.client.get(RULES_URL, {'assigned_only': 1})
+
+        self.assertEqual([r['id'] for r in res.data['results']], [rule.id])
+
+
+    def test_update_rule_invalid_pattern(self):
+        """Test an invalid pattern is rejected at write time."""
+        rule = Rule.objects.create(user=self.user, name='Lunch', pattern='eggs')
+
+        res = self.client.patch(detail_url(rule.id), {'pattern': '(eggs'})
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('pattern', res.data)
+
+    def test_update_rule_stores_compiled_pattern(self):
+        """Test a new pattern is precompiled when it is written."""
+        rule = Rule.objects.create(user=self.user, name='Lunch', pattern='eggs')
+        self.assertEqual(rule.kind, 'literal')
+
+        res = self.client.patch(detail_url(rule.id), {'pattern': r'scrambled\s+eggs'})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        rule.refresh_from_db()
+        self.assertEqual(rule.kind, 'regex')
+        self.assertEqual(rule.compiled_pattern, r'scrambled\s+eggs')
+        self.assertEqual(rule.prefilter, 'scrambled')
+
+    def test_update_rule_target(self):
+        """Test header rules must name a header and others must not."""
+        rule = Rule.objects.create(user=self.user, name='Sender', pattern='jason')
+
+        res = self.client.patch(detail_url(rule.id), {'target': 'header'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('header', res.data)
+
+        res = self.client.patch(detail_url(rule.id), {'target': 'header', 'header': 'From'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        rule.refresh_from_db()
+        self.assertEqual((rule.target, rule.header), ('header', 'From'))
+
+        res = self.client.patch(detail_url(rule.id), {'target': 'subject'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_risky_pattern_flagged(self):
+        """Test a pattern that may backtrack exponentially is reported."""
+        res = self.client.patch(
+            detail_url(Rule.objects.create(user=self.user, name='Spam', pattern='x').id),
+            {'pattern': r'(\w+\s?)+$'},
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertFalse(res.data['linear_safe'])
+
+    def test_rule_costs(self):
+        """Test the costliest rules of the user are listed."""
+        ruleset_cache.clear()
+        rule_costs.clear()
+        money = Rule.objects.create(user=self.user, name='Money', pattern=r'(?:cash|money)-\d+')
+        Rule.objects.create(user=self.user, name='Lunch', pattern='lunch')
+        ruleset = RuleSet.objects.create(user=self.user, name='Inbox')
+        ruleset.rules.set(Rule.objects.all())
+        other = create_user(email='other@example.com')
+        foreign = Rule.objects.create(user=other, name='Money', pattern=r'(?:cash|money)-\d+')
+        rule_costs.record([(foreign.id, 1.0, False)])
+
+        self.client.post(
+            reverse('efu_engine:ruleset-evaluate', args=[ruleset.id]),
+            [{'body': 'money-12 for lunch'}, {'body': 'money-x'}],
+            format='json',
+        )
+        res = self.client.get(COSTS_URL)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([cost['id'] for cost in res.data], [money.id])
+        self.assertEqual(res.data[0]['name'], 'Money')
+        self.assertEqual(res.data[0]['searches'], 2)
+        self.assertEqual(res.data[0]['timeouts'], 0)
+
+    def test_update_set_entries(self):
+        """Test entries are normalized, added and removed in bulk."""
+        ruleset_cache.clear()
+        rule = Rule.objects.create(user=self.user, name='Spam', pattern='spam.com', kind='domain')
+        ruleset = RuleSet.objects.create(user=self.user, name='Inbox')
+        ruleset.rules.add(rule)
+        ruleset.refresh_from_db()
+        version = ruleset.version
+
+        res = self.client.post(
+            entries_url(rule.id),
+            {'add': ['*.Casino.net', 'casino.net', 'lotto.org']},
+            format='json',
+        )
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data, {'count': 2, 'entries': ['casino.net', 'lotto.org']})
+        ruleset.refresh_from_db()
+        self.assertGreater(ruleset.version, version)
+        self.assertEqual(ruleset_cache.get(ruleset).match('visit www.casino.net'), [rule.id])
+
+        res = self.client.post(entries_url(rule.id), {'remove': ['LOTTO.org']}, format='json')
+        self.assertEqual(res.data['entries'], ['casino.net'])
+        res = self.client.get(entries_url(rule.id))
+        self.assertEqual(res.data['count'], 1)
+
+    def test_set_rule_kind_change_rejected(self):
+        """Test the kind of a set rule with entries cannot change."""
+        ruleset_cache.clear()
+        rule = Rule.objects.create(user=self.user, name='Spam', pattern='spam.com', kind='domain')
+        rule.entries.create(value='spam.org')
+        ruleset = RuleSet.objects.create(user=self.user, name='Inbox')
+        ruleset.rules.add(rule)
+
+        for payload in [{'kind': 'ip', 'pattern': '10.0.0.0/8'}, {'kind': 'address'}]:
+            with self.subTest(payload=payload):
+                res = self.client.patch(detail_url(rule.id), payload, format='json')
+                self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+                self.assertIn('kind', res.data)
+
+        res = self.client.patch(detail_url(rule.id), {'pattern': 'casino.net'}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['kind'], 'domain')
+        ruleset.refresh_from_db()
+        self.assertEqual(ruleset_cache.get(ruleset).match('mail.spam.org'), [rule.id])
+
+        rule.entries.all().delete()
+        res = self.client.patch(detail_url(rule.id), {'kind': 'ip', 'pattern': '10.0.0.0/8'})
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_invalid_set_entries_rejected(self):
+        """Test invalid entries and entries of pattern rules are rejected."""
+        rule = Rule.objects.create(user=self.user, name='Spam', pattern='10.0.0.0/8', kind='ip')
+        pattern = Rule.objects.create(user=self.user, name='Lunch', pattern='eggs')
+
+        res = self.client.post(entries_url(rule.id), {'add': ['10.0.0.1', 'nope']}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('add', res.data)
+        self.assertFalse(rule.entries.exists())
+
+        res = self.client.post(entries_url(pattern.id), {'add': ['10.0.0.1']}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_import_rules_ndjson(self):
+        """Test rules are created in batches, skipping existing ones."""
+        Rule.objects.create(user=self.user, name='Lunch', pattern='eggs')
+        lines = [
+            {'name': 'Lunch', 'pattern': 'eggs'},
+            {'name': 'Dev', 'pattern': r'dev(eloper)?\b', 'target': 'subject'},
+            {'name': 'Spam', 'pattern': 'spam.com', 'kind': 'domain', 'entries': ['*.Casino.net']},
+            {'name': 'Dev', 'pattern': r'dev(eloper)?\b', 'target': 'subject'},
+        ]
+        body = '\n'.join(json.dumps(line) for line in lines)
+
+        with override_settings(EFU_ENGINE={'IMPORT_BATCH_SIZE': 2}):
+            res = self.client.post(IMPORT_URL, body, content_type='application/x-ndjson')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data, {'rows': 4, 'created': 2, 'duplicates': 2})
+        dev = Rule.objects.get(name='Dev')
+        self.assertEqual((dev.kind, dev.target), ('regex', 'subject'))
+        spam = Rule.objects.get(name='Spam')
+        self.assertEqual(list(spam.entries.values_list('value', flat=True)), ['casino.net'])
+
+    def test_import_duplicate_rows(self):
+        """Test rows identical to existing rules or rows count as duplicates."""
+        body = 'name,pattern\nLunch,eggs\nDinner,soup\nLunch,eggs\n'
+
+        with override_settings(EFU_ENGINE={'IMPORT_BATCH_SIZE': 1}):
+            first = self.client.post(IMPORT_URL, body, content_type='text/csv')
+            second = self.client.post(IMPORT_URL, body, content_type='text/csv')
+
+        self.assertEqual(first.data, {'rows': 3, 'created': 2, 'duplicates': 1})
+        self.assertEqual(second.data, {'rows': 3, 'created': 0, 'duplicates': 3})
+        self.assertEqual(Rule.objects.filter(user=self.user).count(), 2)
+
+    def test_import_rule_of_other_kind(self):
+        """Test a row differing from an existing rule in kind is created."""
+        Rule.objects.create(user=self.user, name='Lunch', pattern='eggs')
+        body = 'name,pattern,kind\nLunch,eggs,\nLunch,eggs,regex\n'
+
+        res = self.client.post(IMPORT_URL, body, content_type='text/csv')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data, {'rows': 2, 'created': 1, 'duplicates': 1})
+        kinds = Rule.objects.filter(name='Lunch').values_list('kind', flat=True)
+        self.assertEqual(sorted(kinds), ['literal', 'regex'])
+
+    def test_import_invalid_row_rolled_back(self):
+        """Test an invalid row leaves every rule of the import out."""
+        body = 'name,pattern\nLunch,eggs\nBroken,(eggs\n'
+
+        res = self.client.post(IMPORT_URL, body, content_type='text/csv')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(res.data['row'], 2)
+        self.assertIn('pattern', res.data['errors'])
+        self.assertFalse(Rule.objects.exists())
+
+    def test_export_rules_round_trip(self):
+        """Test exported rules import back identically for another user."""
+        Rule.objects.create(user=self.user, name='Lunch', pattern='eggs', description='a, "b"')
+        spam = Rule.objects.create(user=self.user, name='Spam', pattern='spam.com', kind='domain')
+        spam.entries.create(value='casino.net')
+        Rule.objects.create(user=create_user('other@example.com'), name='Other', pattern='x')
+        other = APIClient()
+        other.force_authenticate(create_user('copy@example.com'))
+
+        for file_format, content_type in [('jsonl', 'application/x-ndjson'), ('csv', 'text/csv')]:
+            with self.subTest(file_format=file_format):
+                res = self.client.get(EXPORT_URL, {'type': file_format})
+                self.assertEqual(res.status_code, status.HTTP_200_OK)
+                body = b''.join(res.streaming_content)
+
+                res = other.post(IMPORT_URL, body, content_type=content_type)
+
+                self.assertEqual(res.data['rows'], 2)
+                copied = Rule.objects.filter(user__email='copy@example.com')
+                self.assertEqual(
+                    sorted(copied.values_list('name', 'description', 'kind')),
+                    [('Lunch', 'a, "b"', 'literal'), ('Spam', '', 'domain')],
+                )
+                self.assertTrue(copied.get(name='Spam').entries.filter(value='casino.net').exists())
+
+        res = self.client.get(EXPORT_URL, {'type': 'xml'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
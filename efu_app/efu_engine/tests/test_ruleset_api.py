@@ -4,7 +4,9 @@ import os
 
 from django.contrib.auth import get_user_model
 from django.urls import reverse
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from unittest import skip
 from rest_framework import status
@@ -36,6 +38,11 @@ def detail_url(ruleset_id):
     return reverse('efu_engine:ruleset-detail', args=[ruleset_id]
 )
 
+def members_url(ruleset_id):
+    """Create and return the members URL of a ruleset."""
+    return reverse('efu_engine:ruleset-members', args=[ruleset_id])
+
+
 def create_ruleset(user, **params):
     """Create and return a sample ruleset."""
     defaults = {
@@ -82,7 +89,7 @@ class PrivateRuleSetApiTests(TestCase):
         rulesets = RuleSet.objects.all().order_by('-id')
         serializer = RuleSetSerializer(rulesets, many=True)
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(res.data, serializer.data)
+        self.assertEqual(res.data['results'], serializer.data)
 
     def test_ruleset_list_limited_to_user(self):
         """Test list of rulesets is limited to authenticated user."""
@@ -95,7 +102,7 @@ class PrivateRuleSetApiTests(TestCase):
         rulesets = RuleSet.objects.filter(user=self.user)
         serializer = RuleSetSerializer(rulesets, many=True)
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(res.data, serializer.data)
+        self.assertEqual(res.data['results'], serializer.data)
 
     def test_get_ruleset_detail(self):
         """Test get ruleset detail."""
@@ -234,6 +241,20 @@ class PrivateRuleSetApiTests(TestCase):
             ).exists()
             self.assertTrue(exists)
 
+    def test_create_ruleset_rule_of_other_kind(self):
+        """Test a rule differing from an existing one in kind is created."""
+        literal = Rule.objects.create(user=self.user, name='x', pattern='a.c', kind='literal')
+        payload = {
+            'name': 'Kinds',
+            'rules': [{'name': 'x', 'pattern': 'a.c', 'kind': 'regex'}],
+        }
+        res = self.client.post(RULESET_URL, payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        rule = RuleSet.objects.get(id=res.data['id']).rules.get()
+        self.assertNotEqual(rule.id, literal.id)
+        self.assertEqual(rule.kind, 'regex')
+
     def test_create_rule_on_update(self):
         """Test create rule when updating a ruleset."""
         ruleset = create_ruleset(user=self.user)
@@ -291,7 +312,195 @@ class PrivateRuleSetApiTests(TestCase):
         s1 = RuleSetSerializer(r1)
         s2 = RuleSetSerializer(r2)
         s3 = RuleSetSerializer(r3)
-        self.assertIn(s1.data, res.data)
-        self.assertIn(s2.data, res.data)
-        self.assertNotIn(s3.data, res.data)
+        self.assertIn(s1.data, res.data['results'])
+        self.assertIn(s2.data, res.data['results'])
+        self.assertNotIn(s3.data, res.data['results'])
+
+
+    def test_list_query_count(self):
+        """Test listing rulesets runs a fixed number of queries."""
+        for i in range(5):
+            ruleset = create_ruleset(user=self.user, name=f'Ruleset {i}')
+            for j in range(3):
+                ruleset.rules.add(
+                    Rule.objects.create(user=self.user, name=f'Rule {i} {j}', pattern='x')
+                )
+
+        rule_id = ruleset.rules.first().id
+
+        # Rules version of the user, rulesets and their prefetched rules.
+        with self.assertNumQueries(3):
+            res = self.client.get(RULESET_URL)
+        with self.assertNumQueries(3):
+            self.client.get(RULESET_URL, {'rules': f'{rule_id}'})
+
+        self.assertEqual(len(res.data['results']), 5)
+        self.assertEqual(len(res.data['results'][0]['rules']), 3)
+
+    def test_retrieve_query_count(self):
+        """Test retrieving a ruleset runs a fixed number of queries."""
+        ruleset = create_ruleset(user=self.user)
+        ruleset.rules.add(
+            Rule.objects.create(user=self.user, name='First', pattern='x'),
+            Rule.objects.create(user=self.user, name='Second', pattern='y'),
+        )
+
+        with self.assertNumQueries(3):
+            res = self.client.get(detail_url(ruleset.id))
+
+        self.assertEqual(len(res.data['rules']), 2)
+
+    def test_list_not_modified(self):
+        """Test a current ETag is answered with 304 and no ruleset query."""
+        ruleset = create_ruleset(user=self.user)
+        ruleset.rules.add(Rule.objects.create(user=self.user, name='First', pattern='x'))
+        res = self.client.get(RULESET_URL)
+        etag = res['ETag']
+
+        with self.assertNumQueries(1):
+            cached = self.client.get(RULESET_URL, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(cached.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertIn('Last-Modified', res)
+        other_page = self.client.get(RULESET_URL, {'page_size': 1}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(other_page.status_code, status.HTTP_200_OK)
+
+    def test_etag_changes_with_rules(self):
+        """Test changing a rule of a ruleset invalidates its ETag."""
+        ruleset = create_ruleset(user=self.user)
+        rule = Rule.objects.create(user=self.user, name='First', pattern='x')
+        ruleset.rules.add(rule)
+        url = detail_url(ruleset.id)
+        etag = self.client.get(url)['ETag']
+
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code,
+            status.HTTP_304_NOT_MODIFIED,
+        )
+        rule.pattern = 'y'
+        rule.save()
+        res = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(res['ETag'], etag)
+        self.assertEqual(res.data['rules'][0]['pattern'], 'y')
+
+    def test_create_query_count_independent_of_rules(self):
+        """Test creating a ruleset does not run queries per rule."""
+        def create(count, name):
+            payload = {
+                'name': name,
+                'rules': [{'name': f'{name} {i}', 'pattern': f'p{i}'} for i in range(count)],
+            }
+            with CaptureQueriesContext(connection) as queries:
+                res = self.client.post(RULESET_URL, payload, format='json')
+            self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(len(res.data['rules']), count)
+            return len(queries)
+
+        self.assertEqual(create(3, 'small'), create(60, 'large'))
+
+    def test_update_rules_diff(self):
+        """Test updating rules keeps unchanged rules and replaces the rest."""
+        kept = Rule.objects.create(user=self.user, name='Kept', pattern='k')
+        dropped = Rule.objects.create(user=self.user, name='Dropped', pattern='d')
+        ruleset = create_ruleset(user=self.user)
+        ruleset.rules.add(kept, dropped)
 
+        payload = {'rules': [
+            {'name': 'Kept', 'pattern': 'k'},
+            {'name': 'New', 'pattern': 'n'},
+            {'name': 'New', 'pattern': 'n'},
+        ]}
+        res = self.client.patch(detail_url(ruleset.id), payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(
+            sorted(ruleset.rules.values_list('name', flat=True)), ['Kept', 'New'],
+        )
+        self.assertTrue(Rule.objects.filter(id=dropped.id).exists())
+
+    def test_partial_update_keeps_rules(self):
+        """Test a partial update without rules leaves them untouched."""
+        rule = Rule.objects.create(user=self.user, name='Kept', pattern='k')
+        ruleset = create_ruleset(user=self.user)
+        ruleset.rules.add(rule)
+
+        res = self.client.patch(detail_url(ruleset.id), {'name': 'Renamed'})
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertIn(rule, ruleset.rules.all())
+
+    def test_create_ruleset_invalid_rule_pattern(self):
+        """Test a ruleset with an invalid rule pattern is rejected."""
+        payload = {'name': 'Broken', 'rules': [{'name': 'Bad', 'pattern': '[a-'}]}
+
+        res = self.client.post(RULESET_URL, payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(RuleSet.objects.filter(user=self.user).exists())
+
+    def test_create_ruleset_rules_precompiled(self):
+        """Test rules created in bulk get their precompiled form."""
+        payload = {'name': 'Globs', 'rules': [{'name': 'Spam', 'kind': 'glob', 'pattern': '*@spam.com'}]}
+
+        res = self.client.post(RULESET_URL, payload, format='json')
+
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        rule = Rule.objects.get(user=self.user, name='Spam')
+        self.assertEqual(rule.kind, 'glob')
+        self.assertEqual(rule.prefilter, '@spam.com')
+
+    def test_list_members(self):
+        """Test members are listed in priority order with their action."""
+        first = Rule.objects.create(user=self.user, name='First', pattern='f')
+        second = Rule.objects.create(user=self.user, name='Second', pattern='s')
+        ruleset = create_ruleset(user=self.user)
+        ruleset.rules.add(second, first)
+
+        res = self.client.get(members_url(ruleset.id))
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data, [
+            {'rule': first.id, 'position': 0, 'action': 'tag'},
+            {'rule': second.id, 'position': 0, 'action': 'tag'},
+        ])
+
+    def test_update_members(self):
+        """Test changing members bumps the ruleset version."""
+        first = Rule.objects.create(user=self.user, name='First', pattern='f')
+        second = Rule.objects.create(user=self.user, name='Second', pattern='s')
+        ruleset = create_ruleset(user=self.user)
+        ruleset.rules.add(first, second)
+        version = RuleSet.objects.get(pk=ruleset.pk).version
+
+        res = self.client.patch(
+            members_url(ruleset.id),
+            [{'rule': first.id, 'position': 10, 'action': 'reject'}],
+            format='json',
+        )
+
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([member['rule'] for member in res.data], [second.id, first.id])
+        self.assertEqual(res.data[1]['action'], 'reject')
+        self.assertEqual(RuleSet.objects.get(pk=ruleset.pk).version, version + 1)
+
+    def test_update_members_rejects_other_rules(self):
+        """Test only rules of the ruleset can be changed."""
+        rule = Rule.objects.create(user=self.user, name='Outside', pattern='o')
+        ruleset = create_ruleset(user=self.user)
+
+        res = self.client.patch(
+            members_url(ruleset.id),
+            [{'rule': rule.id, 'position': 1, 'action': 'bogus'}],
+            format='json',
+        )
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+        res = self.client.patch(
+            members_url(ruleset.id),
+            [{'rule': rule.id, 'position': 1, 'action': 'stop'}],
+            format='json',
+        )
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('rule', res.data)
@@ -0,0 +1,82 @@
+"""
+Tests for domain, address and IP set rules.
+"""
+from efu_engine.tests import init_test
+init_test()
+
+from django.test import SimpleTestCase
+
+from efu_engine.matcher import make_rule_spec
+from efu_engine.sets import (
+    DomainTrie,
+    IntervalSet,
+    SetIndex,
+    iter_ips,
+    normalize_entry,
+)
+
+
+class NormalizeTests(SimpleTestCase):
+    """Test entries are stored in one canonical form."""
+
+    def test_normalize_entries(self):
+        """Test equivalent spellings normalize to the same entry."""
+        for kind, value, expected in [
+            ('domain', '*.Example.COM.', 'example.com'),
+            ('domain', '.bücher.de', 'xn--bcher-kva.de'),
+            ('address', ' Bob@Example.com ', 'bob@example.com'),
+            ('ip', '10.1.2.3/8', '10.0.0.0/8'),
+            ('ip', '2001:DB8::1', '2001:db8::1/128'),
+        ]:
+            with self.subTest(value=value):
+                self.assertEqual(normalize_entry(kind, value), expected)
+
+    def test_invalid_entries(self):
+        """Test invalid entries raise ValueError."""
+        for kind, value in [('domain', 'localhost'), ('address', 'bob'), ('ip', '10.0.0.300')]:
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                normalize_entry(kind, value)
+
+
+class SetIndexTests(SimpleTestCase):
+    """Test looking up the values of a text in the set indexes."""
+
+    def test_domain_trie_matches_subdomains(self):
+        """Test a listed domain covers its subdomains only."""
+        trie = DomainTrie()
+        trie.add('spam.com', 1)
+        trie.add('mail.spam.com', 2)
+        found = set()
+
+        trie.lookup('a.mail.spam.com', found)
+        self.assertEqual(found, {1, 2})
+        found.clear()
+        trie.lookup('notspam.com', found)
+        self.assertEqual(found, set())
+
+    def test_interval_set_merges_ranges(self):
+        """Test overlapping and adjacent networks are merged."""
+        intervals = IntervalSet(['10.0.0.0/24', '10.0.1.0/24', '10.0.0.128/25', '::1/128'])
+        ips = dict(zip(['10.0.1.255', '10.0.2.0', '::1', '::ffff:10.0.0.5'], iter_ips(
+            '10.0.1.255 10.0.2.0 ::1 ::ffff:10.0.0.5'
+        )))
+
+        self.assertEqual(len(intervals.starts), 2)
+        self.assertIn(ips['10.0.1.255'], intervals)
+        self.assertNotIn(ips['10.0.2.0'], intervals)
+        self.assertIn(ips['::1'], intervals)
+        # IPv4-mapped addresses are the same addresses.
+        self.assertIn(ips['::ffff:10.0.0.5'], intervals)
+
+    def test_set_index(self):
+        """Test every set rule whose entries occur in a text is reported."""
+        index = SetIndex([
+            make_rule_spec(1, 'spam.com', 'domain', entries=('casino.net',)),
+            make_rule_spec(2, 'bob@example.com', 'address'),
+            make_rule_spec(3, '192.0.2.0/24', 'ip', entries=('2001:db8::/32',)),
+            make_rule_spec(4, 'example.com', 'domain'),
+        ])
+
+        self.assertEqual(index.match('From: Bob@Example.com via 192.0.2.17'), {2, 3, 4})
+        self.assertEqual(index.match('see www.casino.net or [2001:db8::5]'), {1, 3})
+        self.assertEqual(index.match('alice@other.org 192.0.3.1'), set())
@@ -0,0 +1,218 @@
+"""
+Bulk import and export of the rules of a user as JSONL or CSV.
+
+Imports consume a stream of rows, validate them one at a time and insert
+them with bulk_create in batches, all in one transaction. Exports read
+the rules with a server side cursor and yield the file in chunks.
+"""
+import csv
+import io
+import json
+
+from django.db import transaction
+
+from efu_auth.models import (
+    Rule,
+    RuleEntry,
+    RuleSet,
+)
+from efu_engine.conf import engine_setting
+from efu_engine.serializers import RuleSerializer
+from efu_engine.sets import (
+    SET_KINDS,
+    normalize_entry,
+)
+from efu_engine.signals import (
+    bump_rules_version,
+    bump_ruleset_versions,
+)
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_CSV = 'csv'
+FORMATS = (FORMAT_JSONL, FORMAT_CSV)
+
+# Columns of a file. The entries of set rules are a list in JSONL and
+# separated by spaces in CSV.
+FIELDS = ('name', 'kind', 'pattern', 'description', 'target', 'header', 'entries')
+
+
+class RuleImportError(Exception):
+    """Raised for an invalid row of an import; row counts from 1."""
+
+    def __init__(self, row, errors):
+        super().__init__('Row %d: %s' % (row, errors))
+        self.row = row
+        self.errors = errors
+
+
+def read_jsonl(lines):
+    """Yield the object of every non blank JSONL line.
+
+    Raises ValueError for a line that is not valid JSON.
+    """
+    for lineno, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            raise ValueError('Line %d: %s' % (lineno, exc))
+
+
+def read_csv(lines):
+    """Yield a rule dict for every record of CSV lines with a header row.
+
+    Empty cells are left out so their fields take their default. Raises
+    ValueError for malformed CSV.
+    """
+    reader = csv.DictReader(lines)
+    try:
+        for row in reader:
+            if None in row:
+                raise ValueError('Line %d has more cells than the header.' % reader.line_num)
+            row = {field: value for field, value in row.items() if value}
+            if 'entries' in row:
+                row['entries'] = row['entries'].split()
+            yield row
+    except csv.Error as exc:
+        raise ValueError('Line %d: %s' % (reader.line_num, exc))
+
+
+def _validated_rule(user, row_number, row):
+    """Return the unsaved rule of a row and its normalized entries."""
+    if not isinstance(row, dict):
+        raise RuleImportError(row_number, 'Expected an object.')
+    row = dict(row)
+    entries = row.pop('entries', None) or []
+    serializer = RuleSerializer(data=row)
+    if not serializer.is_valid():
+        raise RuleImportError(row_number, serializer.errors)
+    rule = Rule(user=user, **serializer.validated_data)
+    rule.set_identity_hash()
+    rule.set_compiled_pattern()
+    if entries:
+        if rule.kind not in SET_KINDS:
+            raise RuleImportError(row_number, {'entries': ['Only set rules have entries.']})
+        if not isinstance(entries, list):
+            raise RuleImportError(row_number, {'entries': ['Expected a list of entries.']})
+        try:
+            entries = [normalize_entry(rule.kind, str(value)) for value in entries]
+        except ValueError as exc:
+            raise RuleImportError(row_number, {'entries': [str(exc)]})
+    return rule, entries
+
+
+def _write_batch(user, batch):
+    """Insert the rules of a batch that do not exist yet and their entries.
+
+    batch maps identity hashes to (rule, entries). Returns the number of
+    rules created.
+    """
+    rules = Rule.objects.filter(user=user, identity_hash__in=batch)
+    existing = set(rules.values_list('identity_hash', flat=True))
+    # Conflicts come from concurrent writers creating the same rules.
+    Rule.objects.bulk_create(
+        [rule for key, (rule, entries) in batch.items() if key not in existing],
+        ignore_conflicts=True,
+    )
+    # Rules a concurrent writer inserted meanwhile count as created.
+    ids = dict(rules.values_list('identity_hash', 'id'))
+    created = set(ids) - existing
+    with_entries = {key: entries for key, (rule, entries) in batch.items() if entries}
+    if with_entries:
+        RuleEntry.objects.bulk_create(
+            [
+                RuleEntry(rule_id=ids[key], value=value)
+                for key, entries in with_entries.items() for value in entries
+            ],
+            batch_size=len(batch),
+            ignore_conflicts=True,
+        )
+        # Rules created above are in no ruleset yet.
+        updated = [ids[key] for key in with_entries if key in existing]
+        if updated:
+            bump_ruleset_versions(RuleSet.objects.filter(rules__in=updated))
+    return len(created)
+
+
+def load_rules(user, rows, batch_size=None):
+    """Create the rules of rows for user and return the counts.
+
+    rows is an iterable of rule dicts consumed once. A row identical to a
+    rule of the user or to an earlier row creates nothing, though its
+    entries are added to that rule; such rows count as duplicates.
+    Raises RuleImportError for the first invalid row, leaving the rules
+    of the user unchanged.
+    """
+    batch_size = batch_size or engine_setting('IMPORT_BATCH_SIZE')
+    counts = {'rows': 0, 'created': 0}
+    with transaction.atomic():
+        batch = {}
+        for number, row in enumerate(rows, 1):
+            rule, entries = _validated_rule(user, number, row)
+            counts['rows'] = number
+            batch.setdefault(rule.identity_hash, (rule, []))[1].extend(entries)
+            if len(batch) >= batch_size:
+                counts['created'] += _write_batch(user, batch)
+                batch = {}
+        if batch:
+            counts['created'] += _write_batch(user, batch)
+        if counts['rows']:
+            bump_rules_version(user.pk)
+    counts['duplicates'] = counts['rows'] - counts['created']
+    return counts
+
+
+def _rule_chunks(queryset, chunk_size):
+    """Yield lists of up to chunk_size rule dicts of queryset with entries.
+
+    The entries of the set rules of a chunk are read with one query.
+    """
+    rows = queryset.values('id', *FIELDS[:-1]).iterator(chunk_size=chunk_size)
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) < chunk_size:
+            continue
+        yield _with_entries(chunk)
+        chunk = []
+    if chunk:
+        yield _with_entries(chunk)
+
+
+def _with_entries(chunk):
+    set_ids = [row['id'] for row in chunk if row['kind'] in SET_KINDS]
+    entries = {}
+    if set_ids:
+        values = RuleEntry.objects.filter(rule_id__in=set_ids).order_by('value')
+        for rule_id, value in values.values_list('rule_id', 'value'):
+            entries.setdefault(rule_id, []).append(value)
+    for row in chunk:
+        row['entries'] = entries.get(row.pop('id'), [])
+    return chunk
+
+
+def dump_rules(queryset, file_format, chunk_size=None):
+    """Yield the rules of queryset as JSONL or CSV text.
+
+    Each yielded string holds up to chunk_size rules, the first CSV
+    string also the header row.
+    """
+    chunk_size = chunk_size or engine_setting('EXPORT_CHUNK_SIZE')
+    buffer = io.StringIO()
+    if file_format == FORMAT_CSV:
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(FIELDS)
+    for chunk in _rule_chunks(queryset, chunk_size):
+        for row in chunk:
+            if file_format == FORMAT_CSV:
+                row['entries'] = ' '.join(row['entries'])
+                writer.writerow([row[field] for field in FIELDS])
+            else:
+                buffer.write(json.dumps(row) + '\n')
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
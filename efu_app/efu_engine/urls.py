@@ -14,5 +14,10 @@ app_name = 'efu_engine'
 
 # register default for the 'recipe' router
 urlpatterns = [
+    path(
+        'rulesets/<int:pk>/evaluate-async/',
+        views.evaluate_async,
+        name='ruleset-evaluate-async',
+    ),
     path('', include(router.urls)),
 ]
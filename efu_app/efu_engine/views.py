@@ -1,4 +1,29 @@
-from django.shortcuts import render
+import asyncio
+import contextvars
+import hashlib
+import io
+import json
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import (
+    Exists,
+    OuterRef,
+)
+from django.http import (
+    Http404,
+    HttpResponse,
+    HttpResponseNotAllowed,
+    JsonResponse,
+    StreamingHttpResponse,
+)
+from django.shortcuts import (
+    get_object_or_404,
+    render,
+)
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from drf_spectacular.utils import (
     extend_schema_view,
     extend_schema,
@@ -13,15 +38,141 @@ from rest_framework import (
     status,
 )
 from rest_framework.decorators import action
+from rest_framework.exceptions import (
+    APIException,
+    AuthenticationFailed,
+    NotAuthenticated,
+    ParseError,
+    UnsupportedMediaType,
+    ValidationError,
+)
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import (
+    IsAdminUser,
+    IsAuthenticated,
+)
 
 from efu_auth.models import (
     Rule,
-    RuleSet
+    RuleEntry,
+    RuleSet,
+    RuleSetRule,
 )
 from efu_engine import serializers
+from efu_engine.artifact import (
+    CONTENT_TYPE as ARTIFACT_CONTENT_TYPE,
+    dump_stored_ruleset,
+)
+from efu_engine.authentication import CachedTokenAuthentication
+from efu_engine.cache import (
+    get_compiled_ruleset,
+    result_cache,
+    ruleset_cache,
+)
+from efu_engine.conf import engine_setting
+from efu_engine.guard import (
+    isolated_search,
+    rule_costs,
+)
+from efu_engine.matcher import pattern_pool
+from efu_engine.message import SubmittedMessage
+from efu_engine.pagination import (
+    RuleCursorPagination,
+    RuleSetCursorPagination,
+)
+from efu_engine.parallel import evaluation_pool
+from efu_engine.parsers import (
+    CSVParser,
+    NDJSONParser,
+)
+from efu_engine.profiling import timing
+from efu_engine.sets import SET_KINDS
+from efu_engine.signals import (
+    bump_rule_entries,
+    bump_rules_version,
+    bump_ruleset_versions,
+)
+from efu_engine.transfer import (
+    FORMAT_CSV,
+    FORMAT_JSONL,
+    FORMATS,
+    RuleImportError,
+    dump_rules,
+    load_rules,
+)
+
+
+def submitted_messages(messages):
+    """Return the SubmittedMessage of every message of a JSON batch.
+
+    Raises ValidationError when the batch is not a list, is too large or
+    holds an invalid message.
+    """
+    if not isinstance(messages, list):
+        raise ValidationError('Expected a list of messages.')
+    max_batch = engine_setting('EVALUATE_MAX_BATCH')
+    if len(messages) > max_batch:
+        raise ValidationError(
+            'At most %d messages can be evaluated per request.' % max_batch
+        )
+    submitted = []
+    for index, data in enumerate(messages):
+        try:
+            submitted.append(SubmittedMessage(data))
+        except ValueError as exc:
+            raise ValidationError({index: [str(exc)]})
+    return submitted
+
+
+def _rules_state(request):
+    """Return the rules version and its modification time for the user.
+
+    Loaded once per request with a single query on the user row.
+    """
+    if not hasattr(request, '_rules_state'):
+        request._rules_state = get_user_model().objects.filter(
+            pk=request.user.pk,
+        ).values_list('rules_version', 'rules_updated_at').first()
+    return request._rules_state
+
+
+def rules_etag(request, *args, **kwargs):
+    """Return the ETag of a ruleset read by the current user.
+
+    It covers the rules version of the user and everything else the
+    response depends on: the URL with its query and the accepted format.
+    """
+    version, _ = _rules_state(request)
+    variant = '%s\n%s' % (request.get_full_path(), request.META.get('HTTP_ACCEPT', ''))
+    digest = hashlib.sha1(variant.encode()).hexdigest()[:16]
+    return '%d-%d-%s' % (request.user.pk, version, digest)
+
+
+def rules_last_modified(request, *args, **kwargs):
+    """Return the last change to the rulesets or rules of the user."""
+    return _rules_state(request)[1]
+
+
+rules_condition = method_decorator(
+    condition(etag_func=rules_etag, last_modified_func=rules_last_modified)
+)
+
+
+def evaluation_result(compiled, index, message):
+    """Return the evaluation result of one message."""
+    rules, action = result_cache.evaluate(compiled, message)
+    return {'index': index, 'rules': rules, 'action': action}
+
+
+def match_messages(compiled, messages):
+    """Return the evaluation results of a list of messages."""
+    with timing('evaluate'):
+        return [
+            evaluation_result(compiled, index, message)
+            for index, message in enumerate(messages)
+        ]
+
 
 @extend_schema_view(
     list=extend_schema(
@@ -38,7 +189,8 @@ class RuleSetViewSet(viewsets.ModelViewSet):
     """View for manage recipe APIs."""
     serializer_class = serializers.RuleSetSerializer
     queryset = RuleSet.objects.all()
-    authentication_classes = [TokenAuthentication]
+    pagination_class = RuleSetCursorPagination
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def _params_to_ints(self, qs):
@@ -46,15 +198,21 @@ class RuleSetViewSet(viewsets.ModelViewSet):
         return [int(str_id) for str_id in qs.split(',')]
 
     def get_queryset(self):
-        """Retrieve recipes for authenticated user."""
+        """Retrieve rulesets for authenticated user."""
         rules = self.request.query_params.get('rules')
-        queryset = self.queryset
+        queryset = self.queryset.filter(user=self.request.user)
         if rules:
             rule_ids = self._params_to_ints(rules)
-            queryset = queryset.filter(rules__id__in=rule_ids)
-        return queryset.filter(
-            user=self.request.user
-        ).order_by('-id').distinct()
+            # A semi-join on the through table keeps one row per ruleset,
+            # so no DISTINCT over the joined rows is needed.
+            queryset = queryset.filter(
+                id__in=RuleSetRule.objects.filter(
+                    rule_id__in=rule_ids,
+                ).values('ruleset_id')
+            )
+        if self.action in ('list', 'retrieve'):
+            queryset = queryset.prefetch_related('rules')
+        return queryset.order_by('-id')
 
     def get_serializer_class(self):
         """Return the serializer class for request."""
@@ -63,10 +221,143 @@ class RuleSetViewSet(viewsets.ModelViewSet):
 
         return self.serializer_class
 
+    @rules_condition
+    def list(self, request, *args, **kwargs):
+        """List rulesets, or 304 if the client copy is still current."""
+        return super().list(request, *args, **kwargs)
+
+    @rules_condition
+    def retrieve(self, request, *args, **kwargs):
+        """Return a ruleset, or 304 if the client copy is still current."""
+        return super().retrieve(request, *args, **kwargs)
+
     def perform_create(self, serializer):
         """Create a new ruleset."""
         serializer.save(user=self.request.user)
 
+    @extend_schema(responses=OpenApiTypes.OBJECT)
+    @action(
+        detail=False,
+        methods=['get'],
+        url_path='cache-stats',
+        permission_classes=[IsAuthenticated, IsAdminUser],
+    )
+    def cache_stats(self, request):
+        """Return the counters of the compiled ruleset cache."""
+        stats = ruleset_cache.stats()
+        stats['patterns'] = pattern_pool.stats()
+        stats['isolation'] = isolated_search.stats()
+        stats['results'] = result_cache.stats()
+        return Response(stats)
+
+    @extend_schema(responses={(200, ARTIFACT_CONTENT_TYPE): OpenApiTypes.BINARY})
+    @action(detail=True, methods=['get'])
+    @rules_condition
+    def artifact(self, request, pk=None):
+        """Return the compiled binary artifact of a ruleset.
+
+        See efu_engine.artifact for the format; filtering agents can
+        memory map it and start matching without the rules API.
+        """
+        ruleset = self.get_object()
+        response = HttpResponse(
+            dump_stored_ruleset(ruleset), content_type=ARTIFACT_CONTENT_TYPE,
+        )
+        response['Content-Disposition'] = (
+            'attachment; filename="ruleset-%d-v%d.efurs"' % (ruleset.id, ruleset.version)
+        )
+        return response
+
+    @extend_schema(
+        request=serializers.RuleSetMemberSerializer(many=True),
+        responses=serializers.RuleSetMemberSerializer(many=True),
+    )
+    @action(detail=True, methods=['get', 'patch'])
+    def members(self, request, pk=None):
+        """List or change the position and action of the ruleset's rules.
+
+        A PATCH body lists the members to change; rules not listed keep
+        their position and action.
+        """
+        ruleset = self.get_object()
+        members = ruleset.rulesetrule_set.order_by('position', 'rule_id')
+        if request.method == 'PATCH':
+            serializer = serializers.RuleSetMemberSerializer(data=request.data, many=True)
+            serializer.is_valid(raise_exception=True)
+            changed = self._update_members(ruleset, members, serializer.validated_data)
+            if changed:
+                members = members.all()
+        return Response(serializers.RuleSetMemberSerializer(members, many=True).data)
+
+    def _update_members(self, ruleset, members, changes):
+        """Apply validated member changes and return whether any applied."""
+        by_rule = {member.rule_id: member for member in members}
+        unknown = sorted({change['rule_id'] for change in changes} - by_rule.keys())
+        if unknown:
+            raise ValidationError({'rule': [
+                'Rules %s are not in the ruleset.' % ', '.join(map(str, unknown))
+            ]})
+        for change in changes:
+            member = by_rule[change['rule_id']]
+            member.position = change['position']
+            member.action = change['action']
+        if not changes:
+            return False
+        with transaction.atomic():
+            RuleSetRule.objects.bulk_update(
+                [by_rule[change['rule_id']] for change in changes],
+                ['position', 'action'],
+                batch_size=1000,
+            )
+            # bulk_update sends no signal.
+            bump_ruleset_versions(RuleSet.objects.filter(pk=ruleset.pk))
+            bump_rules_version(ruleset.user_id)
+        return True
+
+    def _evaluate_stream(self, compiled, messages):
+        """Yield NDJSON result lines for a stream of messages."""
+        chunk_size = engine_setting('EVALUATE_STREAM_CHUNK')
+        lines = []
+        index = -1
+        try:
+            for index, data in enumerate(messages):
+                try:
+                    result = evaluation_result(compiled, index, SubmittedMessage(data))
+                except ValueError as exc:
+                    result = {'index': index, 'error': str(exc)}
+                lines.append(json.dumps(result))
+                if len(lines) >= chunk_size:
+                    yield '\n'.join(lines) + '\n'
+                    lines = []
+        except ParseError as exc:
+            lines.append(json.dumps({'index': index + 1, 'error': str(exc.detail)}))
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    @extend_schema(
+        request=serializers.MessageSerializer(many=True),
+        responses=serializers.EvaluationResultSerializer(many=True),
+    )
+    @action(
+        detail=True,
+        methods=['post'],
+        parser_classes=[JSONParser, NDJSONParser],
+    )
+    def evaluate(self, request, pk=None):
+        """Return the ids of the rules matching each message of a batch.
+
+        A JSON array is answered with a JSON array. An NDJSON body is read
+        and answered line by line so large batches are never buffered.
+        """
+        compiled = get_compiled_ruleset(self.get_object())
+        if request.content_type.startswith(NDJSONParser.media_type):
+            return StreamingHttpResponse(
+                self._evaluate_stream(compiled, request.data),
+                content_type=NDJSONParser.media_type,
+            )
+
+        return Response(match_messages(compiled, submitted_messages(request.data)))
+
 
 @extend_schema_view(
     list=extend_schema(
@@ -84,7 +375,7 @@ class BaseRuleSetAttrViewSet(mixins.DestroyModelMixin,
                             mixins.ListModelMixin,
                             viewsets.GenericViewSet):
     """Base viewset for ruleset attributes."""
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
@@ -94,14 +385,200 @@ class BaseRuleSetAttrViewSet(mixins.DestroyModelMixin,
         )
         queryset = self.queryset
         if assigned_only:
-            queryset = queryset.filter(ruleset__isnull=False)
+            # EXISTS probes the (rule, ruleset) index once per row instead
+            # of joining every membership and deduplicating with DISTINCT.
+            queryset = queryset.filter(
+                Exists(RuleSetRule.objects.filter(rule=OuterRef('pk')))
+            )
 
         return queryset.filter(
             user=self.request.user
-        ).order_by('-name').distinct()
+        ).order_by('-name', '-id')
 
 class RuleViewSet(BaseRuleSetAttrViewSet):
     """Manage rules in the database."""
     serializer_class = serializers.RuleSerializer
     queryset = Rule.objects.all()
+    pagination_class = RuleCursorPagination
+
+    @extend_schema(request=serializers.RuleEntriesSerializer, responses=OpenApiTypes.OBJECT)
+    @action(detail=True, methods=['get', 'post'])
+    def entries(self, request, pk=None):
+        """List, add or remove the entries of a domain, address or IP set rule.
+
+        A POST body holds the entries to add and to remove; entries are
+        normalized first, so equivalent spellings are the same entry.
+        """
+        rule = self.get_object()
+        if rule.kind not in SET_KINDS:
+            raise ValidationError({'kind': ['Only set rules have entries.']})
+        if request.method == 'POST':
+            serializer = serializers.RuleEntriesSerializer(
+                data=request.data, context={'rule': rule},
+            )
+            serializer.is_valid(raise_exception=True)
+            self._write_entries(rule, **serializer.validated_data)
+        values = list(rule.entries.order_by('value').values_list('value', flat=True))
+        return Response({'count': len(values), 'entries': values})
+
+    def _write_entries(self, rule, add, remove):
+        """Bulk add and remove entries of a rule."""
+        batch_size = 1000
+        with transaction.atomic():
+            for start in range(0, len(remove), batch_size):
+                rule.entries.filter(value__in=remove[start:start + batch_size]).delete()
+            RuleEntry.objects.bulk_create(
+                [RuleEntry(rule=rule, value=value) for value in dict.fromkeys(add)],
+                batch_size=batch_size,
+                ignore_conflicts=True,
+            )
+            bump_rule_entries(rule)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                'limit',
+                OpenApiTypes.INT,
+                description='Number of rules to return, 20 by default.',
+            ),
+        ],
+        responses=serializers.RuleCostSerializer(many=True),
+    )
+    @action(detail=False, methods=['get'])
+    def costs(self, request):
+        """Return the rules of the user that took longest to evaluate.
+
+        Counters are kept per server process since it started; rules are
+        ranked by their total search time.
+        """
+        try:
+            limit = max(0, min(int(request.query_params.get('limit', 20)), 1000))
+        except ValueError:
+            raise ValidationError({'limit': ['A valid integer is required.']})
+        rules = dict(
+            Rule.objects.filter(user=request.user).values_list('id', 'name')
+        )
+        return Response([
+            dict(cost, id=rule_id, name=rules[rule_id])
+            for rule_id, cost in rule_costs.slowest(rules, limit)
+        ])
+
+    @extend_schema(request={
+        NDJSONParser.media_type: OpenApiTypes.OBJECT,
+        CSVParser.media_type: OpenApiTypes.STR,
+    }, responses=OpenApiTypes.OBJECT)
+    @action(
+        detail=False,
+        methods=['post'],
+        url_path='import',
+        url_name='import',
+        parser_classes=[NDJSONParser, CSVParser],
+    )
+    def import_rules(self, request):
+        """Create rules in bulk from an NDJSON or CSV upload.
+
+        The upload is read as it is validated and written in batches in
+        one transaction, so an invalid row leaves the rules unchanged.
+        Rows identical to existing rules or earlier rows are skipped and
+        counted as duplicates.
+        """
+        try:
+            counts = load_rules(request.user, request.data)
+        except RuleImportError as exc:
+            return Response(
+                {'row': exc.row, 'errors': exc.errors},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(counts, status=status.HTTP_201_CREATED)
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                'type',
+                OpenApiTypes.STR, enum=FORMATS,
+                description='File format, jsonl by default.',
+            ),
+        ],
+        responses={(200, 'application/x-ndjson'): OpenApiTypes.STR},
+    )
+    @action(detail=False, methods=['get'], url_path='export', url_name='export')
+    def export_rules(self, request):
+        """Stream the rules of the user as JSONL or CSV."""
+        file_format = request.query_params.get('type', FORMAT_JSONL)
+        if file_format not in FORMATS:
+            raise ValidationError({'type': ['Expected one of %s.' % ', '.join(FORMATS)]})
+        content_type = CSVParser.media_type if file_format == FORMAT_CSV else NDJSONParser.media_type
+        response = StreamingHttpResponse(
+            dump_rules(self.get_queryset(), file_format), content_type=content_type,
+        )
+        response['Content-Disposition'] = 'attachment; filename="rules.%s"' % file_format
+        return response
+
+
+
+@sync_to_async
+def _authenticated_ruleset(request, pk):
+    """Authenticate the request token and return the user's compiled ruleset."""
+    authenticated = CachedTokenAuthentication().authenticate(request)
+    if authenticated is None:
+        raise NotAuthenticated()
+    ruleset = get_object_or_404(RuleSet, pk=pk, user=authenticated[0])
+    return get_compiled_ruleset(ruleset)
+
+
+def _evaluate_body(compiled, content_type, body):
+    """Parse a JSON array or NDJSON body and evaluate its messages."""
+    if content_type == NDJSONParser.media_type:
+        messages = list(NDJSONParser().parse(io.BytesIO(body)))
+    elif content_type == JSONParser.media_type:
+        messages = JSONParser().parse(io.BytesIO(body))
+    else:
+        raise UnsupportedMediaType(content_type)
+    return match_messages(compiled, submitted_messages(messages))
+
+
+def _error_response(exc):
+    """Return the JSON response DRF would send for an API exception."""
+    detail = exc.detail
+    if not isinstance(detail, (list, dict)):
+        detail = {'detail': detail}
+    response = JsonResponse(detail, status=exc.status_code, safe=False)
+    if isinstance(exc, (NotAuthenticated, AuthenticationFailed)):
+        response['WWW-Authenticate'] = CachedTokenAuthentication().authenticate_header(None)
+    return response
+
+
+async def evaluate_async(request, pk):
+    """Return the ids of the rules matching each message of a batch.
+
+    The async counterpart of the ruleset evaluate action for ASGI servers.
+    The token and ruleset are loaded through sync_to_async and matching
+    runs in the bounded evaluation pool, so waiting clients only hold a
+    coroutine, not a thread. A JSON array is answered with a JSON array
+    and an NDJSON body with NDJSON.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        compiled = await _authenticated_ruleset(request, pk)
+        # Executors do not carry over context variables, such as the
+        # profile of the request.
+        context = contextvars.copy_context()
+        results = await asyncio.get_running_loop().run_in_executor(
+            evaluation_pool(), context.run, _evaluate_body,
+            compiled, request.content_type, request.body,
+        )
+    except APIException as exc:
+        return _error_response(exc)
+    except Http404:
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+    if request.content_type == NDJSONParser.media_type:
+        return HttpResponse(
+            ''.join(json.dumps(result) + '\n' for result in results),
+            content_type=NDJSONParser.media_type,
+        )
+    return JsonResponse(results, safe=False)
+
 
+# Clients authenticate with a token, not a session cookie.
+evaluate_async.csrf_exempt = True